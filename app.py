@@ -1,17 +1,25 @@
-print(">>> running:", __file__)
-import os; print(">>> cwd:", os.getcwd())
-
-from flask import Flask, render_template, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, render_template, request, jsonify, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os, re, json, traceback
-from sqlalchemy import create_engine, Column, String, Integer, BigInteger, ForeignKey, DateTime, func
+import threading, queue, time, atexit, zlib
+import bisect, csv, hashlib, ipaddress, base64, io, tempfile, importlib.util
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import create_engine, Column, String, Integer, BigInteger, ForeignKey, DateTime, func, select, update
+from sqlalchemy import Index, Table, bindparam, case, event
+from sqlalchemy.exc import OperationalError, TimeoutError as SATimeoutError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.orm import DeclarativeBase, relationship, sessionmaker
 import uuid
 import requests
+import click
 from sqlalchemy import text
 from functools import wraps
+from contextlib import contextmanager
 from flask import session, redirect, url_for, render_template_string
 
 
@@ -19,9 +27,8 @@ from flask import session, redirect, url_for, render_template_string
 #   Config
 # =========================
 load_dotenv()
-app = Flask(__name__, static_folder="static", template_folder="templates")
-CORS(app)
-app.secret_key = os.getenv("SECRET_KEY", "dev")
+# Rutas y comandos CLI se registran en este blueprint; create_app() (al final) arma la app Flask
+bp = Blueprint("guia", __name__, cli_group=None)
 
 # --- Admin key desde .env (default Bootcamp1) ---
 ADMIN_KEY = os.getenv("ADMIN_KEY", "Bootcamp1")
@@ -52,7 +59,7 @@ def require_admin(view_func):
         # Si el cliente es navegador (HTML), redirige a login; si es API, 401 JSON
         accepts_html = "text/html" in (request.headers.get("Accept") or "")
         if accepts_html and request.method in ("GET", "HEAD"):
-            return redirect(url_for("analytics_login"))
+            return redirect(url_for(".analytics_login"))
         return jsonify(ok=False, error="unauthorized"), 401
     return wrapper
 
@@ -65,21 +72,78 @@ if not DATABASE_URL:
     # Local sin Postgres: usa SQLite para pruebas
     DATABASE_URL = "sqlite:///./dev.db"
 
+# Réplica de lectura opcional para la analítica (stats, query, timeseries, exports): pool propio,
+# sesiones de solo lectura y, si no está configurada o no responde, se lee del primario.
+DATABASE_READ_URL = (os.getenv("DATABASE_READ_URL") or "").strip()
+READ_POOL_SIZE = int(os.getenv("READ_POOL_SIZE", "3"))
+READ_MAX_OVERFLOW = int(os.getenv("READ_MAX_OVERFLOW", "2"))
+READ_POOL_TIMEOUT_S = float(os.getenv("READ_POOL_TIMEOUT_S", "5"))
+
+class _PoolStats:
+    """Espera por checkout (ms) y ocupación máxima de un pool; la alimenta _TimedQueuePool."""
+    def __init__(self, window: int = 1024):
+        self._waits = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.checkouts = self.timeouts = self.peak_in_use = 0
+        self.wait_ms_max = 0.0
+
+    def record(self, wait_ms: float, in_use: int | None, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self._waits.append(wait_ms)
+            self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+            if in_use is not None:
+                self.peak_in_use = max(self.peak_in_use, in_use)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            out = {"checkouts": self.checkouts, "timeouts": self.timeouts,
+                   "peak_in_use": self.peak_in_use, "wait_ms_max": round(self.wait_ms_max, 2)}
+        for pct in (50, 95, 99):
+            out[f"wait_ms_p{pct}"] = round(waits[min(len(waits) - 1, int(len(waits) * pct / 100))], 2) if waits else None
+        return out
+
+_POOL_STATS: dict[str, _PoolStats] = {}
+
+class _TimedQueuePool(QueuePool):
+    """QueuePool que mide cuánto espera cada checkout (incluye abrir conexión nueva si hace falta)."""
+    def connect(self):
+        stats = _POOL_STATS.setdefault(self.logging_name or "primary", _PoolStats())
+        t0 = time.perf_counter()
+        try:
+            conn = super().connect()
+        except SATimeoutError:
+            stats.record((time.perf_counter() - t0) * 1000.0, None, timed_out=True)
+            raise
+        stats.record((time.perf_counter() - t0) * 1000.0, self.checkedout())
+        return conn
+
+def _make_engine(url: str, name: str, read_only: bool = False, **pool):
+    kwargs = dict(pool_pre_ping=True, poolclass=_TimedQueuePool, pool_logging_name=name)
+    if url.startswith("postgresql"):
+        kwargs.update(pool)  # Postgres: sí definimos pool_size y max_overflow
+        if read_only:
+            kwargs["connect_args"] = {"options": "-c default_transaction_read_only=on"}
+    eng = create_engine(url, **kwargs)  # SQLite: NO pases pool_size ni max_overflow
+    if read_only and not url.startswith("postgresql"):
+        event.listen(eng, "connect", lambda dbapi_conn, _rec: dbapi_conn.execute("PRAGMA query_only = ON"))
+    return eng
+
 # Crea el engine según el tipo de URL
-if DATABASE_URL.startswith("postgresql"):
-    # Postgres (Render o local): sí definimos pool_size y max_overflow
-    engine = create_engine(
-        DATABASE_URL,
-        pool_pre_ping=True,
-        pool_size=5,
-        max_overflow=10,
-    )
-else:
-    # SQLite: NO pases pool_size ni max_overflow
-    engine = create_engine(
-        DATABASE_URL,
-        pool_pre_ping=True,
-    )
+engine = _make_engine(DATABASE_URL, "primary", pool_size=5, max_overflow=10)
+read_engine = (_make_engine(DATABASE_READ_URL, "read", read_only=True, pool_size=READ_POOL_SIZE,
+                            max_overflow=READ_MAX_OVERFLOW, pool_timeout=READ_POOL_TIMEOUT_S)
+               if DATABASE_READ_URL else None)
+
+@event.listens_for(engine, "checkin")
+def _clear_query_only(dbapi_conn, record):
+    # Lecturas de respaldo en el primario (SQLite): la conexión vuelve al pool escribible
+    if record.info.pop("query_only", False):
+        dbapi_conn.execute("PRAGMA query_only = OFF")
 
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
@@ -87,29 +151,54 @@ class Base(DeclarativeBase):
     pass
 
 
+# --- Proveedores LLM: import perezoso ---
+# google.generativeai (gRPC/protobuf) y ollama (httpx/pydantic) suman ~1 s de import. Al arrancar solo
+# se comprueba que estén instalados; cada worker los importa en la primera llamada.
+def _module_available(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+_provider_lock = threading.Lock()
+
 # --- Ollama (opcional) ---
-try:
-    from ollama import Client as OllamaClient
-    OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
-    LLM_MODEL   = os.getenv("LLM_MODEL", "mistral")
-    ollama = OllamaClient(host=OLLAMA_HOST)
-    _HAS_OLLAMA = True
-except Exception:
-    _HAS_OLLAMA = False
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+LLM_MODEL   = os.getenv("LLM_MODEL", "mistral")
+OLLAMA_TIMEOUT_S = float(os.getenv("OLLAMA_TIMEOUT_S", "20"))
+_HAS_OLLAMA = _module_available("ollama")
+_ollama_client = None
+
+def _ollama():
+    """Cliente Ollama del worker (se crea en el primer uso)."""
+    global _ollama_client
+    if _ollama_client is None:
+        with _provider_lock:
+            if _ollama_client is None:
+                from ollama import Client as OllamaClient
+                _ollama_client = OllamaClient(host=OLLAMA_HOST, timeout=OLLAMA_TIMEOUT_S)
+    return _ollama_client
 
 # --- Gemini (requerido para scorecard y fallback de validación) ---
-_HAS_GENAI = False
-try:
-    import google.generativeai as genai  # import temprano
-    # Clave: argumento -> variable global Geminiapikey -> env
-    _GEMINI_KEY = (globals().get("Geminiapikey") or
-                   os.getenv("GEMINI_API_KEY") or
-                   os.getenv("GEMINI_APIKEY"))
-    if _GEMINI_KEY:
-        genai.configure(api_key=_GEMINI_KEY)
-        _HAS_GENAI = True
-except Exception:
-    _HAS_GENAI = False
+# Clave: argumento -> variable global Geminiapikey -> env
+_GEMINI_KEY = (globals().get("Geminiapikey") or
+               os.getenv("GEMINI_API_KEY") or
+               os.getenv("GEMINI_APIKEY"))
+_HAS_GENAI = bool(_GEMINI_KEY) and _module_available("google.generativeai")
+_GENAI_CONFIGURED_KEY = _GEMINI_KEY if _HAS_GENAI else None
+_genai_module = None
+
+def _genai():
+    """Módulo google.generativeai, importado y configurado con la clave global en el primer uso."""
+    global _genai_module
+    if _genai_module is None:
+        with _provider_lock:
+            if _genai_module is None:
+                import google.generativeai as genai
+                if _GENAI_CONFIGURED_KEY:
+                    genai.configure(api_key=_GENAI_CONFIGURED_KEY)
+                _genai_module = genai
+    return _genai_module
 
 # =========================
 #   Utilidades
@@ -184,50 +273,500 @@ def _extract_text_from_candidates(resp) -> str:
     except Exception:
         return ""
 
+def _norm_key_text(s) -> str:
+    """Minúsculas y espacios colapsados: 'Claridad,  ejemplos' == 'claridad, ejemplos'."""
+    return re.sub(r"\s+", " ", str(s or "")).strip().lower()
+
+def _hash_key(*parts, lower: bool = True) -> str:
+    """Hash estable (sha256) de varias partes normalizadas; sirve como llave de caché.
+    lower=False conserva mayúsculas (para textos cuyo resultado depende de ellas, p. ej. prompts)."""
+    h = hashlib.sha256()
+    for p in parts:
+        t = _norm_key_text(p) if lower else re.sub(r"\s+", " ", str(p or "")).strip()
+        h.update(t.encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+class _TTLCache:
+    """LRU acotado con expiración opcional (ttl en segundos; None = no expira). Thread-safe."""
+    _DEFAULT = object()
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (expira_en | None, valor)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (item[0] is not None and item[0] <= now):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=_DEFAULT):
+        ttl = self.ttl if ttl is self._DEFAULT else ttl
+        expires = (time.monotonic() + ttl) if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> int:
+        with self._lock:
+            n = len(self._data)
+            self._data.clear()
+        return n
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data), "maxsize": self.maxsize, "ttl_s": self.ttl,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+# --- Registro de modelos Gemini: un handle por (modelo, instrucción, config) y por worker ---
+# genai.configure() descarta los clientes gRPC ya creados, así que se llama una sola vez;
+# el canal HTTP/2 del cliente por defecto queda abierto y lo comparten todos los modelos.
+GENAI_KEY_POOL_MAX = int(os.getenv("GENAI_KEY_POOL_MAX", "8"))
+GENAI_MODEL_REGISTRY_MAX = int(os.getenv("GENAI_MODEL_REGISTRY_MAX", "64"))
+# Acotado (LRU): el nombre del modelo puede venir del cliente (/api/scorecard)
+_genai_models = _TTLCache(maxsize=GENAI_MODEL_REGISTRY_MAX)      # spec -> GenerativeModel
+_genai_models_lock = threading.Lock()
+_genai_key_clients = _TTLCache(maxsize=GENAI_KEY_POOL_MAX)       # hash(api_key) -> cliente propio
+_genai_key_models = _TTLCache(maxsize=GENAI_KEY_POOL_MAX * 8)    # (hash(api_key), spec) -> modelo
+
+def _genai_client_for_key(api_key: str):
+    """Cliente gRPC para una API key distinta a la global (pool acotado, LRU)."""
+    from google.ai import generativelanguage as glm
+    kh = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    client = _genai_key_clients.get(kh)
+    if client is None:
+        client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+        _genai_key_clients.set(kh, client)
+    return kh, client
+
+class _KeyedGeminiModel:
+    """
+    Modelo para una API key propia sobre los clientes públicos de google.ai.generativelanguage
+    (GenerativeModel no acepta un cliente). Mismo uso que GenerativeModel para un texto:
+    generate_content(texto) y generate_content_async(texto); la respuesta trae candidates/parts.
+    """
+    def __init__(self, client, api_key: str, model_name: str, system_instruction: str | None,
+                 generation_config: dict | None, safety_settings: list | None):
+        self._client = client
+        self._api_key = api_key
+        self._async_client = None
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self._system_instruction = system_instruction
+        self._generation_config = generation_config
+        self._safety_settings = safety_settings
+
+    def _request(self, text_in: str):
+        from google.ai import generativelanguage as glm
+        kwargs = {"model": self.model_name,
+                  "contents": [glm.Content(role="user", parts=[glm.Part(text=text_in)])]}
+        if self._system_instruction:
+            kwargs["system_instruction"] = glm.Content(parts=[glm.Part(text=self._system_instruction)])
+        if self._generation_config:
+            kwargs["generation_config"] = glm.GenerationConfig(**self._generation_config)
+        if self._safety_settings:
+            kwargs["safety_settings"] = [glm.SafetySetting(**x) for x in self._safety_settings]
+        return glm.GenerateContentRequest(**kwargs)
+
+    def generate_content(self, text_in: str):
+        return self._client.generate_content(request=self._request(text_in))
+
+    async def generate_content_async(self, text_in: str):
+        if self._async_client is None:
+            from google.ai import generativelanguage as glm
+            self._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": self._api_key})
+        return await self._async_client.generate_content(request=self._request(text_in))
+
+def get_gemini_model(model_name: str,
+                     system_instruction: str | None = None,
+                     generation_config: dict | None = None,
+                     safety_settings: list | None = None,
+                     api_key: str | None = None):
+    """
+    GenerativeModel reutilizable. Con api_key distinta a la configurada, el modelo usa
+    un cliente del pool secundario en vez de reconfigurar genai para todo el proceso.
+    """
+    spec = json.dumps([model_name, system_instruction or "", generation_config or {}, safety_settings or []],
+                      sort_keys=True, ensure_ascii=False)
+
+    def build():
+        return _genai().GenerativeModel(
+            model_name=model_name,
+            system_instruction=system_instruction or None,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+        )
+
+    if api_key and api_key != _GENAI_CONFIGURED_KEY:
+        kh, client = _genai_client_for_key(api_key)
+        model = _genai_key_models.get((kh, spec))
+        if model is None:
+            model = _KeyedGeminiModel(client, api_key, model_name, system_instruction,
+                                      generation_config, safety_settings)
+            _genai_key_models.set((kh, spec), model)
+        return model
+
+    model = _genai_models.get(spec)
+    if model is None:
+        with _genai_models_lock:
+            model = _genai_models.get(spec)
+            if model is None:
+                model = build()
+                _genai_models.set(spec, model)
+    return model
+
+def genai_registry_stats() -> dict:
+    return {
+        "models": _genai_models.stats(),
+        "key_clients": _genai_key_clients.stats(),
+        "key_models": len(_genai_key_models),
+    }
+
+# --- Circuit breaker por proveedor LLM ---
+# _HAS_OLLAMA solo indica que el paquete está instalado; si el servidor local está caído o lento,
+# cada llamada pagaría el timeout completo antes del fallback. El breaker corta ese camino:
+# closed -> (N fallos seguidos) -> open -> (reset) -> half_open (una sola sonda) -> closed/open.
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_RESET_S = float(os.getenv("LLM_BREAKER_RESET_S", "30"))
+OLLAMA_HEALTH_INTERVAL_S = float(os.getenv("OLLAMA_HEALTH_INTERVAL_S", "15"))
+OLLAMA_HEALTH_TIMEOUT_S = float(os.getenv("OLLAMA_HEALTH_TIMEOUT_S", "2"))
+
+class _CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failures: int = 3, reset_s: float = 30.0, state: str = CLOSED):
+        self.name = name
+        self.max_failures = max(1, failures)
+        self.reset_s = reset_s
+        self.state = state
+        self.failures = 0
+        self.opened_at = time.monotonic() if state == self.OPEN else 0.0
+        self.last_error = None
+        self.trips = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """¿Se puede llamar al proveedor ahora? En half_open deja pasar una única sonda."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_s:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def failure(self, err=None):
+        with self._lock:
+            self.failures += 1
+            self.last_error = (str(err) or type(err).__name__)[:200] if err else None
+            if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+                self._open()
+            self._probing = False
+
+    def trip(self, err=None):
+        """Apertura inmediata (p. ej. el health checker no alcanza el servidor)."""
+        with self._lock:
+            self.last_error = (str(err) or type(err).__name__)[:200] if err else self.last_error
+            self._open()  # si ya estaba abierto, reinicia la ventana: no hace falta sondear un servidor caído
+            self._probing = False
+
+    def _open(self):
+        if self.state != self.OPEN:
+            self.trips += 1
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = round(max(0.0, self.reset_s - (time.monotonic() - self.opened_at)), 1)
+            return {"state": self.state, "failures": self.failures, "trips": self.trips,
+                    "retry_in_s": retry_in, "last_error": self.last_error}
+
+# Ollama arranca abierto hasta que el health checker confirme que el servidor responde.
+_BREAKERS = {
+    "ollama": _CircuitBreaker("ollama", LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_S,
+                              state=_CircuitBreaker.OPEN if _HAS_OLLAMA else _CircuitBreaker.CLOSED),
+    "gemini": _CircuitBreaker("gemini", LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_S),
+}
+
+class _OllamaHealth:
+    """Hilo que sondea ollama.list() con timeout corto y mantiene el breaker al día."""
+
+    def __init__(self, interval: float, timeout: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.checked_at = None
+        self.healthy = None
+        self.latency_ms = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if not _HAS_OLLAMA or self.interval <= 0:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="ollama-health", daemon=True)
+                self._thread.start()
+
+    def check(self) -> bool:
+        t0 = time.monotonic()
+        try:
+            from ollama import Client as OllamaClient
+            OllamaClient(host=OLLAMA_HOST, timeout=self.timeout).list()
+            self.healthy = True
+            _BREAKERS["ollama"].success()
+        except Exception as e:
+            self.healthy = False
+            _BREAKERS["ollama"].trip(e)
+        self.latency_ms = round((time.monotonic() - t0) * 1000, 1)
+        self.checked_at = datetime.utcnow().isoformat() + "Z"
+        return self.healthy
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def snapshot(self) -> dict:
+        return {"healthy": self.healthy, "checked_at": self.checked_at, "latency_ms": self.latency_ms,
+                "interval_s": self.interval}
+
+_ollama_health = _OllamaHealth(OLLAMA_HEALTH_INTERVAL_S, OLLAMA_HEALTH_TIMEOUT_S)
+
+def llm_breakers_snapshot() -> dict:
+    out = {name: b.snapshot() for name, b in _BREAKERS.items()}
+    if _HAS_OLLAMA:
+        out["ollama"]["health"] = _ollama_health.snapshot()
+    return out
+
+# --- Latencias por proveedor (ventana circular) y hedging ---
+# Con LLM_HEDGE=1, si el proveedor primario no respondió tras el percentil configurado de su
+# latencia reciente, se lanza la misma petición al secundario y gana la primera respuesta válida.
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "150"))
+LLM_HEDGE_DEFAULT_DELAY_MS = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_MS", "2000"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "512"))
+_HEDGE_MIN_SAMPLES = 20
+
+class _LatencyWindow:
+    """Últimas N latencias (ms) de llamadas exitosas; percentiles sobre la ventana."""
+
+    def __init__(self, size: int):
+        self._samples = deque(maxlen=max(1, size))
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, ms: float):
+        with self._lock:
+            self._samples.append(ms)
+            self.count += 1
+
+    def percentile(self, pct: float):
+        with self._lock:
+            data = sorted(self._samples)
+        if not data:
+            return None
+        k = min(len(data) - 1, max(0, int(round(pct / 100.0 * (len(data) - 1)))))
+        return data[k]
+
+    def __len__(self):
+        return len(self._samples)
+
+    def snapshot(self) -> dict:
+        return {"samples": len(self), "total": self.count,
+                **{f"p{q}": self.percentile(q) for q in (50, 95, 99)}}
+
+_LATENCY = {name: _LatencyWindow(LLM_LATENCY_WINDOW) for name in _BREAKERS}
+_hedge_stats = {"hedged": 0, "primary_won": 0, "secondary_won": 0}
+_hedge_stats_lock = threading.Lock()
+
+def _count_hedge(key: str):
+    with _hedge_stats_lock:
+        _hedge_stats[key] += 1
+
+def _hedge_delay_s(provider: str) -> float:
+    w = _LATENCY[provider]
+    ms = w.percentile(LLM_HEDGE_PERCENTILE) if len(w) >= _HEDGE_MIN_SAMPLES else None
+    return max(LLM_HEDGE_MIN_DELAY_MS, ms if ms is not None else LLM_HEDGE_DEFAULT_DELAY_MS) / 1000.0
+
+def llm_latency_snapshot() -> dict:
+    with _hedge_stats_lock:
+        hedge = dict(_hedge_stats)
+    return {"hedge": LLM_HEDGE, "percentile": LLM_HEDGE_PERCENTILE, **hedge,
+            "providers": {name: {**w.snapshot(), "hedge_delay_ms": round(_hedge_delay_s(name) * 1000, 1)}
+                          for name, w in _LATENCY.items()}}
+
+def _call_ollama(p: str, system, model, temperature) -> str:
+    """Una llamada a Ollama con contabilidad de breaker y latencia. Requiere allow() previo."""
+    br = _BREAKERS["ollama"]
+    t0 = time.monotonic()
+    try:
+        # Prepend de 'system' sencillo para generate(); si usas client.chat, adáptalo a messages=[...]
+        full_prompt = (f"{system}\n\n{p}" if system else p)
+        res = _ollama().generate(
+            model=model or os.getenv("LLM_MODEL", "mistral"),
+            prompt=full_prompt,
+            options={"temperature": temperature},
+            stream=False,
+        )
+    except Exception as e:
+        br.failure(e)
+        raise
+    br.success()
+    _LATENCY["ollama"].record((time.monotonic() - t0) * 1000)
+    return (res.get("response") or "").strip()
+
+def _call_gemini(p: str, system, model, temperature, max_tokens) -> str:
+    """Una llamada a Gemini con contabilidad de breaker y latencia. Requiere allow() previo."""
+    br = _BREAKERS["gemini"]
+    t0 = time.monotonic()
+    try:
+        m = get_gemini_model(
+            model or os.getenv("GEMINI_TEXT_MODEL", "gemini-1.5-flash"),
+            system_instruction=system or None,
+            generation_config={"temperature": temperature, "max_output_tokens": max_tokens},
+        )
+        resp = m.generate_content(p)
+    except Exception as e:
+        br.failure(e)
+        raise
+    br.success()
+    _LATENCY["gemini"].record((time.monotonic() - t0) * 1000)
+    return _extract_text_from_candidates(resp) or (getattr(resp, "text", "") or "").strip()
+
+def _hedged_generate(calls: list) -> dict:
+    """
+    calls = [(provider, fn), ...] en orden de preferencia; el primario ya pasó por allow() y los
+    demás se consultan a su breaker solo en el momento de lanzarlos.
+    Lanza el primario; si no contesta dentro de su hedge delay (o falla), lanza el secundario.
+    Devuelve la primera respuesta no vacía; los perdedores se cancelan o, si ya corren,
+    su resultado se descarta (el timeout del cliente acota cuánto siguen ocupando el pool).
+    """
+    pool = _llm_pool()
+    (first_name, first_fn), rest = calls[0], list(calls[1:])
+    pending = {pool.submit(first_fn): first_name}
+    errors = []
+    hedged = False
+    deadline = _hedge_delay_s(first_name)
+    try:
+        while pending:
+            done, _ = wait(list(pending), timeout=deadline if rest else None, return_when=FIRST_COMPLETED)
+            if not done:
+                name, fn = rest.pop(0)
+                if _BREAKERS[name].allow():
+                    _count_hedge("hedged")
+                    hedged = True
+                    pending[pool.submit(fn)] = name
+                continue
+            for fut in done:
+                name = pending.pop(fut)
+                try:
+                    txt = fut.result()
+                except Exception as e:
+                    errors.append(e)
+                    txt = ""
+                if txt:
+                    if hedged:
+                        _count_hedge("primary_won" if name == first_name else "secondary_won")
+                    return {"provider": name, "text": txt}
+            while not pending and rest:
+                name, fn = rest.pop(0)  # el primario falló: fallback inmediato sin esperar
+                if _BREAKERS[name].allow():
+                    pending[pool.submit(fn)] = name
+    finally:
+        for fut in pending:
+            fut.cancel()
+    if errors:
+        raise errors[-1]
+    return {"provider": calls[-1][0], "text": ""}
+
 def llm_generate(prompt: str,
                  system: str | None = None,
                  model_ollama: str | None = None,
                  model_gemini: str | None = None,
                  temperature: float = 0.2,
-                 max_tokens: int = 1024) -> dict:
+                 max_tokens: int = 1024,
+                 hedge: bool | None = None) -> dict:
     """
     Generación de texto con fallback:
-    - Si hay Ollama y responde, usa Ollama.
-    - Si no, usa Gemini.
+    - Si hay Ollama y su breaker lo permite, usa Ollama.
+    - Si no, usa Gemini (también protegido por su breaker).
+    - Con hedge=True (o LLM_HEDGE=1) y ambos proveedores disponibles, Gemini se lanza en paralelo
+      cuando Ollama supera su percentil de latencia; gana la primera respuesta válida.
     Retorna: {"provider": "ollama"|"gemini", "text": "..."} o lanza excepción si no hay ningún proveedor.
     """
     p = (prompt or "").strip()
     if not p:
         return {"provider": "none", "text": ""}
-
-    # 1) Intento con Ollama (si está instalado y accesible)
-    if globals().get("_HAS_OLLAMA", False):
+    hedge = LLM_HEDGE if hedge is None else hedge
+    has_ollama = globals().get("_HAS_OLLAMA", False)
+    has_genai = globals().get("_HAS_GENAI", False)
+    if has_ollama:
+        _ollama_health.ensure_started()
+
+    # 1) Intento con Ollama (si está instalado y el breaker no está abierto)
+    use_ollama = has_ollama and _BREAKERS["ollama"].allow()
+    if use_ollama and hedge and has_genai:
+        return _hedged_generate([
+            ("ollama", lambda: _call_ollama(p, system, model_ollama, temperature)),
+            ("gemini", lambda: _call_gemini(p, system, model_gemini, temperature, max_tokens)),
+        ])
+    if use_ollama:
         try:
-            # Prepend de 'system' sencillo para generate(); si usas client.chat, adáptalo a messages=[...]
-            full_prompt = (f"{system}\n\n{p}" if system else p)
-            res = ollama.generate(
-                model=model_ollama or os.getenv("LLM_MODEL", "mistral"),
-                prompt=full_prompt,
-                options={"temperature": temperature},
-                stream=False,
-            )
-            txt = (res.get("response") or "").strip()
+            txt = _call_ollama(p, system, model_ollama, temperature)
             if txt:
                 return {"provider": "ollama", "text": txt}
         except Exception:
             pass  # cae a Gemini
 
     # 2) Fallback con Gemini
-    if not globals().get("_HAS_GENAI", False):
+    if not has_genai:
         raise RuntimeError("No LLM provider available: configure GEMINI_API_KEY or enable Ollama.")
-    model = genai.GenerativeModel(
-        model_name=model_gemini or os.getenv("GEMINI_TEXT_MODEL", "gemini-1.5-flash"),
-        system_instruction=system or None,
-        generation_config={"temperature": temperature, "max_output_tokens": max_tokens},
-    )
-    resp = model.generate_content(p)
-    txt = _extract_text_from_candidates(resp) or (getattr(resp, "text", "") or "").strip()
-    return {"provider": "gemini", "text": txt}
+    if not _BREAKERS["gemini"].allow():
+        raise RuntimeError("LLM provider unavailable: gemini circuit is open.")
+    return {"provider": "gemini", "text": _call_gemini(p, system, model_gemini, temperature, max_tokens)}
 
 
 # =========================
@@ -251,6 +790,11 @@ class Session(Base):
     user_agent = Column(String(256), nullable=True)
     referrer = Column(String(256), nullable=True)
     user = relationship("User")
+    __table_args__ = (
+        Index("ix_sessions_user_started", "user_id", "started_at"),  # última sesión por usuario
+        Index("ix_sessions_started", "started_at"),
+        Index("ix_sessions_country", "country"),
+    )
 
 class SessionMetrics(Base):
     __tablename__ = "session_metrics"
@@ -270,42 +814,826 @@ class Prompt(Base):
     # En Postgres usamos JSONB; en SQLite guardamos como string
     prompt_initial_json = Column(JSONB if DATABASE_URL.startswith("postgresql") else String, nullable=False)
     created_at = Column(DateTime, server_default=func.now())
+    __table_args__ = (
+        Index("ix_prompts_session_created", "session_id", "created_at"),
+        Index("ix_prompts_created", "created_at"),
+    )
+
+class Event(Base):
+    """Log crudo append-only de /api/analytics/event (solo INSERT; sin índices secundarios)."""
+    __tablename__ = "events"
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    ts = Column(DateTime, nullable=False)
+    session_id = Column(UUID(as_uuid=True), nullable=False)  # sin FK: el log sobrevive a borrados
+    device_id = Column(String(128), nullable=False)
+    event = Column(String(32), nullable=False)
+    payload = Column(String, nullable=True)  # JSON compacto; None si viene vacío
+
+class _RollupColumns:
+    """Agregados por (bucket, país); los promedios se derivan: suma / sesiones."""
+    bucket_start = Column(DateTime, primary_key=True)
+    country = Column(String(64), primary_key=True, default="")  # "" = sin país
+    sessions = Column(Integer, nullable=False, default=0)
+    time_on_page_ms = Column(BigInteger, nullable=False, default=0)
+    first_prompt_ms = Column(BigInteger, nullable=False, default=0)          # suma de los > 0
+    first_prompt_sessions = Column(Integer, nullable=False, default=0)       # sesiones con primer prompt
+    improved_sessions = Column(Integer, nullable=False, default=0)
+    copied_sessions = Column(Integer, nullable=False, default=0)
+    prompts = Column(Integer, nullable=False, default=0)
+
+class RollupHourly(_RollupColumns, Base):
+    __tablename__ = "analytics_rollup_hourly"
+
+class RollupDaily(_RollupColumns, Base):
+    __tablename__ = "analytics_rollup_daily"
+
+class _SketchColumns:
+    """DDSketch serializado por (bucket, país, métrica); buckets y países se fusionan sumando cubetas."""
+    bucket_start = Column(DateTime, primary_key=True)
+    country = Column(String(64), primary_key=True, default="")  # "" = sin país
+    metric = Column(String(32), primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0)
+    sketch = Column(String, nullable=False)
+
+class SketchHourly(_SketchColumns, Base):
+    __tablename__ = "analytics_sketch_hourly"
+
+class SketchDaily(_SketchColumns, Base):
+    __tablename__ = "analytics_sketch_daily"
+
+# =========================
+#   Migraciones versionadas
+# =========================
+# Cada migración es (versión, nombre, función, concurrent). Las normales corren en su propia
+# transacción junto con el registro en schema_migrations; las 'concurrent' corren en autocommit
+# para poder usar CREATE INDEX CONCURRENTLY en Postgres (no bloquea escrituras).
+# Se aplican una vez por deploy con `flask --app app db-upgrade` (Procfile: release).
+_IS_PG = DATABASE_URL.startswith("postgresql")
+_MIGRATION_LOCK_KEY = 72_410_001  # pg_advisory_lock: un solo proceso migra a la vez
+
+_schema_migrations_t = Table(
+    "schema_migrations", Base.metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(128), nullable=False),
+    Column("applied_at", DateTime, server_default=func.now()),
+)
+
+def _create_index(conn, name: str, table: str, cols: str):
+    """CREATE INDEX idempotente; en Postgres CONCURRENTLY y rehaciendo los que quedaron INVALID."""
+    if not _IS_PG:
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({cols})")
+        return
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+        "WHERE c.relname = :n AND NOT i.indisvalid"), {"n": name}).first()
+    if invalid:  # un CONCURRENTLY interrumpido deja el índice marcado INVALID
+        conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    partitioned = conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :t"),
+        {"t": table}).first()
+    # Postgres no admite CONCURRENTLY sobre tablas particionadas
+    conn.exec_driver_sql(f"CREATE INDEX {'' if partitioned else 'CONCURRENTLY '}IF NOT EXISTS {name} ON {table} ({cols})")
+
+def _m001_baseline(conn):
+    Base.metadata.create_all(bind=conn)
+
+def _m002_analytics_indexes(conn):
+    for name, table, cols in (
+        ("ix_sessions_user_started", "sessions", "user_id, started_at"),
+        ("ix_sessions_started", "sessions", "started_at"),
+        ("ix_sessions_country", "sessions", "country"),
+        ("ix_prompts_session_created", "prompts", "session_id, created_at"),
+        ("ix_prompts_created", "prompts", "created_at"),
+    ):
+        _create_index(conn, name, table, cols)
+
+def _m003_rollups(conn):
+    Base.metadata.create_all(bind=conn, tables=[RollupHourly.__table__, RollupDaily.__table__])
+    compact_rollups(conn, since=None, sketches=False)  # backfill de todo el historial, una sola vez
+
+def _m004_sketches(conn):
+    Base.metadata.create_all(bind=conn, tables=[SketchHourly.__table__, SketchDaily.__table__])
+    compact_sketches(conn, since=None)
+
+def _m005_events(conn):
+    Base.metadata.create_all(bind=conn, tables=[Event.__table__])
+
+_MIGRATIONS = [
+    (1, "baseline", _m001_baseline, False),
+    (2, "analytics_indexes", _m002_analytics_indexes, True),
+    (3, "analytics_rollups", _m003_rollups, False),
+    (4, "analytics_sketches", _m004_sketches, False),
+    (5, "events_log", _m005_events, False),
+]
 
-# --- Crear tablas si no existen (idempotente) ---
-if os.getenv("AUTO_CREATE_TABLES", "true").lower() == "true":
+def applied_migrations() -> dict:
+    """versión -> nombre de las migraciones ya aplicadas ({} si la tabla aún no existe)."""
     try:
-        with engine.begin() as conn:
-            Base.metadata.create_all(bind=conn)
-        print("DB ready ✅ (create_all)")
+        with engine.connect() as conn:
+            return {r.version: r.name for r in conn.execute(select(_schema_migrations_t))}
+    except Exception:
+        return {}
+
+def run_migrations(target: int | None = None, log=print) -> list[int]:
+    """Aplica en orden las migraciones pendientes (hasta `target`). Devuelve las versiones aplicadas."""
+    done = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        if _IS_PG:
+            lock_conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": _MIGRATION_LOCK_KEY})
+        try:
+            _schema_migrations_t.create(lock_conn, checkfirst=True)
+            applied = set(lock_conn.execute(select(_schema_migrations_t.c.version)).scalars())
+            for version, name, fn, concurrent in _MIGRATIONS:
+                if version in applied or (target is not None and version > target):
+                    continue
+                log(f"Migración {version:03d} {name} ...")
+                if concurrent:
+                    fn(lock_conn)
+                    lock_conn.execute(_schema_migrations_t.insert().values(version=version, name=name))
+                else:
+                    with engine.begin() as conn:
+                        fn(conn)
+                        conn.execute(_schema_migrations_t.insert().values(version=version, name=name))
+                done.append(version)
+                _PENDING_MIGRATIONS.discard(name)
+            if _IS_PG and _prompts_partitioned(lock_conn):
+                _ensure_prompt_partitions(lock_conn, PROMPTS_PARTITION_MONTHS_AHEAD, log=log)
+        finally:
+            if _IS_PG:
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _MIGRATION_LOCK_KEY})
+    return done
+
+# Migraciones que faltaban al crear la app (check_schema); run_migrations las va quitando
+_PENDING_MIGRATIONS: set[str] = set()
+
+def _schema_ready(*names: str) -> bool:
+    return not _PENDING_MIGRATIONS.intersection(names)
+
+def check_schema(log=print) -> list[str] | None:
+    """
+    Compara schema_migrations con _MIGRATIONS. Una BD vacía (primer arranque, sin tablas) se migra acá mismo.
+    Si en una BD existente faltan migraciones lo avisa y, en vez de responder 500, apaga lo que depende
+    de ellas: el log de eventos (events_log) y la fuente rollup de stats, el compactador y /timeseries
+    (analytics_rollups/analytics_sketches). None si la BD no responde (no apaga nada; se reintenta).
+    """
+    try:
+        with engine.connect() as conn:
+            has_table = engine.dialect.has_table(conn, _schema_migrations_t.name)
+            applied = set(conn.execute(select(_schema_migrations_t.c.name)).scalars()) if has_table else set()
+            empty = not has_table and not engine.dialect.has_table(conn, User.__tablename__)
+        if empty:
+            log("BD sin tablas: aplicando migraciones (primer arranque)")
+            run_migrations(log=log)
+            applied = {name for _, name, _, _ in _MIGRATIONS}
     except Exception as e:
-        print("DB init error:", e)
+        log(f"⚠️ No se pudo verificar el esquema: {e}")
+        return None
+    pending = [name for _, name, _, _ in _MIGRATIONS if name not in applied]
+    _PENDING_MIGRATIONS.clear()
+    _PENDING_MIGRATIONS.update(pending)
+    if pending:
+        log(f"⚠️ Migraciones pendientes: {', '.join(pending)}. Corre `flask --app app db-upgrade` "
+            "(o AUTO_CREATE_TABLES=true). Mientras tanto: "
+            f"log de eventos {'apagado' if not _schema_ready('events_log') else 'activo'}, "
+            f"stats {'en vivo' if not _schema_ready('analytics_rollups', 'analytics_sketches') else 'desde rollups'}.")
+    return pending
+
+_schema_checked = threading.Event()
+_schema_check_lock = threading.Lock()
+
+def _ensure_schema_checked():
+    """check_schema() una vez por proceso, en el primer request (importar el módulo no toca la BD)."""
+    if _schema_checked.is_set():
+        return
+    with _schema_check_lock:
+        if not _schema_checked.is_set() and check_schema() is not None:
+            _schema_checked.set()
+
+# --- Particionado por mes de `prompts` (solo Postgres, opcional) ---
+# `sessions` no se particiona: users -> sessions <- session_metrics/prompts usan sessions.id como FK,
+# y en Postgres toda PK/UNIQUE de una tabla particionada debe incluir la llave de partición.
+PROMPTS_PARTITION_MONTHS_AHEAD = int(os.getenv("PROMPTS_PARTITION_MONTHS_AHEAD", "3"))
+
+def _month_start(d: datetime, offset: int = 0) -> datetime:
+    m = d.year * 12 + (d.month - 1) + offset
+    return datetime(m // 12, m % 12 + 1, 1)
+
+def _prompts_partitioned(conn) -> bool:
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'prompts'")).first() is not None
+
+def _ensure_prompt_partitions(conn, months_ahead: int, start: datetime | None = None, log=print):
+    """Crea las particiones mensuales prompts_pYYYYMM desde `start` (o el mes actual) hasta months_ahead."""
+    first = _month_start(start or datetime.utcnow())
+    last = _month_start(datetime.utcnow(), months_ahead)
+    m = first
+    while m <= last:
+        nxt = _month_start(m, 1)
+        name = f"prompts_p{m:%Y%m}"
+        try:
+            conn.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF prompts "
+                f"FOR VALUES FROM ('{m:%Y-%m-%d}') TO ('{nxt:%Y-%m-%d}')")
+        except Exception as e:  # p. ej. filas de ese mes ya en la partición default
+            log(f"No se pudo crear {name}: {e}")
+        m = nxt
+
+def partition_prompts(months_ahead: int = PROMPTS_PARTITION_MONTHS_AHEAD, log=print):
+    """
+    Convierte `prompts` en tabla particionada por mes de created_at (copia dentro de una transacción
+    con la tabla bloqueada). La tabla original queda como prompts_unpartitioned para borrarla a mano.
+    """
+    if not _IS_PG:
+        raise RuntimeError("El particionado solo está disponible en PostgreSQL.")
+    with engine.begin() as conn:
+        if _prompts_partitioned(conn):
+            log("prompts ya está particionada.")
+        else:
+            conn.exec_driver_sql("LOCK TABLE prompts IN ACCESS EXCLUSIVE MODE")
+            oldest = conn.execute(text("SELECT MIN(created_at) FROM prompts")).scalar()
+            conn.exec_driver_sql(
+                "CREATE TABLE prompts_partitioned ("
+                " id UUID NOT NULL,"
+                " session_id UUID NOT NULL REFERENCES sessions(id),"
+                " prompt_initial_json JSONB NOT NULL,"
+                " created_at TIMESTAMP NOT NULL DEFAULT now(),"
+                " PRIMARY KEY (id, created_at)"
+                ") PARTITION BY RANGE (created_at)")
+            conn.exec_driver_sql("CREATE TABLE prompts_default PARTITION OF prompts_partitioned DEFAULT")
+            conn.exec_driver_sql("ALTER TABLE prompts RENAME TO prompts_unpartitioned")
+            conn.exec_driver_sql("ALTER TABLE prompts_partitioned RENAME TO prompts")
+            _ensure_prompt_partitions(conn, months_ahead, start=oldest, log=log)
+            conn.exec_driver_sql(
+                "INSERT INTO prompts (id, session_id, prompt_initial_json, created_at) "
+                "SELECT id, session_id, prompt_initial_json, COALESCE(created_at, now()) FROM prompts_unpartitioned")
+            for idx in ("ix_prompts_session_created", "ix_prompts_created"):
+                conn.exec_driver_sql(f"ALTER INDEX IF EXISTS {idx} RENAME TO {idx}_unpartitioned")
+            conn.exec_driver_sql("CREATE INDEX ix_prompts_session_created ON prompts (session_id, created_at)")
+            conn.exec_driver_sql("CREATE INDEX ix_prompts_created ON prompts (created_at)")
+            log("prompts particionada por mes ✅ (la tabla original quedó como prompts_unpartitioned)")
+        _ensure_prompt_partitions(conn, months_ahead, log=log)
+
+@bp.cli.command("db-upgrade")
+@click.option("--target", type=int, default=None, help="Aplica hasta esta versión.")
+def db_upgrade_command(target):
+    """Aplica las migraciones pendientes (una vez por deploy)."""
+    done = run_migrations(target, log=click.echo)
+    click.echo(f"Migraciones aplicadas: {done or 'ninguna (al día)'}")
+
+@bp.cli.command("db-status")
+def db_status_command():
+    """Lista las migraciones y si ya están aplicadas."""
+    applied = applied_migrations()
+    for version, name, _, _ in _MIGRATIONS:
+        click.echo(f"{'✔' if version in applied else ' '} {version:03d} {name}")
+
+@bp.cli.command("db-partition-prompts")
+@click.option("--months-ahead", type=int, default=PROMPTS_PARTITION_MONTHS_AHEAD, show_default=True)
+def db_partition_prompts_command(months_ahead):
+    """Particiona `prompts` por mes (Postgres). db-upgrade mantiene creadas las particiones futuras."""
+    partition_prompts(months_ahead, log=click.echo)
 
 # =========================
-#   GeoIP (Opción B con API pública)
+#   Rollups de analítica (hora / día, por país)
+# =========================
+# La compactación recalcula solo los buckets de las sesiones iniciadas dentro de la ventana
+# ROLLUP_LOOKBACK_H (sus métricas aún cambian con heartbeats/clics): borra esos buckets y los
+# reinserta con un INSERT ... SELECT. Las horas anteriores no se tocan, así que el costo depende
+# del tráfico reciente y no del historial. Los días se rearman sumando sus horas.
+ROLLUP_COMPACT_INTERVAL_S = float(os.getenv("ROLLUP_COMPACT_INTERVAL_S", "60"))
+ROLLUP_LOOKBACK_H = int(os.getenv("ROLLUP_LOOKBACK_H", "48"))
+_ROLLUP_LOCK_KEY = 72_410_002
+_ROLLUP_AGG_COLS = ("sessions", "time_on_page_ms", "first_prompt_ms", "first_prompt_sessions",
+                    "improved_sessions", "copied_sessions", "prompts")
+
+def _trunc_sql(col: str, unit: str) -> str:
+    """Inicio de la hora/día de `col` en SQL del dialecto (en SQLite, con el formato que usa SQLAlchemy)."""
+    if _IS_PG:
+        return f"date_trunc('{unit}', {col})"
+    fmt = "%Y-%m-%d %H:00:00.000000" if unit == "hour" else "%Y-%m-%d 00:00:00.000000"
+    return f"strftime('{fmt}', {col})"
+
+def _floor_hour(d: datetime) -> datetime:
+    return d.replace(minute=0, second=0, microsecond=0)
+
+def _started_since(d: datetime):
+    """
+    Bind `since` para comparar con sessions.started_at. En SQLite va como texto sin fracción:
+    '... 13:00:00' es <= tanto '... 13:00:00' como '... 13:00:00.000000', así cuentan también
+    las filas guardadas con precisión de segundos.
+    """
+    if _IS_PG:
+        return bindparam("since", d, type_=DateTime)
+    return bindparam("since", d.strftime("%Y-%m-%d %H:%M:%S"), type_=String)
+
+def compact_rollups(conn, since: datetime | None = None, sketches: bool = True) -> dict:
+    """
+    Recalcula rollups horarios desde `since` (None = todo) y los diarios de los días afectados
+    (y, con `sketches`, los cuantiles de esas mismas horas/días).
+    Corre dentro de la transacción de `conn`. Devuelve cuántas filas quedaron en cada tabla.
+    """
+    since_h = _floor_hour(since) if since else datetime(1970, 1, 1)
+    since_d = since_h.replace(hour=0)
+    cols = ", ".join(_ROLLUP_AGG_COLS)
+    params = lambda sql, **kw: text(sql).bindparams(
+        *(bindparam(k, v, type_=DateTime) for k, v in kw.items()))
+
+    conn.execute(params("DELETE FROM analytics_rollup_hourly WHERE bucket_start >= :since", since=since_h))
+    hourly = conn.execute(text(f"""
+        INSERT INTO analytics_rollup_hourly (bucket_start, country, {cols})
+        SELECT {_trunc_sql('s.started_at', 'hour')}, COALESCE(s.country, ''),
+               COUNT(*),
+               COALESCE(SUM(sm.time_on_page_ms), 0),
+               COALESCE(SUM(CASE WHEN sm.time_to_first_prompt_ms > 0 THEN sm.time_to_first_prompt_ms ELSE 0 END), 0),
+               SUM(CASE WHEN sm.time_to_first_prompt_ms > 0 THEN 1 ELSE 0 END),
+               SUM(CASE WHEN sm.improve_clicks_count > 0 THEN 1 ELSE 0 END),
+               SUM(CASE WHEN sm.clipboard_copy_count > 0 THEN 1 ELSE 0 END),
+               COALESCE(SUM(sm.prompts_initial_count), 0)
+        FROM sessions s LEFT JOIN session_metrics sm ON sm.session_id = s.id
+        WHERE s.started_at >= :since
+        GROUP BY 1, 2
+    """).bindparams(_started_since(since_h))).rowcount
+
+    conn.execute(params("DELETE FROM analytics_rollup_daily WHERE bucket_start >= :since", since=since_d))
+    daily = conn.execute(params(f"""
+        INSERT INTO analytics_rollup_daily (bucket_start, country, {cols})
+        SELECT {_trunc_sql('bucket_start', 'day')}, country, {", ".join(f"SUM({c})" for c in _ROLLUP_AGG_COLS)}
+        FROM analytics_rollup_hourly
+        WHERE bucket_start >= :since
+        GROUP BY 1, 2
+    """, since=since_d)).rowcount
+    out = {"hourly_rows": hourly, "daily_rows": daily}
+    if sketches:
+        out.update(compact_sketches(conn, since_h))
+    return out
+
+# --- Cuantiles (p50/p90/p99) de tiempo en página y tiempo al primer prompt ---
+# DDSketch: cubetas logarítmicas de razón gamma = (1+a)/(1-a), error relativo <= a en cualquier cuantil.
+# Dos sketches se fusionan sumando conteos por cubeta, así que las horas se rearman en días y cualquier
+# rango/país se responde fusionando filas guardadas: costo O(filas × tamaño del sketch), no O(sesiones).
+# Se recalculan en la compactación (misma ventana caliente que los rollups): el valor de cada sesión es
+# un acumulado que cambia con cada heartbeat, y un sketch alimentado evento a evento mediría los deltas.
+SKETCH_RELATIVE_ACCURACY = float(os.getenv("SKETCH_RELATIVE_ACCURACY", "0.01"))
+_SKETCH_METRICS = {"time_on_page_ms": True, "time_to_first_prompt_ms": False}  # ¿cuentan los ceros?
+_SKETCH_QUANTILES = (0.5, 0.9, 0.99)
+
+class _DDSketch:
+    def __init__(self, alpha: float = SKETCH_RELATIVE_ACCURACY):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.bins = {}   # índice de cubeta -> conteo
+        self.zeros = 0
+
+    @property
+    def count(self) -> int:
+        return self.zeros + sum(self.bins.values())
+
+    def add(self, values) -> "_DDSketch":
+        import numpy as np
+        v = np.asarray(values, dtype=np.float64)
+        pos = v[v > 0]
+        self.zeros += int(len(v) - len(pos))
+        if len(pos):
+            keys, counts = np.unique(np.ceil(np.log(pos) / np.log(self.gamma)).astype(np.int64), return_counts=True)
+            for k, c in zip(keys.tolist(), counts.tolist()):
+                self.bins[k] = self.bins.get(k, 0) + c
+        return self
+
+    def merge(self, other: "_DDSketch") -> "_DDSketch":
+        if other.alpha != self.alpha:
+            raise ValueError("no se pueden fusionar sketches con distinta precisión")
+        self.zeros += other.zeros
+        for k, c in other.bins.items():
+            self.bins[k] = self.bins.get(k, 0) + c
+        return self
+
+    def quantile(self, q: float):
+        n = self.count
+        if not n:
+            return None
+        rank = q * (n - 1)
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for k in sorted(self.bins):
+            seen += self.bins[k]
+            if seen > rank:
+                return 2 * self.gamma ** k / (self.gamma + 1)  # punto medio (relativo) de la cubeta
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_json(self) -> str:
+        return json.dumps({"a": self.alpha, "z": self.zeros, "b": {str(k): c for k, c in sorted(self.bins.items())}},
+                          separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, raw: str) -> "_DDSketch":
+        d = json.loads(raw)
+        sk = cls(d["a"])
+        sk.zeros = int(d["z"])
+        sk.bins = {int(k): int(c) for k, c in d["b"].items()}
+        return sk
+
+def compact_sketches(conn, since: datetime | None = None) -> dict:
+    """Sketches horarios desde `since` (a partir de las sesiones) y diarios de los días afectados (fusionando horas)."""
+    import pandas as pd  # perezoso: solo la compactación y el snapshot lo usan
+    since_h = _floor_hour(since) if since else datetime(1970, 1, 1)
+    since_d = since_h.replace(hour=0)
+    s, m = Session.__table__, SessionMetrics.__table__
+    hourly_t, daily_t = SketchHourly.__table__, SketchDaily.__table__
+
+    df = pd.DataFrame(conn.execute(
+        select(s.c.started_at, s.c.country, *(m.c[c] for c in _SKETCH_METRICS))
+        .select_from(s.outerjoin(m, m.c.session_id == s.c.id))
+        .where(s.c.started_at >= _started_since(since_h))
+    ).all(), columns=["started_at", "country", *_SKETCH_METRICS])
+    hourly = []
+    if len(df):
+        df["bucket_start"] = pd.to_datetime(df["started_at"]).dt.floor("h")
+        df["country"] = df["country"].fillna("")
+        for metric, with_zeros in _SKETCH_METRICS.items():
+            df[metric] = df[metric].fillna(0)
+            sub = df if with_zeros else df[df[metric] > 0]
+            for (bucket, country), values in sub.groupby(["bucket_start", "country"])[metric]:
+                sk = _DDSketch().add(values.to_numpy())
+                hourly.append({"bucket_start": bucket.to_pydatetime(), "country": country, "metric": metric,
+                               "count": sk.count, "sketch": sk.to_json()})
+    conn.execute(hourly_t.delete().where(hourly_t.c.bucket_start >= since_h))
+    if hourly:
+        conn.execute(hourly_t.insert(), hourly)
+
+    days = {}
+    for r in conn.execute(select(hourly_t.c.bucket_start, hourly_t.c.country, hourly_t.c.metric, hourly_t.c.sketch)
+                          .where(hourly_t.c.bucket_start >= since_d)):
+        key = (r.bucket_start.replace(hour=0), r.country, r.metric)
+        sk = _DDSketch.from_json(r.sketch)
+        days[key] = days[key].merge(sk) if key in days else sk
+    conn.execute(daily_t.delete().where(daily_t.c.bucket_start >= since_d))
+    if days:
+        conn.execute(daily_t.insert(), [{"bucket_start": b, "country": c, "metric": metric,
+                                         "count": sk.count, "sketch": sk.to_json()}
+                                        for (b, c, metric), sk in days.items()])
+    return {"sketch_hourly_rows": len(hourly), "sketch_daily_rows": len(days)}
+
+def _sketch_quantiles(sk: "_DDSketch | None") -> dict:
+    """p50/p90/p99 en segundos (None si no hay datos)."""
+    return {f"p{int(q * 100)}": (None if sk is None or not sk.count else round(sk.quantile(q) / 1000.0, 3))
+            for q in _SKETCH_QUANTILES}
+
+def merged_sketches(db, table, where=(), by=()) -> dict:
+    """(claves de `by`..., métrica) -> DDSketch fusionado de las filas que cumplen `where`."""
+    q = select(*(table.c[k] for k in by), table.c.metric, table.c.sketch).where(*where)
+    out = {}
+    for r in db.execute(q):
+        key = tuple(r[:-1])
+        sk = _DDSketch.from_json(r[-1])
+        out[key] = out[key].merge(sk) if key in out else sk
+    return out
+
+def _sqlite_lock_path(name: str) -> str | None:
+    """Archivo de lock junto a la BD SQLite (None en memoria o en Postgres)."""
+    db = engine.url.database
+    return f"{db}.{name}.lock" if not _IS_PG and db and db != ":memory:" else None
+
+@contextmanager
+def _try_file_lock(path: str):
+    """Lock exclusivo no bloqueante entre procesos: entrega el archivo abierto, o None si otro lo tiene."""
+    f = open(path, "a+", encoding="utf-8")
+    try:
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield None
+            return
+        yield f
+    finally:
+        f.close()  # cerrar libera el lock
+
+class _RollupCompactor:
+    """
+    Hilo perezoso que compacta la ventana reciente cada ROLLUP_COMPACT_INTERVAL_S. Arranca en cada worker,
+    pero compacta uno por intervalo: en Postgres con un advisory lock; en SQLite con un lock de archivo
+    junto a la BD que además guarda la hora de la última pasada (los demás workers la saltan).
+    """
+
+    def __init__(self, interval: float, lookback_h: int):
+        self.interval = interval
+        self.lookback_h = lookback_h
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {"runs": 0, "skipped": 0, "errors": 0, "last_run_at": None,
+                      "last_ms": None, "last_error": None}
+
+    def ensure_started(self):
+        if self.interval <= 0 or not _schema_ready("analytics_rollups", "analytics_sketches"):
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="rollup-compactor", daemon=True)
+                self._thread.start()
+
+    def run_once(self, since: datetime | None = None) -> dict | None:
+        """
+        Compacta desde `since` (por defecto, ahora - lookback). None si otro proceso ya está compactando
+        o, en la pasada periódica sobre SQLite, si otro worker ya compactó en este intervalo.
+        """
+        periodic = since is None
+        since = since or (datetime.utcnow() - timedelta(hours=self.lookback_h))
+        path = _sqlite_lock_path("rollups")
+        if path is None:
+            return self._compact(since)
+        with _try_file_lock(path) as f:
+            if f is not None:
+                f.seek(0)
+                try:
+                    last = float(f.read().strip() or 0)
+                except ValueError:
+                    last = 0.0
+            if f is None or (periodic and time.time() - last < self.interval * 0.9):
+                self.stats["skipped"] += 1
+                if f is not None and last:  # compactó otro worker: esa es la hora vigente de los rollups
+                    self.stats["last_run_at"] = datetime.utcfromtimestamp(last).isoformat() + "Z"
+                return None
+            out = self._compact(since)
+            f.seek(0)
+            f.truncate()
+            f.write(str(time.time()))
+            f.flush()
+            return out
+
+    def _compact(self, since: datetime) -> dict | None:
+        t0 = time.monotonic()
+        try:
+            with engine.begin() as conn:
+                if _IS_PG and not conn.execute(text("SELECT pg_try_advisory_xact_lock(:k)"),
+                                               {"k": _ROLLUP_LOCK_KEY}).scalar():
+                    self.stats["skipped"] += 1
+                    return None
+                out = compact_rollups(conn, since)
+        except Exception as e:
+            self.stats["errors"] += 1
+            self.stats["last_error"] = str(e)[:200]
+            raise
+        self.stats["runs"] += 1
+        self.stats["last_run_at"] = datetime.utcnow().isoformat() + "Z"
+        self.stats["last_ms"] = round((time.monotonic() - t0) * 1000, 1)
+        return out
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                print("rollup compaction error:", e)
+
+    def snapshot(self) -> dict:
+        return {"interval_s": self.interval, "lookback_h": self.lookback_h, **self.stats}
+
+_rollups = _RollupCompactor(ROLLUP_COMPACT_INTERVAL_S, ROLLUP_LOOKBACK_H)
+
+@bp.cli.command("analytics-compact")
+@click.option("--hours", type=int, default=None, help="Ventana a recalcular (por defecto ROLLUP_LOOKBACK_H).")
+@click.option("--full", is_flag=True, help="Recalcula todo el historial.")
+def analytics_compact_command(hours, full):
+    """Recalcula los rollups horarios/diarios de analítica."""
+    if full:
+        with engine.begin() as conn:
+            out = compact_rollups(conn, since=None)
+    else:
+        out = _rollups.run_once(datetime.utcnow() - timedelta(hours=hours or ROLLUP_LOOKBACK_H))
+    click.echo(json.dumps(out) if out is not None else "Otra compactación está en curso; nada que hacer.")
+
+# --- Esquema: se migra con `flask --app app db-upgrade` (una vez por deploy) o con `python app.py`.
+# AUTO_CREATE_TABLES=true lo hace además en create_app() (comportamiento anterior, por worker).
+AUTO_CREATE_TABLES = os.getenv("AUTO_CREATE_TABLES", "false").lower() == "true"
+
+# =========================
+#   GeoIP: resolvers (ip-api.com / archivo local) + caché LRU + modo diferido
 # =========================
 GEO_TIMEOUT = float(os.getenv("GEO_TIMEOUT", "2.0"))
 BOOTCAMP_MODE = os.getenv("BOOTCAMP_MODE", "0") == "1"
+GEO_PROVIDER = os.getenv("GEO_PROVIDER", "ipapi").strip().lower()   # ipapi | file | none
+GEO_DB_PATH = os.getenv("GEO_DB_PATH", "")                           # CSV: start_ip,end_ip,country,city
+# Diferido: inserta NULL y completa en segundo plano. Por defecto sí con ipapi (red, fuera de la transacción
+# de ingesta); con el CSV local la consulta es en memoria y se hace en línea.
+GEO_DEFERRED = os.getenv("GEO_DEFERRED", "1" if GEO_PROVIDER == "ipapi" else "0") == "1"
+GEO_CACHE_SIZE = int(os.getenv("GEO_CACHE_SIZE", "4096"))
+GEO_CACHE_TTL_S = float(os.getenv("GEO_CACHE_TTL_S", "86400"))
+
+_NO_GEO = {"country": None, "city": None}
+
+def _client_ip() -> str:
+    """IP del cliente (primer salto de X-Forwarded-For si viene de proxy)."""
+    return (request.headers.get("X-Forwarded-For", request.remote_addr) or "").split(",")[0].strip()
+
+def _public_ip(ip: str):
+    """ip_address si la IP es pública; None si es inválida, local o privada."""
+    try:
+        addr = ipaddress.ip_address((ip or "").strip())
+    except ValueError:
+        return None
+    if addr.is_private or addr.is_loopback or addr.is_link_local or addr.is_unspecified:
+        return None
+    return addr
+
+def _geo_cache_key(addr) -> str:
+    # Las IPs de un mismo /24 (v4) o /48 (v6) casi siempre caen en la misma ciudad
+    prefix = 24 if addr.version == 4 else 48
+    return str(ipaddress.ip_network(f"{addr}/{prefix}", strict=False))
 
-def resolve_geo_from_request():
-    """Resuelve país/ciudad desde la IP del request usando ip-api.com."""
-    if BOOTCAMP_MODE:
-        # Demo estable para el bootcamp
-        return {"country": "Guatemala", "city": "Ciudad de Guatemala"}
 
-    ip = (request.headers.get("X-Forwarded-For", request.remote_addr) or "").split(",")[0].strip()
-    if not ip or ip.startswith("127.") or ip in ("localhost", "::1"):
-        return {"country": None, "city": None}
+class _IpRangeDB:
+    """
+    Base local de rangos IP cargada desde CSV (start_ip,end_ip,country,city; IPs en texto o enteros).
+    Se guarda en arreglos ordenados por versión y se consulta con búsqueda binaria.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tables = None   # {4: (starts, ends, labels), 6: (...)}
+
+    @staticmethod
+    def _to_int(v: str) -> tuple[int, int]:
+        v = v.strip()
+        if v.isdigit():
+            n = int(v)
+            return (4 if n < 2**32 else 6), n
+        a = ipaddress.ip_address(v)
+        return a.version, int(a)
+
+    def _load(self):
+        rows = {4: [], 6: []}
+        with open(self.path, newline="", encoding="utf-8") as f:
+            for rec in csv.reader(f):
+                if len(rec) < 3 or rec[0].startswith("#"):
+                    continue
+                try:
+                    ver, start = self._to_int(rec[0])
+                    _, end = self._to_int(rec[1])
+                except ValueError:
+                    continue  # cabecera u otra línea no válida
+                rows[ver].append((start, end, (rec[2] or None, (rec[3] if len(rec) > 3 else "") or None)))
+        tables = {}
+        for ver, items in rows.items():
+            items.sort(key=lambda r: r[0])
+            tables[ver] = ([r[0] for r in items], [r[1] for r in items], [r[2] for r in items])
+        print(f"GeoIP DB cargada: {len(rows[4])} rangos v4, {len(rows[6])} rangos v6")
+        return tables
+
+    def lookup(self, addr):
+        if self._tables is None:
+            with self._lock:
+                if self._tables is None:
+                    self._tables = self._load()
+        starts, ends, labels = self._tables[addr.version]
+        n = int(addr)
+        i = bisect.bisect_right(starts, n) - 1
+        if i >= 0 and n <= ends[i]:
+            country, city = labels[i]
+            return {"country": country, "city": city}
+        return dict(_NO_GEO)
+
+
+def _geo_ipapi(addr):
+    """ip-api.com. Devuelve None si la consulta falló (para no cachear el error)."""
     try:
-        r = requests.get(f"http://ip-api.com/json/{ip}?fields=status,country,city",
+        r = requests.get(f"http://ip-api.com/json/{addr}?fields=status,country,city",
                          timeout=GEO_TIMEOUT)
         j = r.json()
         if j.get("status") == "success":
             return {"country": j.get("country"), "city": j.get("city")}
+        return dict(_NO_GEO)
     except Exception:
-        pass
-    return {"country": None, "city": None}
+        return None
+
+_geo_file_db = _IpRangeDB(GEO_DB_PATH) if GEO_DB_PATH else None
+
+_GEO_RESOLVERS = {
+    "ipapi": _geo_ipapi,
+    "file": (lambda addr: _geo_file_db.lookup(addr) if _geo_file_db else dict(_NO_GEO)),
+    "none": (lambda addr: dict(_NO_GEO)),
+}
+
+_geo_cache = _TTLCache(maxsize=GEO_CACHE_SIZE, ttl=GEO_CACHE_TTL_S)
+
+def resolve_geo_from_request():
+    """Resuelve país/ciudad desde la IP del request con el resolver configurado (GEO_PROVIDER)."""
+    return resolve_geo_for_ip(_client_ip())
+
+def resolve_geo_for_ip(ip: str):
+    """Igual que resolve_geo_from_request pero sin depender del request (útil en hilos de fondo)."""
+    if BOOTCAMP_MODE:
+        # Demo estable para el bootcamp
+        return {"country": "Guatemala", "city": "Ciudad de Guatemala"}
+
+    addr = _public_ip(ip)
+    if addr is None:
+        return dict(_NO_GEO)
+    key = _geo_cache_key(addr)
+    hit = _geo_cache.get(key)
+    if hit is not None:
+        return dict(hit)
+    geo = _GEO_RESOLVERS.get(GEO_PROVIDER, _GEO_RESOLVERS["none"])(addr)
+    if geo is None:
+        return dict(_NO_GEO)
+    _geo_cache.set(key, geo)
+    return dict(geo)
+
+def peek_geo_for_ip(ip: str):
+    """Solo caché/demo, sin red. None si habría que consultar al resolver."""
+    if BOOTCAMP_MODE:
+        return resolve_geo_for_ip(ip)
+    addr = _public_ip(ip)
+    if addr is None:
+        return dict(_NO_GEO)
+    hit = _geo_cache.get(_geo_cache_key(addr))
+    return dict(hit) if hit is not None else None
 
 
+class _GeoBackfill:
+    """
+    Modo diferido: las sesiones se insertan con country/city NULL y este hilo
+    resuelve la IP después y hace el UPDATE por lotes. Si la sesión aún no está
+    confirmada (UPDATE sin filas), reintenta unas pocas veces.
+    """
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, maxsize: int = 10000, batch: int = 100, interval_s: float = 1.0):
+        self._q = queue.Queue(maxsize=maxsize)
+        self._batch = batch
+        self._interval = interval_s
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {"queued": 0, "dropped": 0, "updated": 0, "gave_up": 0}
+
+    def submit(self, session_id, ip: str):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="geo-backfill", daemon=True)
+                    self._thread.start()
+        try:
+            self._q.put_nowait((session_id, ip, 0))
+            self.stats["queued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            items = []
+            while len(items) < self._batch:
+                try:
+                    items.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            if items:
+                try:
+                    self._apply(items)
+                except Exception as e:
+                    print("geo backfill error:", e)
+
+    def _apply(self, items):
+        resolved = [(sid, ip, n, resolve_geo_for_ip(ip)) for sid, ip, n in items]
+        with engine.begin() as conn:
+            for sid, ip, n, geo in resolved:
+                if not geo.get("country"):
+                    continue
+                stmt = (update(Session)
+                        .where(Session.id == sid, Session.country.is_(None))
+                        .values(country=geo["country"], city=geo.get("city")))
+                rc = conn.execute(stmt).rowcount
+                if rc:
+                    self.stats["updated"] += 1
+                elif n + 1 < self.MAX_ATTEMPTS:
+                    try:
+                        self._q.put_nowait((sid, ip, n + 1))   # quizá aún no hizo commit
+                    except queue.Full:
+                        self.stats["dropped"] += 1
+                else:
+                    self.stats["gave_up"] += 1
+
+_geo_backfill = _GeoBackfill()
+
+def geo_for_new_session(ip: str, session_id):
+    """Geo para una sesión nueva respetando GEO_DEFERRED (en diferido nunca bloquea)."""
+    if not GEO_DEFERRED:
+        return resolve_geo_for_ip(ip)
+    geo = peek_geo_for_ip(ip)
+    if geo is not None:
+        return geo
+    _geo_backfill.submit(session_id, ip)
+    return dict(_NO_GEO)
+
 
 # =========================
 #   1) Preguntas iniciales
@@ -320,8 +1648,8 @@ INITIAL_QUESTIONS = [
 ]
 
 # --- /questions y /api/questions ---
-@app.get("/questions")
-@app.get("/api/questions")
+@bp.get("/questions")
+@bp.get("/api/questions")
 def questions():
     return jsonify(questions=INITIAL_QUESTIONS)
 
@@ -387,100 +1715,464 @@ _LLM_COHERENCE_SYSTEM_CONTEXT = (
     "'incoherente' si es claramente off-topic o contradictorio. No des explicaciones."
 )
 
-def _gemini_one_word(system_msg: str, user_msg: str) -> str:
+# Caché de veredictos: respuestas repetidas (o criterios comunes) no vuelven a llamar al LLM
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "4096"))
+VERDICT_CACHE_TTL_S = float(os.getenv("VERDICT_CACHE_TTL_S", "21600"))
+_verdict_cache = _TTLCache(maxsize=VERDICT_CACHE_SIZE, ttl=VERDICT_CACHE_TTL_S)
+
+_VALIDATOR_SAFETY = [
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUAL", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+# Los flujos LLM se parten en *_prepare (caché, modelo) y *_finish (interpretar, cachear): el camino sync
+# de app.py y el async de asgi.py solo difieren en cómo hacen la llamada (generate_content[_async]).
+def _one_word_prepare(system_msg: str, user_msg: str, cache_parts: tuple | None = None):
+    """(veredicto ya resuelto o None, modelo, llave de caché)."""
     if not _HAS_GENAI:
-        return "coherente"
-    llm = genai.GenerativeModel(
-        model_name=os.getenv("GEMINI_VALIDATOR_MODEL", "gemini-1.5-flash"),
+        return "coherente", None, None
+    model_name = os.getenv("GEMINI_VALIDATOR_MODEL", "gemini-1.5-flash")
+    key = _hash_key(system_msg, model_name, *(cache_parts if cache_parts is not None else (user_msg,)))
+    cached = _verdict_cache.get(key)
+    if cached is not None:
+        return cached, None, key
+    llm = get_gemini_model(
+        model_name,
         system_instruction=system_msg,
         generation_config={"temperature": 0.2, "max_output_tokens": 8},
-        safety_settings=[
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUAL", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ],
+        safety_settings=_VALIDATOR_SAFETY,
     )
-    resp = llm.generate_content(user_msg)
-    text = _extract_text_from_candidates(resp)
-    return _as_verdict_one_word(text)
+    return None, llm, key
 
-def _validate_step_core(qid: str, answer: str, history: dict):
-    # 1) Reglas mínimas (rápidas). Si falla, 200 con mensaje amable + sugerencias.
+def _one_word_finish(resp, key: str) -> str:
+    verdict = _as_verdict_one_word(_extract_text_from_candidates(resp))
+    if verdict:  # no cacheamos respuestas vacías/ilegibles
+        _verdict_cache.set(key, verdict)
+    return verdict
+
+def _gemini_one_word(system_msg: str, user_msg: str, cache_parts: tuple | None = None) -> str:
+    """
+    Veredicto 'coherente'/'incoherente' de Gemini.
+    cache_parts: partes que identifican la pregunta (p. ej. objetivo y respuesta);
+    si no se pasan, la llave de caché usa el mensaje completo.
+    """
+    verdict, llm, key = _one_word_prepare(system_msg, user_msg, cache_parts)
+    if llm is None:
+        return verdict
+    return _one_word_finish(llm.generate_content(user_msg), key)
+
+# --- Criterios: dos clasificadores (drift + coherencia). El modo se elige por config ---
+#   sequential: uno tras otro (comportamiento original)
+#   concurrent: ambos en paralelo; corta en el primer "incoherente"
+#   combined:   una sola llamada que devuelve ambos veredictos en JSON
+CRITERIA_VALIDATION_MODE = os.getenv("CRITERIA_VALIDATION_MODE", "sequential").strip().lower()
+LLM_POOL_WORKERS = int(os.getenv("LLM_POOL_WORKERS", "16"))
+
+_LLM_COMBINED_SYSTEM_CRITERIA = (
+    "Eres un clasificador en ESPAÑOL. Evalúa la RESPUESTA con dos criterios y responde SOLO con JSON "
+    '{"criterios": "coherente|incoherente", "coherencia": "coherente|incoherente"}.\n'
+    "- criterios: 'coherente' si la RESPUESTA enumera criterios de calidad, requisitos o condiciones "
+    "aplicables al OBJETIVO (p. ej., claridad, ejemplos prácticos, precisión, español neutro, pasos "
+    "accionables), aunque sean genéricos; 'incoherente' si propone un nuevo objetivo/tema o no expresa "
+    "criterios verificables.\n"
+    "- coherencia: 'coherente' si esos criterios no contradicen el objetivo ni el historial; acepta "
+    "singular/plural y ortografía aproximada; 'incoherente' si cambian de tema o contradicen el objetivo.\n"
+    "No des explicaciones."
+)
+
+_llm_pool_inst = None
+_llm_pool_lock = threading.Lock()
+
+def _llm_pool() -> ThreadPoolExecutor:
+    """Pool de hilos compartido para llamadas LLM en paralelo (se crea en el worker, no al importar)."""
+    global _llm_pool_inst
+    if _llm_pool_inst is None:
+        with _llm_pool_lock:
+            if _llm_pool_inst is None:
+                _llm_pool_inst = ThreadPoolExecutor(max_workers=LLM_POOL_WORKERS, thread_name_prefix="llm")
+    return _llm_pool_inst
+
+_criteria_timings = {}
+_criteria_timings_lock = threading.Lock()
+
+def _record_criteria_timing(mode: str, ms: float):
+    with _criteria_timings_lock:
+        t = _criteria_timings.setdefault(mode, {"n": 0, "total_ms": 0.0, "max_ms": 0.0})
+        t["n"] += 1
+        t["total_ms"] += ms
+        t["max_ms"] = max(t["max_ms"], ms)
+
+def criteria_timing_stats() -> dict:
+    with _criteria_timings_lock:
+        return {
+            "mode": CRITERIA_VALIDATION_MODE,
+            "timings": {m: {"n": t["n"], "avg_ms": round(t["total_ms"] / t["n"], 1), "max_ms": round(t["max_ms"], 1)}
+                        for m, t in _criteria_timings.items() if t["n"]},
+        }
+
+def _combined_prepare(objetivo: str, answer: str):
+    """(veredictos ya resueltos o None, modelo, llave de caché) para el modo combined."""
+    if not _HAS_GENAI:
+        return ("coherente", "coherente"), None, None
+    model_name = os.getenv("GEMINI_VALIDATOR_MODEL", "gemini-1.5-flash")
+    key = _hash_key(_LLM_COMBINED_SYSTEM_CRITERIA, model_name, objetivo, answer)
+    cached = _verdict_cache.get(key)
+    if cached is not None:
+        return tuple(cached), None, key
+    llm = get_gemini_model(
+        model_name,
+        system_instruction=_LLM_COMBINED_SYSTEM_CRITERIA,
+        generation_config={"temperature": 0.2, "max_output_tokens": 40,
+                           "response_mime_type": "application/json"},
+        safety_settings=_VALIDATOR_SAFETY,
+    )
+    return None, llm, key
+
+def _gemini_combined_criteria(user_msg: str, objetivo: str, answer: str):
+    """Ambos veredictos en una llamada. None si la respuesta no se pudo interpretar."""
+    verdicts, llm, key = _combined_prepare(objetivo, answer)
+    if llm is None:
+        return verdicts
+    return _combined_finish(llm.generate_content(user_msg), key)
+
+def _combined_finish(resp, key: str):
+    try:
+        j = _parse_llm_json(_extract_text_from_candidates(resp))
+    except Exception:
+        return None
+    v_a = _as_verdict_one_word(str(j.get("criterios", "")))
+    v_b = _as_verdict_one_word(str(j.get("coherencia", "")))
+    if not v_a or not v_b:
+        return None
+    _verdict_cache.set(key, (v_a, v_b))
+    return v_a, v_b
+
+def _criteria_verdicts(objetivo: str, answer: str, drift_user: str, coh_user: str):
+    """(veredicto drift, veredicto coherencia). v_b puede ser None si v_a ya decidió."""
+    mode = CRITERIA_VALIDATION_MODE
+    t0 = time.perf_counter()
+    try:
+        if mode == "combined":
+            res = _gemini_combined_criteria(coh_user, objetivo, answer)
+            if res is not None:
+                return res
+            mode = "sequential"  # JSON ilegible: caemos al modo original
+
+        if mode == "concurrent":
+            pool = _llm_pool()
+            fut_a = pool.submit(_gemini_one_word, _LLM_DRIFT_SYSTEM_CRITERIA, drift_user, (objetivo, answer))
+            fut_b = pool.submit(_gemini_one_word, _LLM_COHERENCE_SYSTEM_CRITERIA, coh_user, (objetivo, answer))
+            got = {}
+            for fut in as_completed((fut_a, fut_b)):
+                got[fut] = fut.result()
+                if got[fut] == "incoherente":
+                    break
+            for fut in (fut_a, fut_b):
+                if fut not in got:
+                    fut.cancel()  # si ya corre, su resultado simplemente se ignora
+            return got.get(fut_a), got.get(fut_b)
+
+        v_a = _gemini_one_word(_LLM_DRIFT_SYSTEM_CRITERIA, drift_user, (objetivo, answer))
+        if v_a == "incoherente":
+            return v_a, None
+        return v_a, _gemini_one_word(_LLM_COHERENCE_SYSTEM_CRITERIA, coh_user, (objetivo, answer))
+    finally:
+        _record_criteria_timing(CRITERIA_VALIDATION_MODE, (time.perf_counter() - t0) * 1000)
+
+_HINT_CRITERIA_DRIFT = ("Escribe criterios de calidad aplicables al objetivo (p. ej., claridad, "
+                        "ejemplos prácticos, español neutro, precisión, pasos accionables) e intenta de nuevo.")
+_HINT_CRITERIA_COHERENCE = ("No parece un criterio de calidad para este objetivo. Ejemplos: claridad, "
+                            "pasos accionables, ejemplos prácticos, precisión, evitar jerga, fuentes confiables.")
+_HINT_CONTEXT = "No guarda relación con el contexto. Intenta de nuevo."
+
+def _rules_failure(qid: str, answer: str, history: dict):
+    """Reglas mínimas (rápidas). Payload de error con sugerencias, o None si pasan."""
     res = validate_step_rules(qid, answer, history)
-    if not res.get("ok", False):
-        payload = {"ok": False, "hint": res.get("hint", "Respuesta inválida. Intenta de nuevo.")}
-        if qid == "tono":
-            payload["suggestions"] = sorted(ALLOWED_TONES)
-        if qid == "formato":
-            payload["suggestions"] = sorted(ALLOWED_FORMATS)
-        return payload, 200
-
-    # 2) Validación con LLM según tipo de pregunta
-    objetivo = history.get("objetivo", "")
-    question_text = _get_question_text(qid)
+    if res.get("ok", False):
+        return None
+    payload = {"ok": False, "hint": res.get("hint", "Respuesta inválida. Intenta de nuevo.")}
+    if qid == "tono":
+        payload["suggestions"] = sorted(ALLOWED_TONES)
+    if qid == "formato":
+        payload["suggestions"] = sorted(ALLOWED_FORMATS)
+    return payload
+
+def _coherence_user_msg(qid: str, objetivo: str, history: dict, answer: str) -> str:
+    return (
+        f"TIPO_PREGUNTA: {qid}\n"
+        f"OBJETIVO: {objetivo}\n"
+        f"CONTEXTO: {history}\n"
+        f"PREGUNTA: {_get_question_text(qid)}\n"
+        f"RESPUESTA: {answer}\n"
+        "Responde solo: coherente | incoherente"
+    )
 
+def _drift_user_msg(objetivo: str, answer: str) -> str:
+    return (
+        f"OBJETIVO: {objetivo}\n"
+        f"RESPUESTA: {answer}\n"
+        "Responde solo: coherente | incoherente"
+    )
+
+def _criteria_result(v_a, v_b) -> dict:
+    if v_a == "incoherente":
+        return {"ok": False, "hint": _HINT_CRITERIA_DRIFT}
+    if v_b != "coherente":
+        return {"ok": False, "hint": _HINT_CRITERIA_COHERENCE}
+    return {"ok": True, "hint": "OK"}
+
+def _context_result(v_b) -> dict:
+    if v_b != "coherente":
+        return {"ok": False, "hint": _HINT_CONTEXT}
+    return {"ok": True, "hint": "OK"}
+
+# --- Fast path local (NumPy) para contexto/criterios ---
+# Vectorizador de n-gramas de caracteres con hashing + TF-IDF y una regresión logística por pregunta,
+# entrenada con los veredictos del LLM que se registran en VERDICT_LOG_PATH (flask train-fastpath).
+# Solo decide si la probabilidad de 'coherente' supera FASTPATH_ACCEPT o baja de FASTPATH_REJECT;
+# el resto se escala al LLM como siempre.
+FASTPATH_ENABLED = os.getenv("FASTPATH_ENABLED", "1") == "1"
+FASTPATH_MODEL_PATH = os.getenv("FASTPATH_MODEL_PATH", "./fastpath.npz")
+FASTPATH_ACCEPT = float(os.getenv("FASTPATH_ACCEPT", "0.95"))
+FASTPATH_REJECT = float(os.getenv("FASTPATH_REJECT", "0.05"))
+FASTPATH_DIM = int(os.getenv("FASTPATH_DIM", str(2 ** 18)))
+VERDICT_LOG_PATH = os.getenv("VERDICT_LOG_PATH", "")
+_FASTPATH_QIDS = ("contexto", "criterios")
+_FASTPATH_NGRAMS = (2, 5)
+
+def _fastpath_features(text: str, dim: int, ngrams=_FASTPATH_NGRAMS):
+    """(índices, tf sublineal) de los n-gramas de caracteres del texto normalizado."""
+    import numpy as np
+    t = f" {_norm_key_text(text).lower()} "
+    grams = [t[i:i + n] for n in range(ngrams[0], ngrams[1] + 1) for i in range(len(t) - n + 1)]
+    if not grams:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    idx = np.fromiter((zlib.crc32(g.encode("utf-8")) % dim for g in grams), dtype=np.int64, count=len(grams))
+    idx, counts = np.unique(idx, return_counts=True)
+    return idx, 1.0 + np.log(counts)
+
+class _FastPath:
+    def __init__(self, path: str):
+        self.path = path
+        self.models = None  # qid -> (w, b, idf)
+        self.dim = FASTPATH_DIM
+        self.stats = {"accepted": 0, "rejected": 0, "escalated": 0}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        import numpy as np
+        with self._lock:
+            if self.models is not None:
+                return
+            models = {}
+            try:
+                with np.load(self.path) as z:
+                    self.dim = int(z["dim"])
+                    for qid in _FASTPATH_QIDS:
+                        if f"{qid}_w" in z:
+                            models[qid] = (z[f"{qid}_w"], float(z[f"{qid}_b"]), z[f"{qid}_idf"])
+                print(f"Fast path cargado ✅ ({', '.join(models) or 'sin modelos'})")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print("Fast path no disponible:", e)
+            self.models = models
+
+    def reload(self):
+        with self._lock:
+            self.models = None
+        self._load()
+
+    def proba(self, qid: str, text: str):
+        """P(coherente) o None si no hay modelo para la pregunta."""
+        import numpy as np
+        if self.models is None:
+            self._load()
+        m = self.models.get(qid)
+        if m is None:
+            return None
+        w, b, idf = m
+        idx, tf = _fastpath_features(text, self.dim)
+        if not idx.size:
+            return None
+        x = tf * idf[idx]
+        z = float(x @ w[idx]) / (float(np.sqrt(x @ x)) or 1.0) + b
+        return 1.0 / (1.0 + np.exp(-z))
+
+    def verdict(self, qid: str, text: str):
+        """'coherente' | 'incoherente' si la confianza supera los umbrales; None = escalar al LLM."""
+        if not FASTPATH_ENABLED or qid not in _FASTPATH_QIDS:
+            return None
+        p = self.proba(qid, text)
+        if p is None:
+            return None
+        if p >= FASTPATH_ACCEPT:
+            self.stats["accepted"] += 1
+            return "coherente"
+        if p <= FASTPATH_REJECT:
+            self.stats["rejected"] += 1
+            return "incoherente"
+        self.stats["escalated"] += 1
+        return None
+
+    def snapshot(self) -> dict:
+        return {"enabled": FASTPATH_ENABLED, "models": sorted(self.models or {}),
+                "accept": FASTPATH_ACCEPT, "reject": FASTPATH_REJECT, **self.stats}
+
+_fastpath = _FastPath(FASTPATH_MODEL_PATH)
+_verdict_log_lock = threading.Lock()
+
+def _fastpath_result(qid: str, answer: str):
+    """Resultado final de la pregunta si el clasificador local decide; None si hay que ir al LLM."""
+    v = _fastpath.verdict(qid, answer)
+    if v is None:
+        return None
     if qid == "criterios":
-        # (a) Drift permisivo específico para criterios
-        drift_user = (
-            f"OBJETIVO: {objetivo}\n"
-            f"RESPUESTA: {answer}\n"
-            "Responde solo: coherente | incoherente"
-        )
-        v_a = _gemini_one_word(_LLM_DRIFT_SYSTEM_CRITERIA, drift_user)
-        if v_a == "incoherente":
-            return {
-                "ok": False,
-                "hint": "Escribe criterios de calidad aplicables al objetivo (p. ej., claridad, "
-                        "ejemplos prácticos, español neutro, precisión, pasos accionables) e intenta de nuevo."
-            }, 200
-
-        # (b) Coherencia específica para criterios
-        coh_user = (
-            f"TIPO_PREGUNTA: {qid}\n"
-            f"OBJETIVO: {objetivo}\n"
-            f"CONTEXTO: {history}\n"
-            f"PREGUNTA: {question_text}\n"
-            f"RESPUESTA: {answer}\n"
-            "Responde solo: coherente | incoherente"
-        )
-        v_b = _gemini_one_word(_LLM_COHERENCE_SYSTEM_CRITERIA, coh_user)
-        if v_b != "coherente":
-            return {
-                "ok": False,
-                "hint": "No parece un criterio de calidad para este objetivo. Ejemplos: claridad, "
-                        "pasos accionables, ejemplos prácticos, precisión, evitar jerga, fuentes confiables."
-            }, 200
+        return _criteria_result(v, v)
+    return _context_result(v)
+
+def _log_verdict(qid: str, objetivo: str, answer: str, res: dict):
+    """Registra el veredicto del LLM (JSONL) como dato de entrenamiento del fast path."""
+    if not VERDICT_LOG_PATH or not _HAS_GENAI:
+        return
+    line = json.dumps({"ts": datetime.utcnow().isoformat() + "Z", "qid": qid, "objetivo": objetivo,
+                       "answer": answer, "verdict": "coherente" if res.get("ok") else "incoherente"},
+                      ensure_ascii=False)
+    try:
+        with _verdict_log_lock, open(VERDICT_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print("No se pudo registrar el veredicto:", e)
+
+def _load_verdict_log(path: str) -> dict:
+    """qid -> {respuesta normalizada: etiqueta}; gana el último veredicto de cada respuesta."""
+    data = {qid: {} for qid in _FASTPATH_QIDS}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            qid, answer = row.get("qid"), _norm_key_text(row.get("answer"))
+            if qid in data and answer and row.get("verdict") in ("coherente", "incoherente"):
+                data[qid][answer] = 1.0 if row["verdict"] == "coherente" else 0.0
+    return data
+
+def _train_logreg(texts: list, y, dim: int, epochs: int = 300, lr: float = 2.0, l2: float = 1e-4):
+    """Regresión logística por descenso de gradiente sobre TF-IDF disperso (COO). Devuelve (w, b, idf)."""
+    import numpy as np
+    feats = [_fastpath_features(t, dim) for t in texts]
+    n = len(feats)
+    df = np.bincount(np.concatenate([i for i, _ in feats]), minlength=dim)
+    idf = np.log((1.0 + n) / (1.0 + df)) + 1.0
+    rows = np.concatenate([np.full(i.size, r) for r, (i, _) in enumerate(feats)])
+    cols = np.concatenate([i for i, _ in feats])
+    vals = np.concatenate([tf * idf[i] for i, tf in feats])
+    norms = np.sqrt(np.bincount(rows, weights=vals * vals, minlength=n))
+    vals = vals / np.where(norms > 0, norms, 1.0)[rows]
+    w, b = np.zeros(dim), 0.0
+    pos_w = 0.5 / max(y.mean(), 1e-9)  # pesos balanceados por clase
+    neg_w = 0.5 / max(1.0 - y.mean(), 1e-9)
+    sw = np.where(y > 0.5, pos_w, neg_w)
+    for _ in range(epochs):
+        z = np.bincount(rows, weights=vals * w[cols], minlength=n) + b
+        err = sw * (1.0 / (1.0 + np.exp(-z)) - y)
+        w -= lr * (np.bincount(cols, weights=vals * err[rows], minlength=dim) / n + l2 * w)
+        b -= lr * err.mean()
+    return w, b, idf
+
+def train_fastpath(log_path: str, out_path: str, epochs: int = 300, holdout: float = 0.2,
+                   min_per_class: int = 20, dim: int = FASTPATH_DIM) -> dict:
+    """Entrena un modelo por pregunta con el log de veredictos y guarda los pesos en out_path (npz)."""
+    import numpy as np
+    data = _load_verdict_log(log_path)
+    arrays, report = {"dim": np.array(dim)}, {}
+    rng = np.random.default_rng(0)
+    for qid, rows in data.items():
+        texts = list(rows)
+        y = np.array([rows[t] for t in texts])
+        pos, neg = int(y.sum()), int(len(y) - y.sum())
+        if min(pos, neg) < min_per_class:
+            report[qid] = {"skipped": True, "coherente": pos, "incoherente": neg}
+            continue
+        order = rng.permutation(len(texts))
+        cut = int(len(texts) * (1.0 - holdout))
+        tr, te = order[:cut], order[cut:]
+        w, b, idf = _train_logreg([texts[i] for i in tr], y[tr], dim, epochs=epochs)
+        arrays.update({f"{qid}_w": w, f"{qid}_b": np.array(b), f"{qid}_idf": idf})
+
+        # Cobertura y precisión del fast path en el holdout con los umbrales actuales
+        fp = _FastPath(out_path)
+        fp.dim, fp.models = dim, {qid: (w, b, idf)}
+        probs = np.array([fp.proba(qid, texts[i]) or 0.5 for i in te])
+        decided = (probs >= FASTPATH_ACCEPT) | (probs <= FASTPATH_REJECT)
+        correct = ((probs >= FASTPATH_ACCEPT) & (y[te] > 0.5)) | ((probs <= FASTPATH_REJECT) & (y[te] < 0.5))
+        report[qid] = {
+            "train": int(len(tr)), "holdout": int(len(te)), "coherente": pos, "incoherente": neg,
+            "coverage": round(float(decided.mean()), 4) if len(te) else None,
+            "precision": round(float(correct.sum() / decided.sum()), 4) if decided.any() else None,
+        }
+    np.savez_compressed(out_path, **arrays)
+    return report
+
+@bp.cli.command("train-fastpath")
+@click.option("--log", "log_path", default=lambda: VERDICT_LOG_PATH or "./verdicts.jsonl", show_default="VERDICT_LOG_PATH")
+@click.option("--out", "out_path", default=lambda: FASTPATH_MODEL_PATH, show_default="FASTPATH_MODEL_PATH")
+@click.option("--epochs", default=300, show_default=True)
+@click.option("--min-per-class", default=20, show_default=True)
+def train_fastpath_command(log_path, out_path, epochs, min_per_class):
+    """Entrena el clasificador local de contexto/criterios con los veredictos registrados."""
+    report = train_fastpath(log_path, out_path, epochs=epochs, min_per_class=min_per_class)
+    click.echo(json.dumps(report, ensure_ascii=False, indent=2))
+    click.echo(f"Modelo guardado en {out_path}")
+
+def _validate_step_plan(qid: str, answer: str, history: dict):
+    """
+    Todo lo que no es LLM (compartido con asgi.py): (payload, None) si ya se decidió,
+    o (None, llm) con llm = {"objetivo", "coh_user"[, "drift_user"]} si hay que preguntarle al modelo.
+    """
+    # 1) Reglas mínimas (rápidas). Si falla, 200 con mensaje amable + sugerencias.
+    failure = _rules_failure(qid, answer, history)
+    if failure is not None:
+        return failure, None
 
-        return {"ok": True, "hint": "OK"}, 200
+    # 2) Clasificador local: decide los casos obvios sin llamar al LLM
+    fast = _fastpath_result(qid, answer)
+    if fast is not None:
+        return fast, None
 
-    elif qid == "contexto":
+    # 3) Validación con LLM según tipo de pregunta
+    objetivo = history.get("objetivo", "")
+    if qid == "criterios":
+        # (a) Drift permisivo + (b) coherencia específica para criterios
+        return None, {"objetivo": objetivo, "drift_user": _drift_user_msg(objetivo, answer),
+                      "coh_user": _coherence_user_msg(qid, objetivo, history, answer)}
+    if qid == "contexto":
         # Coherencia permisiva de contexto
-        coh_user = (
-            f"TIPO_PREGUNTA: {qid}\n"
-            f"OBJETIVO: {objetivo}\n"
-            f"CONTEXTO: {history}\n"
-            f"PREGUNTA: {question_text}\n"
-            f"RESPUESTA: {answer}\n"
-            "Responde solo: coherente | incoherente"
-        )
-        v_b = _gemini_one_word(_LLM_COHERENCE_SYSTEM_CONTEXT, coh_user)
-        if v_b != "coherente":
-            return {
-                "ok": False,
-                "hint": "No guarda relación con el contexto. Intenta de nuevo."
-            }, 200
-
-        return {"ok": True, "hint": "OK"}, 200
+        return None, {"objetivo": objetivo, "coh_user": _coherence_user_msg(qid, objetivo, history, answer)}
 
     # ✅ Para objetivo, tono, formato, longitud: ya pasaron reglas mínimas.
-    return {"ok": True, "hint": "OK"}, 200
+    return {"ok": True, "hint": "OK"}, None
+
+def _validate_step_core(qid: str, answer: str, history: dict):
+    res, llm = _validate_step_plan(qid, answer, history)
+    if llm is None:
+        return res, 200
+    objetivo = llm["objetivo"]
+    if qid == "criterios":
+        res = _criteria_result(*_criteria_verdicts(objetivo, answer, llm["drift_user"], llm["coh_user"]))
+    else:
+        res = _context_result(_gemini_one_word(_LLM_COHERENCE_SYSTEM_CONTEXT, llm["coh_user"], (objetivo, answer)))
+    _log_verdict(qid, objetivo, answer, res)
+    return res, 200
 
 
 
 # --- /validate-step y /api/validate-step (GET y POST) ---
-@app.route("/validate-step", methods=["GET", "POST"])
-@app.route("/api/validate-step", methods=["GET", "POST"])
+@bp.route("/validate-step", methods=["GET", "POST"])
+@bp.route("/api/validate-step", methods=["GET", "POST"])
 def validate_step():
     try:
         if request.method == "GET":
@@ -505,6 +2197,73 @@ def validate_step():
     except Exception as e:
         return jsonify({"ok": False, "hint": f"Error interno: {e}"}), 500
 
+# --- /validate-steps y /api/validate-steps: todas las respuestas del asistente en una llamada ---
+_LLM_QIDS = ("contexto", "criterios")
+
+def _steps_plan(answers: dict) -> list:
+    """[(qid, respuesta, historial)] en el orden del asistente; el historial son las respuestas previas."""
+    plan, history = [], {}
+    for q in INITIAL_QUESTIONS:
+        qid = q["id"]
+        if qid not in answers:
+            continue
+        answer = str(answers.get(qid) or "").strip()
+        plan.append((qid, answer, dict(history)))
+        history[qid] = answer
+    return plan
+
+def _steps_payload(answers: dict, plan: list, results: dict) -> dict:
+    ordered = {qid: results[qid] for qid, _, _ in plan}
+    invalid = [qid for qid, res in ordered.items() if not res.get("ok")]
+    missing = [q["id"] for q in INITIAL_QUESTIONS if q["id"] not in answers]
+    return {"ok": not invalid and not missing, "results": ordered,
+            "first_invalid": invalid[0] if invalid else None, "missing": missing}
+
+def _safe_step(qid: str, answer: str, history: dict) -> dict:
+    try:
+        return _validate_step_core(qid, answer, history)[0]
+    except Exception as e:
+        return {"ok": False, "hint": f"Error interno: {e}"}
+
+def validate_steps_core(answers: dict) -> dict:
+    """
+    Reglas de inmediato; las preguntas con LLM en paralelo. La última se evalúa en el hilo
+    de la petición: criterios ya reparte sus dos veredictos en el pool y no debe esperar
+    desde dentro de él (con el pool saturado, eso se bloquearía).
+    """
+    plan = _steps_plan(answers)
+    results, llm = {}, []
+    for qid, answer, history in plan:
+        if qid in _LLM_QIDS and _rules_failure(qid, answer, history) is None:
+            llm.append((qid, answer, history))
+        else:
+            results[qid] = _safe_step(qid, answer, history)
+
+    futures = {_llm_pool().submit(_safe_step, *step): step[0] for step in llm[:-1]}
+    if llm:
+        results[llm[-1][0]] = _safe_step(*llm[-1])
+    for fut, qid in futures.items():
+        results[qid] = fut.result()
+    return _steps_payload(answers, plan, results)
+
+def _steps_answers(data: dict):
+    answers = data.get("answers") or data.get("answers_clean")
+    if answers is None and any(q["id"] in data for q in INITIAL_QUESTIONS):
+        answers = data
+    return answers if isinstance(answers, dict) and answers else None
+
+@bp.post("/validate-steps")
+@bp.post("/api/validate-steps")
+def validate_steps():
+    data = request.get_json(silent=True) or {}
+    answers = _steps_answers(data) if isinstance(data, dict) else None
+    if answers is None:
+        return jsonify({"ok": False, "hint": "Falta 'answers' (objeto con las respuestas por pregunta)."}), 400
+    try:
+        return jsonify(validate_steps_core(answers)), 200
+    except Exception as e:
+        return jsonify({"ok": False, "hint": f"Error interno: {e}"}), 500
+
 # =========================
 #   3) Componer prompt
 # =========================
@@ -528,8 +2287,8 @@ def compose_from_template(answers: dict) -> str:
     )
 
 # --- /compose-initial y /api/compose-initial ---
-@app.post("/compose-initial")
-@app.post("/api/compose-initial")
+@bp.post("/compose-initial")
+@bp.post("/api/compose-initial")
 def compose_initial():
     data = request.get_json(silent=True) or {}
     answers_clean = data.get("answers_clean") or data.get("answers") or {}
@@ -540,10 +2299,15 @@ def compose_initial():
 #   4) Scorecard (Gemini)
 # =========================
 def _configure_genai(api_key: str | None = None):
-    key = api_key or globals().get("Geminiapikey") or os.getenv("GEMINI_API_KEY") or os.getenv("GEMINI_APIKEY")
-    if not key:
+    """Configura la clave global una sola vez por worker. Una api_key por request no
+    reconfigura el proceso: la atiende el pool de get_gemini_model."""
+    global _GENAI_CONFIGURED_KEY
+    key = globals().get("Geminiapikey") or os.getenv("GEMINI_API_KEY") or os.getenv("GEMINI_APIKEY")
+    if not key and not api_key:
         raise RuntimeError("No se encontró la API key. Define Geminiapikey o exporta GEMINI_API_KEY.")
-    genai.configure(api_key=key)
+    if key and key != _GENAI_CONFIGURED_KEY:
+        _genai().configure(api_key=key)
+        _GENAI_CONFIGURED_KEY = key
 
 # --- Sistema estricto (igual al notebook) ---
 _SCORECARD_SYSTEM_STRICT = """
@@ -587,6 +2351,24 @@ No redondees hacia arriba. Si dudas entre dos notas, elige la más BAJA.
 
 STRICT_CAP = True
 
+# --- Caché de resultados (opt-in) para scorecard y mejora: mismo prompt + modelo + versión de instrucciones ---
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "0") == "1"
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "86400"))
+_result_cache = _TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL_S)
+
+def _instruction_version(system_text: str) -> str:
+    """Versión corta de una instrucción de sistema: si cambia el texto, cambia la llave."""
+    return hashlib.sha256(system_text.encode("utf-8")).hexdigest()[:12]
+
+_SCORECARD_SYSTEM_VERSION = _instruction_version(_SCORECARD_SYSTEM_STRICT)
+
+def _cache_bypass(data: dict) -> bool:
+    """El cliente puede saltarse la caché con {"no_cache": true} o Cache-Control: no-cache."""
+    if data.get("no_cache"):
+        return True
+    return "no-cache" in (request.headers.get("Cache-Control") or "").lower()
+
 def _safe_json_parse(txt: str):
     txt = (txt or "").strip()
     try:
@@ -601,13 +2383,18 @@ def _safe_json_parse(txt: str):
             pass
     return {"critique": txt[:500], "criteria": {}, "penalties": {}}
 
+_SCORECARD_AXES = ("Rol", "Objetivo", "Tono", "Formato", "Longitud", "Calidad")
+
 def _postprocess_scorecard(sc: dict) -> dict:
-    axes = ["Rol","Objetivo","Tono","Formato","Longitud","Calidad"]
-    sc.setdefault("criteria", {})
+    axes = _SCORECARD_AXES
+    if not isinstance(sc.get("criteria"), dict):
+        sc["criteria"] = {}
     for a in axes:
-        sc["criteria"][a] = int(max(0, min(5, sc["criteria"].get(a, 0))))
+        v = sc["criteria"].get(a, 0)
+        sc["criteria"][a] = int(max(0, min(5, v))) if isinstance(v, (int, float)) else 0
     total_raw = sum(sc["criteria"][a] for a in axes)
-    sc.setdefault("penalties", {})
+    if not isinstance(sc.get("penalties"), dict):
+        sc["penalties"] = {}
     pen_total = sum(int(v) for v in sc["penalties"].values() if isinstance(v, (int, float)))
     total_final = max(0, total_raw - int(pen_total))
     if STRICT_CAP and any(sc["criteria"][a] <= 2 for a in axes):
@@ -617,27 +2404,55 @@ def _postprocess_scorecard(sc: dict) -> dict:
     sc["max"] = 30
     return sc
 
-def scorecard_gemini(prompt_to_score: str,
-                     api_key: str | None = None,
-                     model_name: str = "gemini-1.5-flash") -> dict:
-    _configure_genai(api_key)
-    model = genai.GenerativeModel(
-        model_name=model_name,
-        system_instruction=_SCORECARD_SYSTEM_STRICT,
-    )
-    user_msg = (
+def _scorecard_cache_key(prompt_to_score: str, model_name: str) -> str:
+    return _hash_key("scorecard", model_name, _SCORECARD_SYSTEM_VERSION, prompt_to_score, lower=False)
+
+def _scorecard_user_msg(prompt_to_score: str) -> str:
+    return (
         "Evalúa el siguiente PROMPT según la rúbrica estricta y responde SOLO en JSON:\n\n"
         "=== PROMPT A EVALUAR ===\n"
         f"{prompt_to_score}\n"
         "=== FIN ==="
     )
-    resp = model.generate_content(user_msg)
-    raw_text = _extract_text_from_candidates(resp)
+
+def _scorecard_is_complete(sc) -> bool:
+    """¿El JSON crudo del modelo trae los seis ejes numéricos? (solo entonces se cachea)."""
+    crit = sc.get("criteria") if isinstance(sc, dict) else None
+    return isinstance(crit, dict) and all(
+        isinstance(crit.get(a), (int, float)) and not isinstance(crit.get(a), bool) for a in _SCORECARD_AXES)
+
+def _finish_scorecard(raw_text: str, cache_key: str) -> dict:
     sc = _safe_json_parse(raw_text)
+    # Respuesta vacía, bloqueada o ilegible: se devuelve en ceros pero NO se cachea
+    cacheable = _scorecard_is_complete(sc)
+    if not isinstance(sc, dict):
+        sc = {"critique": (raw_text or "")[:500], "criteria": {}, "penalties": {}}
     sc = _postprocess_scorecard(sc)
     sc["_mode"] = "gemini_strict"
+    if RESULT_CACHE_ENABLED and cacheable:
+        _result_cache.set(cache_key, sc)
     return sc
 
+def _scorecard_prepare(prompt_to_score: str, api_key: str | None, model_name: str, use_cache: bool):
+    """(resultado en caché o None, modelo, llave de caché)."""
+    key = _scorecard_cache_key(prompt_to_score, model_name)
+    if RESULT_CACHE_ENABLED and use_cache:
+        hit = _result_cache.get(key)
+        if hit is not None:
+            return {**hit, "_cached": True}, None, key
+    _configure_genai(api_key)
+    return None, get_gemini_model(model_name, system_instruction=_SCORECARD_SYSTEM_STRICT, api_key=api_key), key
+
+def scorecard_gemini(prompt_to_score: str,
+                     api_key: str | None = None,
+                     model_name: str = "gemini-1.5-flash",
+                     use_cache: bool = True) -> dict:
+    hit, model, key = _scorecard_prepare(prompt_to_score, api_key, model_name, use_cache)
+    if hit is not None:
+        return hit
+    resp = model.generate_content(_scorecard_user_msg(prompt_to_score))
+    return _finish_scorecard(_extract_text_from_candidates(resp), key)
+
 # ====== Normalizador para lo que espera el FRONT ======
 
 def _sum_local_from_criteria(criteria_caps: dict):
@@ -671,9 +2486,9 @@ def _to_front_payload_v2(sc: dict, force_raw_total: bool = True) -> dict:
         "debug": {"sum_from_criteria": chosen_total}
     }
 
-# === endpoint principal (sin caché) ===
-@app.route("/api/scorecard", methods=["POST"])
-@app.route("/scorecard", methods=["POST"])
+# === endpoint principal (caché opcional: RESULT_CACHE_ENABLED) ===
+@bp.route("/api/scorecard", methods=["POST"])
+@bp.route("/scorecard", methods=["POST"])
 def api_scorecard():
     data = request.get_json(silent=True) or {}
     prompt = (data.get("prompt") or "").strip()
@@ -681,18 +2496,71 @@ def api_scorecard():
     api_key= data.get("api_key")
     if not prompt:
         return jsonify({"ok": False, "error": "Falta 'prompt'."}), 400
-    sc = scorecard_gemini(prompt, api_key=api_key, model_name=model)
+    bypass = _cache_bypass(data)
+    sc = scorecard_gemini(prompt, api_key=api_key, model_name=model, use_cache=not bypass)
     payload = _to_front_payload_v2(sc)  # <— usa v2
     resp = jsonify(payload)
+    # La caché es del servidor; el navegador no debe guardar la respuesta
     resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
+    resp.headers["X-Cache"] = "BYPASS" if bypass or not RESULT_CACHE_ENABLED else ("HIT" if sc.get("_cached") else "MISS")
     return resp, 200
 
 
 # =========================
 #   5) Mejorar con IA online (opcional) — máx. 150 palabras
 # =========================
-@app.post("/improve-online")
-@app.post("/api/improve-online")
+_IMPROVER_SYSTEM = (
+    "Eres un mejorador de prompts. Reescribe el prompt para que sea claro, completo y accionable. "
+    "Devuelve SOLO el prompt mejorado en un único bloque, sin comentarios extra, en **máximo 150 palabras**."
+)
+_IMPROVER_SYSTEM_VERSION = _instruction_version(_IMPROVER_SYSTEM)
+IMPROVER_MAX_WORDS = 150
+
+def _improver_model_name() -> str:
+    return os.getenv("GEMINI_IMPROVER_MODEL", "gemini-1.5-flash")
+
+def _improver_cache_key(base_prompt: str) -> str:
+    return _hash_key("improve", _improver_model_name(), _IMPROVER_SYSTEM_VERSION, base_prompt, lower=False)
+
+def _improver_model():
+    # Pedimos explícitamente <=150 palabras y lo reforzamos con un recorte de seguridad
+    return get_gemini_model(
+        _improver_model_name(),
+        system_instruction=_IMPROVER_SYSTEM,
+        generation_config={"temperature": 0.2, "max_output_tokens": 512},
+    )
+
+def _finish_improvement(resp, cache_key: str) -> str:
+    improved = _extract_text_from_candidates(resp) or (getattr(resp, "text", "") or "").strip()
+
+    # Recorte de seguridad a 150 palabras
+    words = improved.split()
+    if len(words) > IMPROVER_MAX_WORDS:
+        improved = " ".join(words[:IMPROVER_MAX_WORDS])
+
+    if RESULT_CACHE_ENABLED and improved:
+        _result_cache.set(cache_key, improved)
+    return improved
+
+def _improve_prepare(base_prompt: str, use_cache: bool):
+    """(resultado en caché o None, modelo, llave de caché)."""
+    key = _improver_cache_key(base_prompt)
+    if RESULT_CACHE_ENABLED and use_cache:
+        hit = _result_cache.get(key)
+        if hit is not None:
+            return {"prompt": hit, "cached": True}, None, key
+    return None, _improver_model(), key
+
+def improve_prompt(base_prompt: str, use_cache: bool = True) -> dict:
+    """Mejora el prompt con Gemini (máx. 150 palabras). Retorna {"prompt": ..., "cached": bool}."""
+    hit, model, key = _improve_prepare(base_prompt, use_cache)
+    if hit is not None:
+        return hit
+    resp = model.generate_content(base_prompt)
+    return {"prompt": _finish_improvement(resp, key), "cached": False}
+
+@bp.post("/improve-online")
+@bp.post("/api/improve-online")
 def improve_online():
     if not _HAS_GENAI:
         return jsonify(error="Gemini no configurado. Define GEMINI_API_KEY."), 501
@@ -702,36 +2570,114 @@ def improve_online():
     if not base_prompt:
         return jsonify(error="Falta 'prompt'."), 400
 
-    # Pedimos explícitamente <=150 palabras y lo reforzamos con un recorte de seguridad
-    llm = genai.GenerativeModel(
-        model_name=os.getenv("GEMINI_IMPROVER_MODEL", "gemini-1.5-flash"),
-        system_instruction=(
-            "Eres un mejorador de prompts. Reescribe el prompt para que sea claro, completo y accionable. "
-            "Devuelve SOLO el prompt mejorado en un único bloque, sin comentarios extra, en **máximo 150 palabras**."
-        ),
-        generation_config={"temperature": 0.2, "max_output_tokens": 512},
-    )
+    bypass = _cache_bypass(data)
+    res = improve_prompt(base_prompt, use_cache=not bypass)
+    resp = jsonify(prompt=res["prompt"])
+    resp.headers["X-Cache"] = "BYPASS" if bypass or not RESULT_CACHE_ENABLED else ("HIT" if res["cached"] else "MISS")
+    return resp, 200
 
-    resp = llm.generate_content(base_prompt)
-    improved = _extract_text_from_candidates(resp) or (getattr(resp, "text", "") or "").strip()
+# --- Variante en streaming (SSE): tokens al navegador según llegan, con tope incremental ---
+def _chunk_text(chunk) -> str:
+    """Texto de un chunk de streaming sin recortar espacios (se concatenan tal cual)."""
+    try:
+        buf = []
+        for c in getattr(chunk, "candidates", []) or []:
+            for p in getattr(getattr(c, "content", None), "parts", []) or []:
+                t = getattr(p, "text", None)
+                if isinstance(t, str):
+                    buf.append(t)
+            if buf:
+                break
+        return "".join(buf)
+    except Exception:
+        return ""
 
-    # Recorte de seguridad a 150 palabras
-    words = improved.split()
-    if len(words) > 150:
-        improved = " ".join(words[:150])
+def _sse(data: dict, event: str | None = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return head + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _stream_improvement(base_prompt: str, use_cache: bool = True):
+    """Genera eventos SSE: varios {"delta"} y un `done` con el prompt final (≤150 palabras)."""
+    key = _improver_cache_key(base_prompt)
+    if RESULT_CACHE_ENABLED and use_cache:
+        hit = _result_cache.get(key)
+        if hit is not None:
+            yield _sse({"delta": hit})
+            yield _sse({"prompt": hit, "cached": True, "truncated": False}, event="done")
+            return
+
+    llm = _improver_model()
+    acc, sent, truncated = "", 0, False
+    chunks = None
+    try:
+        chunks = iter(llm.generate_content(base_prompt, stream=True))
+        for chunk in chunks:
+            acc += _chunk_text(chunk)
+            words = list(re.finditer(r"\S+", acc))
+            if len(words) > IMPROVER_MAX_WORDS:
+                # Tope alcanzado: enviamos hasta la palabra 150 y dejamos de generar
+                acc = acc[:words[IMPROVER_MAX_WORDS - 1].end()]
+                truncated = True
+            if len(acc) > sent:
+                yield _sse({"delta": acc[sent:]})
+                sent = len(acc)
+            if truncated:
+                break
+    except Exception as e:
+        yield _sse({"error": str(e)}, event="error")
+        return
+    finally:
+        # Dejamos de consumir el stream por la API pública: se cierra el iterador si lo admite
+        # y la respuesta queda para el GC (sin tocar internos del SDK)
+        close = getattr(chunks, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception:
+                pass
+
+    # Mismo texto que la concatenación de los `delta` ya enviados (solo sin bordes en blanco)
+    improved = acc.strip()
+    if RESULT_CACHE_ENABLED and improved:
+        _result_cache.set(key, improved)
+    yield _sse({"prompt": improved, "cached": False, "truncated": truncated}, event="done")
 
-    return jsonify(prompt=improved), 200
+@bp.post("/improve-online/stream")
+@bp.post("/api/improve-online/stream")
+def improve_online_stream():
+    if not _HAS_GENAI:
+        return jsonify(error="Gemini no configurado. Define GEMINI_API_KEY."), 501
+
+    data = request.get_json(silent=True) or {}
+    base_prompt = (data.get("prompt", "") or "").strip()
+    if not base_prompt:
+        return jsonify(error="Falta 'prompt'."), 400
+
+    gen = _stream_improvement(base_prompt, use_cache=not _cache_bypass(data))
+    return Response(
+        stream_with_context(gen),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 # =========================
 #   6) Health y Home
 # =========================
-@app.get("/health")
-@app.get("/api/health")
+@bp.get("/health")
+@bp.get("/api/health")
 def health():
-    routes = sorted([f"{r.methods} {r.rule}" for r in app.url_map.iter_rules()])
-    return jsonify(ok=True, has_ollama=_HAS_OLLAMA, has_genai=_HAS_GENAI, routes=routes), 200
-
-@app.get("/")
+    routes = sorted([f"{r.methods} {r.rule}" for r in current_app.url_map.iter_rules()])
+    ingest = {"write_behind": ANALYTICS_WRITE_BEHIND, **_event_buffer.snapshot(),
+              "device_cache": _device_cache.stats()}
+    geo = {"provider": GEO_PROVIDER, "deferred": GEO_DEFERRED,
+           "cache": _geo_cache.stats(), "backfill": dict(_geo_backfill.stats)}
+    return jsonify(ok=True, has_ollama=_HAS_OLLAMA, has_genai=_HAS_GENAI, genai=genai_registry_stats(),
+                   llm_breakers=llm_breakers_snapshot(), llm_latency=llm_latency_snapshot(),
+                   criteria_validation=criteria_timing_stats(), fastpath=_fastpath.snapshot(),
+                   ingest=ingest, geo=geo, rollups=_rollups.snapshot(), db_pools=db_pools_snapshot(),
+                   analytics_snapshot=_snapshot.snapshot(), routes=routes), 200
+
+@bp.get("/")
 def home():
     try:
         return render_template("index.html")
@@ -743,12 +2689,12 @@ def home():
 from flask import jsonify
 import inspect
 
-@app.route("/__routes", methods=["GET"], strict_slashes=False)
+@bp.route("/__routes", methods=["GET"], strict_slashes=False)
 def __routes():
     return jsonify(sorted([f"{r.rule} -> {','.join(sorted(r.methods))}"
-                          for r in app.url_map.iter_rules()]))
+                          for r in current_app.url_map.iter_rules()]))
 
-@app.route("/scorecard/which", methods=["GET"], strict_slashes=False)
+@bp.route("/scorecard/which", methods=["GET"], strict_slashes=False)
 def which_scorecard_payload():
     func = globals().get("_to_front_payload_v2") or globals().get("_to_front_payload")
     return jsonify({
@@ -778,16 +2724,16 @@ def require_admin(view_func):
         if session["fail_count"] >= 3:
             session.pop("fail_count", None)
             session.pop("admin_ok", None)
-            return redirect(url_for("home"))  # <-- aquí: home
+            return redirect(url_for(".home"))  # <-- aquí: home
 
         accepts_html = "text/html" in (request.headers.get("Accept") or "")
         if accepts_html and request.method in ("GET", "HEAD"):
-            return redirect(url_for("analytics_login"))
+            return redirect(url_for(".analytics_login"))
         return jsonify(ok=False, error="unauthorized"), 401
     return wrapper
 
 
-@app.get("/analytics/login")
+@bp.get("/analytics/login")
 def analytics_login():
     html = """
     <!doctype html>
@@ -808,18 +2754,18 @@ def analytics_login():
     """
     return render_template_string(html, msg=None)
 
-@app.post("/analytics/login")
+@bp.post("/analytics/login")
 def analytics_login_post():
     key = (request.form.get("key") or "").strip()
     if key == ADMIN_KEY:
         session["admin_ok"] = True
         session["fail_count"] = 0
-        return redirect(url_for("analytics_page"))
+        return redirect(url_for(".analytics_page"))
     session["fail_count"] = session.get("fail_count", 0) + 1
     if session["fail_count"] >= 3:
         session.pop("fail_count", None)
         session.pop("admin_ok", None)
-        return redirect(url_for("home"))  # <-- aquí: home
+        return redirect(url_for(".home"))  # <-- aquí: home
     html = """
     <!doctype html>
     <meta charset="utf-8">
@@ -839,18 +2785,103 @@ def analytics_login_post():
     """
     return render_template_string(html, tries=session["fail_count"])
 
-@app.get("/analytics")
+@bp.get("/analytics")
 @require_admin
 def analytics_page():
     return render_template("analytics.html")
 
 
 # ---- STATS (única definición, protegida) ----
-@app.get("/api/analytics/stats")
-@require_admin
-def analytics_stats():
-    db = SessionLocal()
+# live (por defecto): agrega sobre las tablas crudas como antes.
+# rollup: suma los rollups diarios (costo proporcional a días × países, no a sesiones), pero refleja
+#         la última compactación: atrasa hasta ROLLUP_COMPACT_INTERVAL_S (la respuesta trae compacted_at).
+ANALYTICS_STATS_SOURCE = os.getenv("ANALYTICS_STATS_SOURCE", "live").strip().lower()
+
+# Lecturas de analítica: réplica (DATABASE_READ_URL) mientras responda; si se cae, el breaker manda
+# las lecturas al primario durante READ_FALLBACK_RESET_S, siempre en transacción de solo lectura.
+# Un pool de réplica agotado NO cae al primario (ese pool es el de la ingesta): se propaga el timeout.
+_read_breaker = _CircuitBreaker("db_read", int(os.getenv("READ_FALLBACK_FAILURES", "1")),
+                                float(os.getenv("READ_FALLBACK_RESET_S", "30")))
+
+def read_connection():
+    """Conexión de solo lectura para la analítica (réplica si está configurada y sana; si no, primario)."""
+    if read_engine is not None and _read_breaker.allow():
+        try:
+            conn = read_engine.connect()
+            _read_breaker.success()
+            return conn
+        except OperationalError as e:
+            _read_breaker.failure(e)
+            print("[db_read] réplica no disponible, leyendo del primario:", str(e)[:200])
+    conn = engine.connect()
+    if _IS_PG:
+        conn.exec_driver_sql("SET TRANSACTION READ ONLY")  # primera sentencia de la transacción
+    else:
+        conn.connection.info["query_only"] = True  # lo revierte _clear_query_only al volver al pool
+        conn.exec_driver_sql("PRAGMA query_only = ON")
+    return conn
+
+def db_pools_snapshot() -> dict:
+    """Ocupación y espera de checkout de los pools (primario y réplica)."""
+    out = {}
+    for name, eng in (("primary", engine), ("read", read_engine)):
+        if eng is None:
+            continue
+        pool = eng.pool
+        capacity = pool.size() + max(0, getattr(pool, "_max_overflow", 0))
+        in_use = pool.checkedout()
+        out[name] = {"size": pool.size(), "capacity": capacity, "checked_out": in_use,
+                     "idle": pool.checkedin(), "overflow": pool.overflow(),
+                     "utilization": round(in_use / capacity, 3) if capacity else None,
+                     **_POOL_STATS.get(name, _PoolStats()).snapshot()}
+    out["read_source"] = ("replica" if read_engine is not None and _read_breaker.state != _CircuitBreaker.OPEN
+                          else "primary")
+    if read_engine is not None:
+        out["read_breaker"] = _read_breaker.snapshot()
+    return out
+
+def _rollup_totals(db):
+    t = RollupDaily.__table__
+    row = db.execute(select(*(func.sum(t.c[c]).label(c) for c in _ROLLUP_AGG_COLS))).mappings().first() or {}
+    top = db.execute(
+        select(t.c.country, func.sum(t.c.sessions).label("n"))
+        .group_by(t.c.country).order_by(func.sum(t.c.sessions).desc()).limit(5)
+    ).mappings().all()
+    return row, [{"country": r["country"] or None, "n": int(r["n"] or 0)} for r in top]
+
+def _rollup_point(r) -> dict:
+    """Métricas derivadas de una fila de sumas de rollup (mismas definiciones que analytics_stats)."""
+    n = int(r["sessions"] or 0)
+    first_n = int(r["first_prompt_sessions"] or 0)
+    return {
+        "sessions": n,
+        "prompts": int(r["prompts"] or 0),
+        "avg_seconds_on_page": (int(r["time_on_page_ms"] or 0) / n / 1000.0) if n else None,
+        "avg_seconds_to_first": (int(r["first_prompt_ms"] or 0) / first_n / 1000.0) if first_n else None,
+        "pct_improved": (100.0 * int(r["improved_sessions"] or 0) / n) if n else None,
+        "pct_copied": (100.0 * int(r["copied_sessions"] or 0) / n) if n else None,
+    }
+
+def _compute_stats() -> dict:
+    db = read_connection()
     try:
+        if ANALYTICS_STATS_SOURCE == "rollup" and _schema_ready("analytics_rollups", "analytics_sketches"):
+            _rollups.ensure_started()
+            row, top_countries = _rollup_totals(db)
+            point = _rollup_point(row)
+            sketches = merged_sketches(db, SketchDaily.__table__)
+            return dict(
+                total_sessions=point["sessions"],
+                avg_seconds_on_page=point["avg_seconds_on_page"],
+                avg_seconds_to_first=point["avg_seconds_to_first"],
+                seconds_on_page=_sketch_quantiles(sketches.get(("time_on_page_ms",))),
+                seconds_to_first=_sketch_quantiles(sketches.get(("time_to_first_prompt_ms",))),
+                pct_improved=point["pct_improved"],
+                top_countries=top_countries,
+                source="rollup",
+                compacted_at=_rollups.stats["last_run_at"],
+            )
+
         total_sessions = db.execute(text("SELECT COUNT(*) FROM sessions")).scalar()
 
         row = db.execute(text("""
@@ -869,158 +2900,1525 @@ def analytics_stats():
             LIMIT 5
         """)).mappings().all()
 
-        return jsonify(
-            ok=True,
+        return dict(
             total_sessions=total_sessions or 0,
-            avg_seconds_on_page=(row or {}).get("avg_seconds_on_page"),
-            avg_seconds_to_first=(row or {}).get("avg_seconds_to_first"),
-            pct_improved=(row or {}).get("pct_improved"),
-            top_countries=[dict(r) for r in (top_countries or [])]
+            avg_seconds_on_page=_json_num((row or {}).get("avg_seconds_on_page")),
+            avg_seconds_to_first=_json_num((row or {}).get("avg_seconds_to_first")),
+            pct_improved=_json_num((row or {}).get("pct_improved")),
+            top_countries=[dict(r) for r in (top_countries or [])],
+            source="live",
         )
     finally:
         db.close()
 
+def _json_num(v):
+    """Decimal (AVG en Postgres) -> float, para que el hash del ETag sea estable."""
+    return float(v) if v is not None else None
+
+# Caché compartida (por worker) del resultado de stats:
+# - fresco (edad < STATS_CACHE_TTL_S): se sirve tal cual
+# - vencido pero dentro de STATS_CACHE_STALE_S: se sirve y se refresca en segundo plano
+# - más viejo: se recalcula en la petición (un solo cálculo a la vez)
+STATS_CACHE_TTL_S = float(os.getenv("STATS_CACHE_TTL_S", "30"))
+STATS_CACHE_STALE_S = float(os.getenv("STATS_CACHE_STALE_S", "300"))
+
+class _StatsCache:
+    def __init__(self, compute, ttl: float, stale: float):
+        self._compute = compute
+        self.ttl = ttl
+        self.stale = stale
+        self._entry = None  # {"data", "etag", "last_modified", "t"}
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self.hits = self.stale_hits = self.misses = self.refreshes = 0
+
+    def _refresh(self) -> dict:
+        data = self._compute()
+        body = {k: v for k, v in data.items() if k != "compacted_at"}  # la hora de compactación no es contenido
+        etag = hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+        prev = self._entry
+        # Last-Modified solo avanza si el contenido cambió
+        last_modified = prev["last_modified"] if prev and prev["etag"] == etag else datetime.utcnow().replace(microsecond=0)
+        self._entry = {"data": data, "etag": etag, "last_modified": last_modified, "t": time.monotonic()}
+        return self._entry
+
+    def _refresh_background(self):
+        try:
+            self._refresh()
+            self.refreshes += 1
+        except Exception as e:
+            print("stats refresh error:", e)
+        finally:
+            self._refreshing = False
+
+    def get(self) -> dict:
+        entry = self._entry
+        age = time.monotonic() - entry["t"] if entry else None
+        if entry is not None and age < self.ttl:
+            self.hits += 1
+            return entry
+        if entry is not None and age < self.ttl + self.stale:
+            self.stale_hits += 1
+            with self._lock:
+                start = not self._refreshing
+                self._refreshing = True
+            if start:
+                threading.Thread(target=self._refresh_background, name="stats-refresh", daemon=True).start()
+            return entry
+        with self._lock:  # single-flight: las demás peticiones esperan este cálculo
+            entry = self._entry
+            if entry is not None and time.monotonic() - entry["t"] < self.ttl:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return self._refresh()
+
+    def clear(self) -> int:
+        had = self._entry is not None
+        self._entry = None
+        return int(had)
+
+    def stats(self) -> dict:
+        entry = self._entry
+        return {"ttl_s": self.ttl, "stale_s": self.stale, "hits": self.hits, "stale_hits": self.stale_hits,
+                "misses": self.misses, "refreshes": self.refreshes,
+                "age_s": round(time.monotonic() - entry["t"], 1) if entry else None}
+
+_stats_cache = _StatsCache(_compute_stats, STATS_CACHE_TTL_S, STATS_CACHE_STALE_S)
+
+@bp.get("/api/analytics/stats")
+@require_admin
+def analytics_stats():
+    entry = _stats_cache.get()
+    headers = {
+        "ETag": f'"{entry["etag"]}"',
+        "Last-Modified": entry["last_modified"].strftime("%a, %d %b %Y %H:%M:%S GMT"),
+        "Cache-Control": "private, no-cache",  # el navegador revalida siempre con If-None-Match
+    }
+    inm = request.if_none_match
+    ims = request.if_modified_since
+    if (inm and inm.contains(entry["etag"])) or (
+            not inm and ims is not None and ims.replace(tzinfo=None) >= entry["last_modified"]):
+        return Response(status=304, headers=headers)
+    resp = jsonify(ok=True, **entry["data"], cache_age_s=round(time.monotonic() - entry["t"], 1))
+    resp.headers.update(headers)
+    return resp
+
+
+# ---- SERIES DE TIEMPO (desde rollups) ----
+_TIMESERIES_MAX_POINTS = int(os.getenv("TIMESERIES_MAX_POINTS", "2000"))
+_TIMESERIES_DEFAULT_RANGE = {"hour": timedelta(hours=48), "day": timedelta(days=30)}
+
+def _parse_ts_arg(name: str):
+    raw = (request.args.get(name) or "").strip()
+    if not raw:
+        return None
+    return datetime.fromisoformat(raw.replace("Z", "+00:00")).replace(tzinfo=None)
+
+@bp.get("/api/analytics/timeseries")
+@require_admin
+def analytics_timeseries():
+    """
+    ?bucket=hour|day&from=ISO&to=ISO[&country=XX][&group_by=country]
+    Puntos ordenados por bucket con sesiones, prompts y promedios/porcentajes derivados.
+    """
+    bucket = (request.args.get("bucket") or "day").lower()
+    if bucket not in _TIMESERIES_DEFAULT_RANGE:
+        return jsonify(ok=False, error="bucket debe ser 'hour' o 'day'"), 400
+    try:
+        end = _parse_ts_arg("to") or datetime.utcnow()
+        start = _parse_ts_arg("from") or (end - _TIMESERIES_DEFAULT_RANGE[bucket])
+    except ValueError as e:
+        return jsonify(ok=False, error=f"fecha inválida: {e}"), 400
+    start = _floor_hour(start) if bucket == "hour" else _floor_hour(start).replace(hour=0)
+    step = timedelta(hours=1) if bucket == "hour" else timedelta(days=1)
+    if end <= start:
+        return jsonify(ok=False, error="'to' debe ser posterior a 'from'"), 400
+    if (end - start) / step > _TIMESERIES_MAX_POINTS:
+        return jsonify(ok=False, error=f"rango demasiado amplio (máx. {_TIMESERIES_MAX_POINTS} buckets)"), 400
+    if not _schema_ready("analytics_rollups", "analytics_sketches"):
+        return jsonify(ok=False, error="migraciones pendientes: flask --app app db-upgrade"), 503
+
+    _rollups.ensure_started()
+    t = (RollupHourly if bucket == "hour" else RollupDaily).__table__
+    by_country = request.args.get("group_by") == "country"
+    keys = [t.c.bucket_start] + ([t.c.country] if by_country else [])
+    q = (select(*keys, *(func.sum(t.c[c]).label(c) for c in _ROLLUP_AGG_COLS))
+         .where(t.c.bucket_start >= start, t.c.bucket_start < end)
+         .group_by(*keys).order_by(*keys))
+    if "country" in request.args:
+        q = q.where(t.c.country == (request.args.get("country") or "").strip())
+
+    st = (SketchHourly if bucket == "hour" else SketchDaily).__table__
+    where = [st.c.bucket_start >= start, st.c.bucket_start < end]
+    if "country" in request.args:
+        where.append(st.c.country == (request.args.get("country") or "").strip())
+    db = read_connection()
+    try:
+        rows = db.execute(q).mappings().all()
+        sketches = merged_sketches(db, st, where, by=("bucket_start", "country") if by_country else ("bucket_start",))
+    finally:
+        db.close()
 
-# ---- QUERY (read-only) ----
-@app.post("/api/analytics/query")
+    points = []
+    for r in rows:
+        p = {"bucket": r["bucket_start"].isoformat() + "Z", **_rollup_point(r)}
+        key = (r["bucket_start"], r["country"]) if by_country else (r["bucket_start"],)
+        p["seconds_on_page"] = _sketch_quantiles(sketches.get(key + ("time_on_page_ms",)))
+        p["seconds_to_first"] = _sketch_quantiles(sketches.get(key + ("time_to_first_prompt_ms",)))
+        if by_country:
+            p["country"] = r["country"] or None
+        points.append(p)
+    return jsonify(ok=True, bucket=bucket, start=start.isoformat() + "Z", end=end.isoformat() + "Z",
+                   points=points, compacted_at=_rollups.stats["last_run_at"])
+
+
+# ---- SNAPSHOT EN MEMORIA (pandas): cohortes, funnel y retención ----
+# Cada worker mantiene sessions + session_metrics + prompts en un frame columnar compacto (una fila por
+# sesión, códigos int32, país categórico). La recarga es incremental: las sesiones de las últimas
+# ANALYTICS_SNAPSHOT_HOT_H horas (cuyas métricas aún cambian) y los prompts nuevos por created_at;
+# cada ANALYTICS_SNAPSHOT_FULL_H horas se recarga todo. Las consultas no tocan la BD.
+ANALYTICS_SNAPSHOT_INTERVAL_S = float(os.getenv("ANALYTICS_SNAPSHOT_INTERVAL_S", "60"))
+ANALYTICS_SNAPSHOT_HOT_H = float(os.getenv("ANALYTICS_SNAPSHOT_HOT_H", "48"))
+ANALYTICS_SNAPSHOT_FULL_H = float(os.getenv("ANALYTICS_SNAPSHOT_FULL_H", "24"))
+_SNAPSHOT_OVERLAP = timedelta(minutes=5)  # prompts de transacciones que confirman después del watermark
+_SNAPSHOT_COUNTERS = {"prompts_initial_count": "int32", "improve_clicks_count": "int32",
+                      "clipboard_copy_count": "int32", "wrong_answer_count": "int32",
+                      "new_prompt_clicks_count": "int32", "time_on_page_ms": "int64",
+                      "time_to_first_prompt_ms": "int64"}
+_SNAPSHOT_PERIODS = ("day", "week", "month")
+
+def _assign_codes(mapping: dict, keys) -> "np.ndarray":
+    """Código int32 estable por clave (UUID como str); las claves nuevas reciben el siguiente."""
+    import numpy as np
+    return np.fromiter((mapping.setdefault(k, len(mapping)) for k in keys), dtype=np.int32, count=len(keys))
+
+class _AnalyticsSnapshot:
+    def __init__(self, interval: float, hot_h: float, full_h: float):
+        self.interval = interval
+        self.hot_h = hot_h
+        self.full_h = full_h
+        self._frame = None       # índice == código de sesión
+        self._sids = {}          # session_id -> código
+        self._uids = {}          # user_id -> código
+        self._session_wm = None  # máximo started_at cargado
+        self._prompt_wm = None   # máximo created_at cargado
+        self._recent_prompts = set()  # ids dentro de la ventana de solape (evita contarlos dos veces)
+        self._full_at = 0.0
+        self._lock = threading.Lock()  # una recarga a la vez
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self.stats = {"refreshes": 0, "full_refreshes": 0, "errors": 0, "last_refresh_at": None,
+                      "last_ms": None, "last_rows": None, "orphan_prompts": 0, "last_error": None}
+
+    def ensure_started(self):
+        if self.interval <= 0:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="analytics-snapshot", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print("analytics snapshot error:", e)
+
+    def frame(self) -> "pd.DataFrame":
+        """Frame vigente (solo lectura); la primera llamada lo carga de forma síncrona."""
+        if self._frame is None:
+            self.refresh()
+        self.ensure_started()
+        return self._frame
+
+    def refresh(self, full: bool = False) -> dict:
+        with self._lock:
+            full = full or self._frame is None or time.monotonic() - self._full_at > self.full_h * 3600
+            t0 = time.monotonic()
+            try:
+                conn = read_connection()
+                try:
+                    rows = self._load(conn, full)
+                finally:
+                    conn.close()
+            except Exception as e:
+                self.stats["errors"] += 1
+                self.stats["last_error"] = str(e)[:200]
+                raise
+            if full:
+                self._full_at = time.monotonic()
+                self.stats["full_refreshes"] += 1
+            self.stats["refreshes"] += 1
+            self.stats["last_refresh_at"] = datetime.utcnow().isoformat() + "Z"
+            self.stats["last_ms"] = round((time.monotonic() - t0) * 1000, 1)
+            self.stats["last_rows"] = rows
+            return self.snapshot()
+
+    def _load(self, conn, full: bool) -> dict:
+        import numpy as np
+        import pandas as pd
+        if full:
+            sids, uids, old, since = {}, {}, None, None
+            prompt_since, recent = None, set()
+        else:
+            sids, uids, old = self._sids, self._uids, self._frame
+            since = datetime.utcnow() - timedelta(hours=self.hot_h)
+            if self._session_wm is not None:
+                since = min(since, self._session_wm)
+            prompt_since = self._prompt_wm - _SNAPSHOT_OVERLAP if self._prompt_wm else None
+            recent = self._recent_prompts
+
+        s, m, p = Session.__table__, SessionMetrics.__table__, Prompt.__table__
+        q = (select(s.c.id, s.c.user_id, s.c.started_at, s.c.ended_at, s.c.country,
+                    *(func.coalesce(m.c[c], 0).label(c) for c in _SNAPSHOT_COUNTERS))
+             .select_from(s.outerjoin(m, m.c.session_id == s.c.id)))
+        if since is not None:
+            q = q.where(s.c.started_at >= since)
+        srows = conn.execute(q).all()
+        pq = select(p.c.id, p.c.session_id, p.c.created_at)
+        if prompt_since is not None:
+            pq = pq.where(p.c.created_at >= prompt_since)
+        prows = conn.execute(pq).all()
+
+        # Sesiones: filas nuevas al final (código == posición), las de la ventana caliente se reemplazan
+        sids, uids = dict(sids), dict(uids)  # el frame vigente sigue siendo consistente mientras cargamos
+        codes = _assign_codes(sids, [str(r[0]) for r in srows])
+        upd = pd.DataFrame({
+            "user": _assign_codes(uids, [str(r[1]) for r in srows]),
+            "started_at": pd.to_datetime([r[2] for r in srows]).astype("datetime64[ns]"),
+            "ended_at": pd.to_datetime([r[3] for r in srows]).astype("datetime64[ns]"),
+            "country": [r[4] or None for r in srows],
+            **{c: np.fromiter((r[5 + i] or 0 for r in srows), dtype=t, count=len(srows))
+               for i, (c, t) in enumerate(_SNAPSHOT_COUNTERS.items())},
+        }, index=pd.Index(codes, dtype=np.int64))
+        n_old = 0 if old is None else len(old)
+        if old is None:
+            df = upd.iloc[0:0].assign(country=pd.Categorical([]), prompts=np.zeros(0, dtype=np.int32))
+        else:
+            df = old.copy()
+        cats = sorted(set(upd["country"].dropna()) - set(df["country"].cat.categories))
+        if cats:
+            df["country"] = df["country"].cat.add_categories(cats)
+        upd["country"] = pd.Categorical(upd["country"], categories=df["country"].cat.categories)
+        changed = upd[upd.index < n_old]
+        if len(changed):
+            df.loc[changed.index, changed.columns] = changed
+        added = upd[upd.index >= n_old].sort_index().assign(prompts=np.int32(0))
+        df = pd.concat([df, added]) if len(df) else added
+        df["prompts"] = df["prompts"].astype(np.int32)
+
+        # Prompts: solo el conteo por sesión (dedupe de la ventana de solape por id)
+        fresh = [(str(sid), created) for pid, sid, created in prows if str(pid) not in recent]
+        pcodes = np.fromiter((sids.get(sid, -1) for sid, _ in fresh), dtype=np.int64, count=len(fresh))
+        orphans = int((pcodes < 0).sum())
+        if len(pcodes):
+            df["prompts"] += np.bincount(pcodes[pcodes >= 0], minlength=len(df)).astype(np.int32)
+        prompt_wm = max((r[2] for r in prows if r[2] is not None), default=None) or self._prompt_wm
+        if prompt_wm is not None:
+            recent = {str(r[0]) for r in prows if r[2] is not None and r[2] >= prompt_wm - _SNAPSHOT_OVERLAP}
+        session_wm = max((r[2] for r in srows if r[2] is not None), default=None)
+
+        # Publica el nuevo estado de una vez
+        self._sids, self._uids = sids, uids
+        self._session_wm = max(filter(None, (self._session_wm if not full else None, session_wm)), default=None)
+        self._prompt_wm, self._recent_prompts = prompt_wm, recent
+        self._frame = df
+        self.stats["orphan_prompts"] += orphans
+        return {"sessions": len(srows), "prompts": len(fresh) - orphans}
+
+    def snapshot(self) -> dict:
+        df = self._frame
+        return {"interval_s": self.interval, "hot_h": self.hot_h, "full_h": self.full_h,
+                "sessions": 0 if df is None else len(df), "users": len(self._uids),
+                "memory_bytes": 0 if df is None else int(df.memory_usage(deep=True).sum()), **self.stats}
+
+_snapshot = _AnalyticsSnapshot(ANALYTICS_SNAPSHOT_INTERVAL_S, ANALYTICS_SNAPSHOT_HOT_H, ANALYTICS_SNAPSHOT_FULL_H)
+
+def _period_index(ts: "np.ndarray", period: str) -> "np.ndarray":
+    """Número de día/semana (ISO, lunes)/mes desde 1970 para un arreglo datetime64."""
+    import numpy as np
+    if period == "month":
+        return ts.astype("datetime64[M]").astype(np.int64)
+    days = ts.astype("datetime64[D]").astype(np.int64)
+    return (days + 3) // 7 if period == "week" else days  # 1970-01-01 fue jueves
+
+def _period_start(idx, period: str) -> str:
+    import numpy as np
+    if period == "month":
+        return str(np.datetime64(int(idx), "M").astype("datetime64[D]"))
+    return str(np.datetime64(int(idx) * 7 - 3 if period == "week" else int(idx), "D"))
+
+def _snapshot_args():
+    """(frame filtrado por país, período, inicio, fin) a partir de ?country=&period=&from=&to=."""
+    period = (request.args.get("period") or "week").lower()
+    if period not in _SNAPSHOT_PERIODS:
+        raise ValueError("period debe ser 'day', 'week' o 'month'")
+    start, end = _parse_ts_arg("from"), _parse_ts_arg("to")
+    df = _snapshot.frame()
+    if "country" in request.args:
+        country = (request.args.get("country") or "").strip()
+        df = df[(df["country"] == country).to_numpy() if country else df["country"].isna().to_numpy()]
+    return df, period, start, end
+
+def _user_cohorts(df: "pd.DataFrame", period: str):
+    """(período de cada sesión, período de la primera sesión de su usuario)."""
+    import pandas as pd
+    pidx = _period_index(df["started_at"].to_numpy(), period)
+    first = pd.Series(pidx, index=df.index).groupby(df["user"].to_numpy()).transform("min").to_numpy()
+    return pidx, first
+
+def _in_range(pidx: "np.ndarray", period: str, start, end) -> "np.ndarray":
+    import numpy as np
+    mask = np.ones(len(pidx), dtype=bool)
+    if start is not None:
+        mask &= pidx >= _period_index(np.array([start], dtype="datetime64[ns]"), period)[0]
+    if end is not None:
+        mask &= pidx <= _period_index(np.array([end], dtype="datetime64[ns]"), period)[0]
+    return mask
+
+def _snapshot_response(t0: float, **data):
+    return jsonify(ok=True, **data, snapshot_at=_snapshot.stats["last_refresh_at"],
+                   elapsed_ms=round((time.perf_counter() - t0) * 1000, 2))
+
+@bp.get("/api/analytics/funnel")
 @require_admin
-def analytics_query():
-    payload = request.get_json(silent=True) or {}
-    sql = (payload.get("sql") or "").strip()
-    limit = int(payload.get("limit") or 100)
-    limit = max(1, min(limit, 100))  # 1..100
+def analytics_funnel():
+    """
+    ?from=ISO&to=ISO[&country=XX]
+    Sesiones iniciadas en el rango que avanzan por session → prompt_created → improve_click → clipboard_copy
+    (cada paso exige los anteriores).
+    """
+    import numpy as np
+    t0 = time.perf_counter()
+    try:
+        df, _period, start, end = _snapshot_args()
+    except ValueError as e:
+        return jsonify(ok=False, error=str(e)), 400
+    started = df["started_at"].to_numpy()
+    mask = np.ones(len(df), dtype=bool)
+    if start is not None:
+        mask &= started >= np.datetime64(start)
+    if end is not None:
+        mask &= started < np.datetime64(end)
+    reached = mask.copy()
+    steps = []
+    for name, hit in (("session", None),
+                      ("prompt_created", (df["prompts"].to_numpy() > 0) | (df["prompts_initial_count"].to_numpy() > 0)),
+                      ("improve_click", df["improve_clicks_count"].to_numpy() > 0),
+                      ("clipboard_copy", df["clipboard_copy_count"].to_numpy() > 0)):
+        if hit is not None:
+            reached &= hit
+        steps.append({"step": name, "sessions": int(reached.sum())})
+    first = steps[0]["sessions"]
+    for prev, st in zip([None] + steps[:-1], steps):
+        st["pct_of_start"] = (100.0 * st["sessions"] / first) if first else None
+        st["pct_of_previous"] = (100.0 * st["sessions"] / prev["sessions"]) if prev and prev["sessions"] else None
+    return _snapshot_response(t0, steps=steps)
+
+@bp.get("/api/analytics/cohorts")
+@require_admin
+def analytics_cohorts():
+    """
+    ?period=day|week|month&from=ISO&to=ISO[&country=XX]
+    Usuarios agrupados por el período de su primera sesión: tamaño, sesiones, prompts y tasas de uso.
+    """
+    t0 = time.perf_counter()
+    try:
+        df, period, start, end = _snapshot_args()
+    except ValueError as e:
+        return jsonify(ok=False, error=str(e)), 400
+    import pandas as pd
+    _pidx, first = _user_cohorts(df, period)
+    keep = _in_range(first, period, start, end)
+    agg = pd.DataFrame({
+        "cohort": first[keep],
+        "user": df["user"].to_numpy()[keep],
+        "prompts": df["prompts"].to_numpy()[keep],
+        "time_on_page_ms": df["time_on_page_ms"].to_numpy()[keep],
+        "improved": df["improve_clicks_count"].to_numpy()[keep] > 0,
+        "copied": df["clipboard_copy_count"].to_numpy()[keep] > 0,
+    }).groupby("cohort").agg(users=("user", "nunique"), sessions=("user", "size"), prompts=("prompts", "sum"),
+                             time_on_page_ms=("time_on_page_ms", "sum"), improved=("improved", "sum"),
+                             copied=("copied", "sum"))
+    cohorts = [{
+        "cohort": _period_start(c, period),
+        "users": int(r.users),
+        "sessions": int(r.sessions),
+        "prompts": int(r.prompts),
+        "sessions_per_user": r.sessions / r.users,
+        "avg_seconds_on_page": r.time_on_page_ms / r.sessions / 1000.0,
+        "pct_improved": 100.0 * r.improved / r.sessions,
+        "pct_copied": 100.0 * r.copied / r.sessions,
+    } for c, r in agg.iterrows()]
+    return _snapshot_response(t0, period=period, cohorts=cohorts)
+
+@bp.get("/api/analytics/retention")
+@require_admin
+def analytics_retention():
+    """
+    ?period=day|week|month&periods=N&from=ISO&to=ISO[&country=XX]
+    Matriz de retención: % de usuarios de cada cohorte con alguna sesión k períodos después (k = 0..N-1);
+    null donde el período aún no termina de ocurrir.
+    """
+    import numpy as np
+    t0 = time.perf_counter()
+    try:
+        df, period, start, end = _snapshot_args()
+        periods = max(1, min(int(request.args.get("periods") or 8), 104))
+    except ValueError as e:
+        return jsonify(ok=False, error=str(e)), 400
+    pidx, first = _user_cohorts(df, period)
+    offset = pidx - first
+    keep = _in_range(first, period, start, end) & (offset < periods)
+    cohort_ids, cohort_pos = np.unique(first[keep], return_inverse=True)
+    # Pares (usuario, k) únicos -> conteo por celda (cohorte, k)
+    users = df["user"].to_numpy()[keep].astype(np.int64)
+    pairs = np.unique(users * periods + offset[keep])
+    cell_of_user = np.zeros(len(_snapshot._uids) + 1, dtype=np.int64)
+    cell_of_user[users] = cohort_pos
+    active = np.bincount(cell_of_user[pairs // periods] * periods + pairs % periods,
+                         minlength=len(cohort_ids) * periods).reshape(len(cohort_ids), periods)
+    current = _period_index(np.array([datetime.utcnow()], dtype="datetime64[ns]"), period)[0]
+    rows = []
+    for i, c in enumerate(cohort_ids):
+        size = int(active[i, 0])
+        rows.append({"cohort": _period_start(c, period), "users": size,
+                     "retention": [(100.0 * int(active[i, k]) / size if size else None) if c + k <= current else None
+                                   for k in range(periods)]})
+    return _snapshot_response(t0, period=period, periods=periods, cohorts=rows)
+
+@bp.route("/api/analytics/snapshot", methods=["GET", "POST"])
+@require_admin
+def analytics_snapshot():
+    """GET: estado del snapshot. POST [?full=1]: recarga ahora (incremental o completa)."""
+    if request.method == "POST":
+        try:
+            return jsonify(ok=True, **_snapshot.refresh(full=request.args.get("full") in ("1", "true")))
+        except Exception as e:
+            return jsonify(ok=False, error=str(e)), 500
+    return jsonify(ok=True, **_snapshot.snapshot())
+
 
+# ---- QUERY (read-only) ----
+# format=json (default): página de hasta 100 filas (valores como string) + next_cursor.
+# format=ndjson|csv: respuesta en streaming, filas en lotes desde un cursor del servidor.
+# format=parquet|arrow: export columnar por lotes a un archivo temporal (requiere pyarrow).
+ANALYTICS_EXPORT_MAX_ROWS = int(os.getenv("ANALYTICS_EXPORT_MAX_ROWS", "1000000"))
+ANALYTICS_EXPORT_BATCH = int(os.getenv("ANALYTICS_EXPORT_BATCH", "1000"))
+_EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+def _guard_select(sql: str):
+    """Mensaje de error si la consulta no es un SELECT único y de solo lectura; None si pasa."""
     if not sql:
-        return jsonify(ok=False, error="sql required"), 400
+        return "sql required"
 
     upper = sql.upper().strip()
 
     # 1) Solo SELECT al inicio
     if not upper.startswith("SELECT"):
-        return jsonify(ok=False, error="only SELECT is allowed"), 400
+        return "only SELECT is allowed"
 
     # 2) Bloquea múltiples statements
     if ";" in sql:
-        return jsonify(ok=False, error="multiple statements are not allowed"), 400
+        return "multiple statements are not allowed"
 
     # 3) Bloquea comandos peligrosos como PALABRAS COMPLETAS (no subcadenas)
     forbidden_words = r"\b(?:INSERT|UPDATE|DELETE|DROP|ALTER|CREATE|TRUNCATE|REINDEX|VACUUM|PRAGMA|ATTACH|DETACH|COPY|GRANT|REVOKE)\b"
     if re.search(forbidden_words, upper):
-        return jsonify(ok=False, error="keyword not allowed"), 400
+        return "keyword not allowed"
+    return None
 
-    # 4) Si no trae LIMIT, lo añadimos (máx 100)
-    if "LIMIT" not in upper:
-        sql = f"{sql} LIMIT {limit}"
+def _encode_cursor(sql: str, offset: int) -> str:
+    raw = json.dumps({"h": _hash_key(sql, lower=False)[:16], "o": offset}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
 
-    db = SessionLocal()
+def _decode_cursor(token: str, sql: str) -> int:
+    """Offset del token; ValueError si es ilegible o pertenece a otra consulta."""
     try:
-        rs = db.execute(text(sql))
-        rows = rs.fetchall()
+        data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        offset = int(data["o"])
+    except Exception:
+        raise ValueError("cursor inválido")
+    if data.get("h") != _hash_key(sql, lower=False)[:16] or offset < 0:
+        raise ValueError("el cursor no corresponde a esta consulta")
+    return offset
+
+def _json_default(v):
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    if isinstance(v, Decimal):
+        return float(v)
+    return str(v)
+
+def _arrow_value(v):
+    if isinstance(v, Decimal):
+        return float(v)
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, ensure_ascii=False, default=_json_default)
+    if v is None or isinstance(v, (bool, int, float, str, bytes, datetime, date)):
+        return v
+    return str(v)
+
+# --- Guardas para SQL ad-hoc: costo estimado (EXPLAIN), timeout por sentencia, concurrencia y caché ---
+# Una consulta cara no debe saturar la BD ni quedarse con el pool que usa la ingesta de eventos.
+ANALYTICS_QUERY_MAX_COST = float(os.getenv("ANALYTICS_QUERY_MAX_COST", "1000000"))
+ANALYTICS_EXPORT_MAX_COST = float(os.getenv("ANALYTICS_EXPORT_MAX_COST", "100000000"))
+ANALYTICS_QUERY_TIMEOUT_S = float(os.getenv("ANALYTICS_QUERY_TIMEOUT_S", "5"))
+ANALYTICS_EXPORT_TIMEOUT_S = float(os.getenv("ANALYTICS_EXPORT_TIMEOUT_S", "120"))
+ANALYTICS_QUERY_CONCURRENCY = int(os.getenv("ANALYTICS_QUERY_CONCURRENCY", "2"))
+ANALYTICS_QUERY_CACHE_TTL_S = float(os.getenv("ANALYTICS_QUERY_CACHE_TTL_S", "60"))
+_query_slots = threading.BoundedSemaphore(max(1, ANALYTICS_QUERY_CONCURRENCY))
+_query_cache = _TTLCache(maxsize=int(os.getenv("ANALYTICS_QUERY_CACHE_SIZE", "256")), ttl=ANALYTICS_QUERY_CACHE_TTL_S)
+
+class _QueryRejected(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+def _normalize_sql(sql: str) -> str:
+    """Colapsa espacios fuera de los literales '...' (llave de caché de consultas equivalentes)."""
+    parts = re.split(r"('(?:[^']|'')*')", sql.strip())
+    return "".join(p if i % 2 else re.sub(r"\s+", " ", p) for i, p in enumerate(parts)).strip()
+
+_SQL_NOT_ALIAS = {"WHERE", "JOIN", "LEFT", "RIGHT", "INNER", "OUTER", "CROSS", "FULL", "ON", "USING",
+                  "GROUP", "ORDER", "LIMIT", "OFFSET", "HAVING", "UNION", "EXCEPT", "INTERSECT", "NATURAL"}
+
+def _sqlite_plan_cost(conn, sql: str) -> float:
+    """
+    Costo aproximado en filas visitadas a partir de EXPLAIN QUERY PLAN:
+    los SCAN de un mismo nivel son loops anidados (se multiplican), los SEARCH por índice suman log2(n)
+    por fila externa y los niveles distintos (subconsultas, UNION) se suman.
+    """
+    import numpy as np
+    rows = {}
+    for (name,) in conn.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"):
+        rows[name.lower()] = float(conn.exec_driver_sql(f'SELECT COALESCE(MAX(rowid), 0) FROM "{name}"').scalar() or 0)
+    # El plan nombra las tablas por su alias: alias -> tabla
+    names = dict((t, t) for t in rows)
+    for t in rows:
+        for m in re.finditer(rf"\b{re.escape(t)}\s+(?:AS\s+)?(\w+)", sql, flags=re.IGNORECASE):
+            if m.group(1).upper() not in _SQL_NOT_ALIAS:
+                names[m.group(1).lower()] = t
+    biggest = max(rows.values(), default=0.0)
+
+    levels = {}
+    for _id, parent, _unused, detail in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql):
+        m = re.match(r"(SCAN|SEARCH) (\w+)", detail)
+        if not m or m.group(2) == "CONSTANT":
+            continue
+        n = rows.get(names.get(m.group(2).lower()), biggest)  # subconsulta materializada: cota superior
+        factor = max(n, 1.0) if m.group(1) == "SCAN" else max(np.log2(n + 1), 1.0)
+        levels[parent] = levels.get(parent, 1.0) * factor
+    return float(sum(levels.values()))
+
+def _query_cost(conn, sql: str) -> float:
+    """Costo estimado por el planner (Postgres: Total Cost de EXPLAIN JSON; SQLite: heurística)."""
+    if _IS_PG:
+        plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return float(plan[0]["Plan"]["Total Cost"])
+    return _sqlite_plan_cost(conn, sql)
+
+def _check_cost(conn, sql: str, max_cost: float):
+    if max_cost <= 0:
+        return
+    cost = _query_cost(conn, sql)
+    if cost > max_cost:
+        raise _QueryRejected(f"consulta demasiado costosa (costo estimado {cost:,.0f} > {max_cost:,.0f}); "
+                             "agrega filtros o índices", 422)
+
+def _set_statement_timeout(conn, seconds: float):
+    """Timeout para las sentencias de `conn` (transacción actual). Devuelve la función que lo retira."""
+    if seconds <= 0:
+        return lambda: None
+    if _IS_PG:
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(seconds * 1000)}")
+        return lambda: None  # SET LOCAL muere con la transacción
+    raw = conn.connection.driver_connection
+    deadline = time.monotonic() + seconds
+    raw.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, 10_000)
+    return lambda: raw.set_progress_handler(None, 0)  # la conexión vuelve al pool sin el handler
+
+def _is_timeout_error(e: Exception) -> bool:
+    msg = str(e).lower()
+    return "statement timeout" in msg or "interrupted" in msg or "canceling statement" in msg
+
+def _acquire_query_slot():
+    if not _query_slots.acquire(blocking=False):
+        raise _QueryRejected("demasiadas consultas de analítica en curso; reintenta en unos segundos", 429)
+
+def _stream_query(sql: str, max_cost: float = 0, timeout_s: float = 0, on_close=None):
+    """
+    (columnas, iterador de lotes de filas, release) con cursor del servidor. Verifica el costo y fija el
+    timeout antes de ejecutar. release() (idempotente) devuelve la conexión y llama on_close; corre al
+    terminar el iterador, pero quien arma la respuesta debe registrarlo también con call_on_close:
+    si el cuerpo nunca se empieza a leer, el `finally` del generador no se ejecuta.
+    """
+    conn = read_connection()
+    clear_timeout = lambda: None
+    try:
+        _check_cost(conn, sql, max_cost)
+        clear_timeout = _set_statement_timeout(conn, timeout_s)
+        rs = conn.execution_options(stream_results=True, yield_per=ANALYTICS_EXPORT_BATCH).execute(text(sql))
+    except Exception:
+        clear_timeout()
+        conn.close()
+        if on_close:
+            on_close()
+        raise
+    cols = list(rs.keys())
+    released = threading.Event()
+
+    def release():
+        if released.is_set():
+            return
+        released.set()
+        try:
+            rs.close()
+            clear_timeout()
+        finally:
+            conn.close()
+            if on_close:
+                on_close()
+
+    def batches():
+        try:
+            for part in rs.partitions():
+                yield part
+        finally:
+            release()
+    return cols, batches(), release
+
+def _ndjson_chunks(cols, batches):
+    for part in batches:
+        yield "".join(json.dumps(dict(zip(cols, r)), ensure_ascii=False, default=_json_default) + "\n"
+                      for r in part)
+
+def _csv_chunks(cols, batches):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(cols)
+    for part in batches:
+        w.writerows(part)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+def _columnar_export(fmt: str, cols, batches):
+    """Escribe los lotes en Parquet / Arrow IPC sobre un archivo temporal; memoria acotada por lote."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    out = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    writer, schema = None, None
+    try:
+        for part in batches:
+            rows = [{c: _arrow_value(v) for c, v in zip(cols, r)} for r in part]
+            if schema is None:
+                inferred = pa.Table.from_pylist(rows).schema
+                # Columnas solo con NULL en el primer lote: string, para que los siguientes lotes encajen
+                schema = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f
+                                    for f in inferred])
+                writer = (pq.ParquetWriter(out, schema) if fmt == "parquet"
+                          else pa.ipc.new_stream(out, schema))
+            for f in schema:
+                if pa.types.is_string(f.type):
+                    for row in rows:
+                        if row[f.name] is not None and not isinstance(row[f.name], str):
+                            row[f.name] = str(row[f.name])
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        if writer is None:  # sin filas: archivo válido con columnas string
+            schema = pa.schema([pa.field(c, pa.string()) for c in cols])
+            writer = pq.ParquetWriter(out, schema) if fmt == "parquet" else pa.ipc.new_stream(out, schema)
+        writer.close()
+    except Exception:
+        out.close()
+        raise
+    finally:
+        batches.close()  # libera la conexión también si hubo error a mitad de camino
+    out.seek(0)
+    return out
+
+def _file_chunks(f, size: int = 64 * 1024):
+    try:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+@bp.post("/api/analytics/query")
+@require_admin
+def analytics_query():
+    """
+    Body: {"sql": "SELECT ...", "limit": 100, "cursor": "<next_cursor>", "format": "json|ndjson|csv|parquet|arrow"}
+    """
+    payload = request.get_json(silent=True) or {}
+    sql = (payload.get("sql") or "").strip()
+    limit = int(payload.get("limit") or 100)
+    limit = max(1, min(limit, 100))  # 1..100
+    fmt = (payload.get("format") or "json").strip().lower()
+
+    error = _guard_select(sql)
+    if error:
+        return jsonify(ok=False, error=error), 400
+    if fmt != "json" and fmt not in _EXPORT_FORMATS:
+        return jsonify(ok=False, error=f"format debe ser json o {', '.join(_EXPORT_FORMATS)}"), 400
+
+    if fmt in _EXPORT_FORMATS:
+        if fmt in ("parquet", "arrow"):
+            try:
+                import pyarrow  # noqa: F401  (dependencia opcional)
+            except ImportError:
+                return jsonify(ok=False, error="export columnar no disponible: instala pyarrow"), 501
+        capped = f"SELECT * FROM ({sql}) AS q LIMIT {ANALYTICS_EXPORT_MAX_ROWS}" if ANALYTICS_EXPORT_MAX_ROWS > 0 else sql
+        release = lambda: None
+        try:
+            _acquire_query_slot()
+            cols, batches, release = _stream_query(capped, ANALYTICS_EXPORT_MAX_COST, ANALYTICS_EXPORT_TIMEOUT_S,
+                                                   on_close=_query_slots.release)
+            if fmt in ("parquet", "arrow"):
+                body = _file_chunks(_columnar_export(fmt, cols, batches))
+            else:
+                body = stream_with_context((_ndjson_chunks if fmt == "ndjson" else _csv_chunks)(cols, batches))
+        except _QueryRejected as e:
+            return _query_rejected_response(e)
+        except Exception as e:
+            release()
+            if _is_timeout_error(e):
+                return jsonify(ok=False, error=f"la consulta superó el tiempo límite ({ANALYTICS_EXPORT_TIMEOUT_S:g}s)"), 408
+            return jsonify(ok=False, error=str(e)), 400
+        ext = {"ndjson": "ndjson", "csv": "csv", "parquet": "parquet", "arrow": "arrows"}[fmt]
+        resp = Response(body, mimetype=_EXPORT_FORMATS[fmt], headers={
+            "Content-Disposition": f'attachment; filename="query.{ext}"',
+            "X-Accel-Buffering": "no",
+        })
+        resp.call_on_close(release)  # slot y conexión vuelven aunque el cuerpo nunca se lea
+        return resp
+
+    # JSON paginado: la consulta del usuario va envuelta, así su propio LIMIT también se pagina
+    try:
+        offset = _decode_cursor(payload["cursor"], sql) if payload.get("cursor") else 0
+    except ValueError as e:
+        return jsonify(ok=False, error=str(e)), 400
+    page_sql = f"SELECT * FROM ({sql}) AS q LIMIT {limit + 1} OFFSET {offset}"
+
+    # Misma consulta normalizada + misma página dentro del TTL: sin tocar la BD
+    cache_key = hashlib.sha256(f"{_normalize_sql(sql)}\x1f{limit}\x1f{offset}".encode("utf-8")).hexdigest()
+    bypass = bool(payload.get("no_cache")) or "no-cache" in (request.headers.get("Cache-Control") or "").lower()
+    cached = None if bypass else _query_cache.get(cache_key)
+    if cached is not None:
+        resp = jsonify(ok=True, **cached)
+        resp.headers["X-Cache"] = "HIT"
+        return resp
+
+    try:
+        _acquire_query_slot()
+    except _QueryRejected as e:
+        return _query_rejected_response(e)
+    conn = None
+    clear_timeout = lambda: None
+    try:
+        conn = read_connection()
+        _check_cost(conn, page_sql, ANALYTICS_QUERY_MAX_COST)
+        clear_timeout = _set_statement_timeout(conn, ANALYTICS_QUERY_TIMEOUT_S)
+        rs = conn.execute(text(page_sql))
+        rows = rs.fetchmany(limit + 1)
         cols = rs.keys()
-        out_rows = [{k: (None if v is None else str(v)) for k, v in zip(cols, r)} for r in rows]
-        return jsonify(ok=True, columns=list(cols), rows=out_rows)
+        has_more = len(rows) > limit
+        out_rows = [{k: (None if v is None else str(v)) for k, v in zip(cols, r)} for r in rows[:limit]]
+        result = {"columns": list(cols), "rows": out_rows,
+                  "next_cursor": _encode_cursor(sql, offset + limit) if has_more else None}
+        _query_cache.set(cache_key, result)
+        resp = jsonify(ok=True, **result)
+        resp.headers["X-Cache"] = "BYPASS" if bypass else "MISS"
+        return resp
+    except _QueryRejected as e:
+        return _query_rejected_response(e)
+    except SATimeoutError:
+        return _query_rejected_response(_QueryRejected("pool de lectura ocupado; reintenta en unos segundos", 503))
     except Exception as e:
+        if _is_timeout_error(e):
+            return jsonify(ok=False, error=f"la consulta superó el tiempo límite ({ANALYTICS_QUERY_TIMEOUT_S:g}s)"), 408
         return jsonify(ok=False, error=str(e)), 400
     finally:
-        db.close()
+        clear_timeout()
+        if conn is not None:
+            conn.close()
+        _query_slots.release()
+
+def _query_rejected_response(e: _QueryRejected):
+    resp = jsonify(ok=False, error=str(e))
+    if e.status in (429, 503):
+        resp.headers["Retry-After"] = "2"
+    return resp, e.status
 
 
 # ---- EVENTOS ----
-@app.post("/api/analytics/event")
-def analytics_event():
-    raw = request.get_data(cache=False, as_text=True)
-    try:
-        data = json.loads(raw) if raw else (request.get_json(force=True) or {})
-    except Exception as e:
-        print("DEBUG /api/analytics/event raw body:", raw)
-        return jsonify(ok=False, error=f"bad json: {str(e)}"), 400
+# Modo write-behind: los eventos se validan, se encolan en memoria y un hilo
+# de fondo los escribe por lotes (por tamaño o por tiempo) en una sola transacción.
+ANALYTICS_WRITE_BEHIND = os.getenv("ANALYTICS_WRITE_BEHIND", "0") == "1"
+ANALYTICS_QUEUE_MAX = int(os.getenv("ANALYTICS_QUEUE_MAX", "10000"))
+ANALYTICS_FLUSH_MAX_EVENTS = int(os.getenv("ANALYTICS_FLUSH_MAX_EVENTS", "500"))
+ANALYTICS_FLUSH_INTERVAL_S = float(os.getenv("ANALYTICS_FLUSH_INTERVAL_S", "1.0"))
+ANALYTICS_ENQUEUE_TIMEOUT_S = float(os.getenv("ANALYTICS_ENQUEUE_TIMEOUT_S", "0.05"))
+# Lotes del front (/api/analytics/events)
+ANALYTICS_BATCH_MAX_EVENTS = int(os.getenv("ANALYTICS_BATCH_MAX_EVENTS", "500"))
+ANALYTICS_BATCH_MAX_BYTES = int(os.getenv("ANALYTICS_BATCH_MAX_BYTES", str(1024 * 1024)))
+
+# evento -> columna de session_metrics que incrementa en 1
+_COUNTER_EVENTS = {
+    "wrong_answer": "wrong_answer_count",
+    "improve_click": "improve_clicks_count",
+    "clipboard_copy": "clipboard_copy_count",
+    "new_prompt_click": "new_prompt_clicks_count",
+}
 
+def _request_event_defaults() -> dict:
+    """Datos del request que se guardan con cada evento (el flusher no tiene request)."""
+    return {
+        "user_agent": request.headers.get("User-Agent") or "",
+        "referrer": request.referrer or "",
+        "ip": _client_ip(),
+    }
+
+def _normalize_event(data: dict, defaults: dict) -> dict | None:
+    """Valida un evento crudo del front. Devuelve None si falta device_id o event."""
+    if not isinstance(data, dict):
+        return None
     device_id = (data.get("device_id") or "").strip()
     event = (data.get("event") or "").strip()
+    if not device_id or not event:
+        return None
     payload = data.get("payload") or {}
     geo = data.get("geo") or {}
-    ua = (data.get("user_agent") or request.headers.get("User-Agent") or "")[:250]
-    ref = (data.get("referrer") or request.referrer or "")[:250]
+    return {
+        "device_id": device_id[:128],
+        "event": event,
+        "payload": payload if isinstance(payload, dict) else {},
+        "geo": geo if isinstance(geo, dict) else {},
+        "user_agent": (data.get("user_agent") or defaults.get("user_agent") or "")[:250],
+        "referrer": (data.get("referrer") or defaults.get("referrer") or "")[:250],
+        "ip": defaults.get("ip") or "",
+        "ts": datetime.utcnow(),
+        "t": time.monotonic(),
+    }
 
-    if not device_id or not event:
-        return jsonify(ok=False, error="device_id y event son requeridos"), 400
+# --- Ingesta a nivel Core: upserts y contadores atómicos (col = col + :delta) ---
+# Nada se lee-modifica-escribe en Python, así dos heartbeats de workers distintos no se pisan.
+if DATABASE_URL.startswith("postgresql"):
+    from sqlalchemy.dialects.postgresql import insert as _dialect_insert
+else:
+    from sqlalchemy.dialects.sqlite import insert as _dialect_insert  # SQLite >= 3.35 (RETURNING)
+
+_users_t = User.__table__
+_sessions_t = Session.__table__
+_metrics_t = SessionMetrics.__table__
+_prompts_t = Prompt.__table__
+_events_t = Event.__table__
+
+# Log crudo: cada evento se agrega a `events` en la misma transacción que lo pliega en los contadores
+# (un INSERT por lote, sin lecturas), así se puede reprocesar la historia con `flask events-replay`.
+EVENT_LOG_ENABLED = os.getenv("EVENT_LOG_ENABLED", "true").lower() == "true"
+EVENT_REPLAY_BATCH = int(os.getenv("EVENT_REPLAY_BATCH", "1000"))
+
+def _event_log_row(ev: dict, session_id) -> dict:
+    # El JSON del prompt ya queda en `prompts`; en el log basta con el resto del payload
+    payload = {k: v for k, v in ev["payload"].items() if k != "prompt_initial_json"}
+    return {"ts": ev["ts"], "session_id": session_id, "device_id": ev["device_id"], "event": ev["event"][:32],
+            "payload": json.dumps(payload, separators=(",", ":"), default=str) if payload else None}
+
+_METRIC_COUNTERS = ("prompts_initial_count", "wrong_answer_count", "improve_clicks_count",
+                    "time_on_page_ms", "clipboard_copy_count", "new_prompt_clicks_count")
+
+def _new_metrics(session_id) -> dict:
+    return {"session_id": session_id, "time_to_first_prompt_ms": 0, **{col: 0 for col in _METRIC_COUNTERS}}
+
+def _fold_event(m: dict, ev: dict):
+    """Aplica un evento a una fila de métricas (deltas en la ingesta, totales en el replay)."""
+    if ev["event"] == "prompt_created":
+        m["prompts_initial_count"] += 1
+        ms_first = ev["payload"].get("time_to_first_prompt_ms")
+        if isinstance(ms_first, int) and ms_first >= 0 and m["time_to_first_prompt_ms"] == 0:
+            m["time_to_first_prompt_ms"] = ms_first
+        return
+    delta = _event_delta(ev)
+    if delta is not None:
+        m[delta[0]] += delta[1]
+
+# device_id -> (user_id, session_id, ended). Solo se guarda estado leído de la BD
+# (ya confirmado); init_session/end_session y las sesiones nuevas lo invalidan. El TTL corto acota
+# cuánto puede divergir un worker cuando otro abre o cierra la sesión del mismo dispositivo.
+DEVICE_CACHE_SIZE = int(os.getenv("DEVICE_CACHE_SIZE", "10000"))
+DEVICE_CACHE_TTL_S = float(os.getenv("DEVICE_CACHE_TTL_S", "30"))
+_device_cache = _TTLCache(maxsize=DEVICE_CACHE_SIZE, ttl=DEVICE_CACHE_TTL_S)
+
+def _event_delta(ev: dict):
+    """(columna, delta) si el evento solo suma a un contador de session_metrics; si no, None."""
+    if ev["event"] in _COUNTER_EVENTS:
+        return _COUNTER_EVENTS[ev["event"]], 1
+    if ev["event"] == "heartbeat":
+        ms = ev["payload"].get("delta_ms")
+        if isinstance(ms, int) and ms > 0:
+            return "time_on_page_ms", ms
+    return None
+
+def _active_session_subquery(device_id: str):
+    """id de la última sesión del dispositivo, solo si sigue abierta."""
+    latest = (
+        select(_sessions_t.c.id)
+        .join(_users_t, _users_t.c.id == _sessions_t.c.user_id)
+        .where(_users_t.c.device_id == device_id)
+        .order_by(_sessions_t.c.started_at.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    return (select(_sessions_t.c.id)
+            .where(_sessions_t.c.id == latest, _sessions_t.c.ended_at.is_(None))
+            .scalar_subquery())
 
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter_by(device_id=device_id).one_or_none()
-        if not user:
-            user = User(device_id=device_id)
-            db.add(user)
-            db.flush()
-
-        session_rec = (
-            db.query(Session)
-              .filter_by(user_id=user.id)
-              .order_by(Session.started_at.desc())
-              .first()
-        )
-        create_new_session = (event == "init_session") or (session_rec is None or session_rec.ended_at is not None)
-        if create_new_session:
-            geo_in = geo or {}
-            if not geo_in.get("country"):
-                geo_in = resolve_geo_from_request()
-
-            session_rec = Session(
-                user_id=user.id,
-                ip_hash=None,
-                country=geo_in.get("country"),
-                city=geo_in.get("city"),
-                user_agent=ua,
-                referrer=ref,
-            )
-            db.add(session_rec)
-            db.flush()
-            db.add(SessionMetrics(session_id=session_rec.id))
-        else:
-            metrics = db.get(SessionMetrics, session_rec.id)
-            if not metrics:
-                metrics = SessionMetrics(session_id=session_rec.id)
-                db.add(metrics)
+def _ingest_counter_fast(db, ev: dict) -> str | None:
+    """
+    Camino de una sola sentencia para contadores y heartbeats:
+      UPDATE session_metrics SET col = col + :delta WHERE session_id = (sesión activa) RETURNING session_id
+    None si el dispositivo no tiene sesión activa con métricas (se usa el camino general).
+    """
+    delta = _event_delta(ev)
+    if delta is None:
+        return None
+    col, d = delta
+    hit = _device_cache.get(ev["device_id"])
+    if hit is not None and not hit[2]:
+        target = hit[1]  # sesión conocida: UPDATE por clave primaria, sin subconsulta
+    else:
+        target = _active_session_subquery(ev["device_id"])
+    stmt = (
+        update(_metrics_t)
+        .where(_metrics_t.c.session_id == target)
+        .values({col: _metrics_t.c[col] + d})
+        .returning(_metrics_t.c.session_id)
+    )
+    sid = db.execute(stmt).scalar()
+    if sid is None and hit is not None:
+        _device_cache.pop(ev["device_id"])  # la sesión cacheada ya no existe: que decida el camino general
+    if sid is not None and EVENT_LOG_ENABLED and _schema_ready("events_log"):
+        db.execute(_events_t.insert(), [_event_log_row(ev, sid)])
+    return str(sid) if sid is not None else None
+
+def _upsert_users(db, device_ids) -> dict:
+    """
+    device_id -> user_id: INSERT ... ON CONFLICT DO NOTHING y luego un SELECT por device_id.
+    Un DO UPDATE no-op reescribiría (y bloquearía) la fila de cada usuario existente en cada lote.
+    """
+    devices = sorted(device_ids)  # orden fijo: sin deadlocks
+    stmt = _dialect_insert(_users_t).values([{"id": uuid.uuid4(), "device_id": d} for d in devices])
+    db.execute(stmt.on_conflict_do_nothing(index_elements=[_users_t.c.device_id]))
+    return {r.device_id: r.id for r in db.execute(
+        select(_users_t.c.id, _users_t.c.device_id).where(_users_t.c.device_id.in_(devices)))}
+
+def _metrics_upsert():
+    """INSERT de métricas que, si la fila existe, suma los deltas en vez de sobrescribir."""
+    stmt = _dialect_insert(_metrics_t)
+    set_ = {col: _metrics_t.c[col] + stmt.excluded[col] for col in _METRIC_COUNTERS}
+    set_["time_to_first_prompt_ms"] = case(
+        (_metrics_t.c.time_to_first_prompt_ms == 0, stmt.excluded.time_to_first_prompt_ms),
+        else_=_metrics_t.c.time_to_first_prompt_ms,
+    )
+    return stmt.on_conflict_do_update(index_elements=[_metrics_t.c.session_id], set_=set_)
 
-        metrics = db.get(SessionMetrics, session_rec.id)
+def _ingest_events(db, events: list[dict]) -> list[str]:
+    """
+    Pliega una lista de eventos normalizados en users/sessions/session_metrics/prompts.
+    Un evento suelto de contador va por _ingest_counter_fast (una sentencia). Para el resto:
+    upsert de usuarios, una consulta de últimas sesiones y, al final, un executemany por tabla
+    con los deltas de cada sesión acumulados en Python. No hace commit.
+    Retorna el session_id asociado a cada evento, en el mismo orden.
+    """
+    if not events:
+        return []
+    if len(events) == 1:
+        sid = _ingest_counter_fast(db, events[0])
+        if sid is not None:
+            return [sid]
+
+    # Dispositivos en caché: sin upsert de usuario ni consulta de última sesión
+    users, current = {}, {}
+    for d in {ev["device_id"] for ev in events}:
+        hit = _device_cache.get(d)
+        if hit is not None:
+            users[d] = hit[0]
+            current[hit[0]] = {"id": hit[1], "ended": hit[2]}
+    missing = {ev["device_id"] for ev in events} - users.keys()
+    if missing:
+        fresh = _upsert_users(db, missing)
+        users.update(fresh)
+
+        # Última sesión de cada usuario (una sola consulta con MAX(started_at) por usuario)
+        latest = (
+            select(_sessions_t.c.user_id, func.max(_sessions_t.c.started_at).label("mx"))
+            .where(_sessions_t.c.user_id.in_(list(fresh.values())))
+            .group_by(_sessions_t.c.user_id)
+            .subquery()
+        )
+        rows = db.execute(
+            select(_sessions_t.c.id, _sessions_t.c.user_id, _sessions_t.c.ended_at).join(
+                latest, (_sessions_t.c.user_id == latest.c.user_id) & (_sessions_t.c.started_at == latest.c.mx))
+        )
+        current.update({r.user_id: {"id": r.id, "ended": r.ended_at is not None} for r in rows})
+
+    # Solo se cachea estado ya confirmado: con sesión previa, el usuario no es un INSERT de esta transacción
+    for d in missing:
+        cur = current.get(users[d])
+        if cur is not None:
+            _device_cache.set(d, (users[d], cur["id"], cur["ended"]))
+    touched = set()  # dispositivos cuya sesión cambia en este lote
+
+    new_sessions, ended, prompts = [], [], []
+    deltas = {}  # session_id -> fila de métricas con deltas
+    log, out = [], []
+    for ev in events:
+        user_id = users[ev["device_id"]]
+        event, payload = ev["event"], ev["payload"]
+        cur = current.get(user_id)
+
+        if event == "init_session" or cur is None or cur["ended"]:
+            new_id = uuid.uuid4()
+            geo_in = ev["geo"]
+            if not geo_in.get("country") and not ev.get("geo_resolved"):  # asgi ya la resolvió
+                geo_in = geo_for_new_session(ev["ip"], new_id)
+            new_sessions.append({
+                "id": new_id, "user_id": user_id, "started_at": ev["ts"], "ip_hash": None,
+                "country": geo_in.get("country"), "city": geo_in.get("city"),
+                "user_agent": ev["user_agent"], "referrer": ev["referrer"],
+            })
+            cur = current[user_id] = {"id": new_id, "ended": False}
+            touched.add(ev["device_id"])
+
+        sid = cur["id"]
+        m = deltas.get(sid)
+        if m is None:
+            m = deltas[sid] = _new_metrics(sid)
 
         if event == "end_session":
-            session_rec.ended_at = func.now()
+            ended.append({"b_id": sid, "b_ended_at": ev["ts"]})
+            cur["ended"] = True
+            touched.add(ev["device_id"])
 
         elif event == "prompt_created":
             pjson = payload.get("prompt_initial_json") or {}
-            if DATABASE_URL.startswith("postgresql"):
-                db.add(Prompt(session_id=session_rec.id, prompt_initial_json=pjson))
-            else:
-                db.add(Prompt(session_id=session_rec.id, prompt_initial_json=json.dumps(pjson)))
-            metrics.prompts_initial_count += 1
-            ms_first = payload.get("time_to_first_prompt_ms")
-            if isinstance(ms_first, int) and ms_first >= 0 and metrics.time_to_first_prompt_ms == 0:
-                metrics.time_to_first_prompt_ms = ms_first
-
-        elif event == "wrong_answer":
-            metrics.wrong_answer_count += 1
-        elif event == "improve_click":
-            metrics.improve_clicks_count += 1
-        elif event == "clipboard_copy":
-            metrics.clipboard_copy_count += 1
-        elif event == "new_prompt_click":
-            metrics.new_prompt_clicks_count += 1
-        elif event == "heartbeat":
-            ms = payload.get("delta_ms")
-            if isinstance(ms, int) and ms > 0:
-                metrics.time_on_page_ms += ms
+            prompts.append({
+                "id": uuid.uuid4(), "session_id": sid, "created_at": ev["ts"],
+                "prompt_initial_json": pjson if DATABASE_URL.startswith("postgresql") else json.dumps(pjson),
+            })
+
+        _fold_event(m, ev)
+        if EVENT_LOG_ENABLED and _schema_ready("events_log"):
+            log.append(_event_log_row(ev, sid))
+        out.append(str(sid))
+
+    if new_sessions:
+        db.execute(_sessions_t.insert(), new_sessions)
+    db.execute(_metrics_upsert(), list(deltas.values()))
+    if ended:
+        db.execute(
+            update(_sessions_t).where(_sessions_t.c.id == bindparam("b_id")).values(ended_at=bindparam("b_ended_at")),
+            ended,
+        )
+    if prompts:
+        db.execute(_prompts_t.insert(), prompts)
+    if log:
+        db.execute(_events_t.insert(), log)
+    for d in touched:
+        _device_cache.pop(d)
+    return out
+
+def replay_session_metrics(batch: int = EVENT_REPLAY_BATCH, dry_run: bool = False, force: bool = False,
+                           log=print) -> dict:
+    """
+    Reconstruye session_metrics desde `events` en una sola pasada en streaming.
+    Los eventos se leen ordenados por (session_id, id), así cada sesión se pliega completa y se escribe
+    en lotes de `batch` (memoria constante). Solo considera eventos hasta el último id al empezar y
+    omite las sesiones que reciben eventos después (siguen activas: sus contadores los mantiene la ingesta).
+    Solo reescribe sesiones con historia completa en el log: el evento que las creó está registrado
+    (su primer evento tiene el mismo ts que sessions.started_at). Las demás empezaron antes del log
+    (o con EVENT_LOG_ENABLED=false) y no se tocan. Además nunca baja un contador (ni borra
+    time_to_first_prompt_ms) salvo con force=True. dry_run: solo compara.
+    """
+    with engine.connect() as conn:
+        max_id = conn.execute(select(func.max(_events_t.c.id))).scalar()
+    stats = {"events": 0, "sessions": 0, "changed": 0, "skipped_partial": 0, "skipped_lower": 0,
+             "max_event_id": max_id}
+    if max_id is None:
+        return stats
+    e = _events_t
+    active = select(e.c.session_id).where(e.c.id > max_id)
+    q = (select(e.c.session_id, e.c.ts, e.c.event, e.c.payload)
+         .where(e.c.id <= max_id, e.c.session_id.not_in(active))
+         .order_by(e.c.session_id, e.c.id))
+    stmt = _dialect_insert(_metrics_t)
+    overwrite = stmt.on_conflict_do_update(
+        index_elements=[_metrics_t.c.session_id],
+        set_={c: stmt.excluded[c] for c in ("time_to_first_prompt_ms", *_METRIC_COUNTERS)})
+
+    def lowers(r, cur) -> bool:
+        if cur is None:
+            return False
+        if any(r[c] < (getattr(cur, c) or 0) for c in _METRIC_COUNTERS):
+            return True
+        return bool(cur.time_to_first_prompt_ms) and not r["time_to_first_prompt_ms"]
+
+    def flush(rows, rconn):
+        if not rows:
+            return
+        ids = [r["session_id"] for r in rows]
+        # SQLite no deja confirmar en otra conexión mientras esta lee: escribe en la misma
+        with (engine.begin() if _IS_PG else _commit_after(rconn)) as wconn:
+            started = dict(wconn.execute(
+                select(_sessions_t.c.id, _sessions_t.c.started_at).where(_sessions_t.c.id.in_(ids))).all())
+            current = {r.session_id: r for r in wconn.execute(
+                select(_metrics_t).where(_metrics_t.c.session_id.in_(ids)))}
+            changed = []
+            for first_ts, r in ((r.pop("_first_ts"), r) for r in rows):
+                if started.get(r["session_id"]) != first_ts:
+                    stats["skipped_partial"] += 1
+                    continue
+                cur = current.get(r["session_id"])
+                if cur is not None and all(getattr(cur, k) == v for k, v in r.items() if k != "session_id"):
+                    continue
+                if not force and lowers(r, cur):
+                    stats["skipped_lower"] += 1
+                    continue
+                changed.append(r)
+            stats["changed"] += len(changed)
+            if changed and not dry_run:
+                wconn.execute(overwrite, changed)
+        stats["sessions"] += len(rows)
+        log(f"  {stats['sessions']} sesiones, {stats['events']} eventos, {stats['changed']} con cambios, "
+            f"{stats['skipped_partial']} parciales, {stats['skipped_lower']} bajarían contadores")
+
+    pending, m = [], None
+    with engine.connect() as conn:
+        rs = conn.execution_options(stream_results=True, yield_per=batch * 10).execute(q)
+        for sid, ts, event, payload in rs:
+            stats["events"] += 1
+            if m is None or m["session_id"] != sid:
+                if m is not None:
+                    pending.append(m)
+                    if len(pending) >= batch:
+                        flush(pending, conn)
+                        pending = []
+                m = {**_new_metrics(sid), "_first_ts": ts}
+            _fold_event(m, {"event": event, "payload": json.loads(payload) if payload else {}})
+        if m is not None:
+            pending.append(m)
+        flush(pending, conn)
+    return stats
+
+@contextmanager
+def _commit_after(conn):
+    yield conn
+    conn.commit()
+
+@bp.cli.command("events-replay")
+@click.option("--batch", type=int, default=EVENT_REPLAY_BATCH, help="Sesiones por transacción de escritura.")
+@click.option("--dry-run", is_flag=True, help="Solo cuenta las sesiones cuyas métricas cambiarían.")
+@click.option("--force", is_flag=True, help="Permite bajar contadores ya guardados (p. ej. tras corregir datos).")
+def events_replay_command(batch, dry_run, force):
+    """Reconstruye session_metrics desde el log de eventos (tabla events)."""
+    out = replay_session_metrics(batch=batch, dry_run=dry_run, force=force, log=click.echo)
+    click.echo(json.dumps(out))
+
+
+class _EventBuffer:
+    """
+    Cola acotada en memoria + hilo flusher.
+    - put(): no bloquea más de `timeout`; si la cola está llena devuelve False (backpressure).
+    - put_many(): todo el lote o nada; put() y put_many() encolan bajo el mismo lock.
+    - El flusher junta hasta `max_batch` eventos o espera `interval_s` y los escribe en una transacción.
+    - close(): detiene el hilo y vacía lo pendiente (se registra con atexit).
+    """
+    def __init__(self, maxsize: int, max_batch: int, interval_s: float):
+        self._q = queue.Queue(maxsize=maxsize)
+        self._max_batch = max(1, max_batch)
+        self._interval = max(0.05, interval_s)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {
+            "enqueued": 0, "rejected": 0, "flushed": 0, "failed": 0, "batches": 0,
+            "last_batch_size": 0, "last_flush_at": None, "last_lag_ms": 0, "max_lag_ms": 0,
+        }
+
+    def _ensure_started(self):
+        # Arranque perezoso: el hilo nace en el proceso worker, no en el que importa el módulo
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="analytics-flusher", daemon=True)
+                self._thread.start()
+
+    def put(self, ev: dict, timeout: float = 0.0) -> bool:
+        self._ensure_started()
+        deadline = time.monotonic() + timeout
+        while True:
+            # Mismo lock que put_many: su chequeo de espacio no puede quedar viejo antes de encolar el lote
+            with self._lock:
+                try:
+                    self._q.put_nowait(ev)
+                    self.stats["enqueued"] += 1
+                    return True
+                except queue.Full:
+                    if time.monotonic() >= deadline:
+                        self.stats["rejected"] += 1
+                        return False
+            time.sleep(min(0.005, max(0.0, deadline - time.monotonic())))
+
+    def put_many(self, evs: list[dict]) -> bool:
+        """Encola todos o ninguno (para que el cliente pueda reintentar el lote completo)."""
+        self._ensure_started()
+        with self._lock:
+            if self._q.maxsize and self._q.qsize() + len(evs) > self._q.maxsize:
+                self.stats["rejected"] += len(evs)
+                return False
+            for ev in evs:
+                self._q.put_nowait(ev)
+            self.stats["enqueued"] += len(evs)
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._q.get(timeout=self._interval)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self._interval
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _commit(self, events: list[dict]):
+        db = SessionLocal()
+        try:
+            _ingest_events(db, events)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _write(self, batch: list[dict]):
+        with self._write_lock:
+            lag_ms = int((time.monotonic() - min(ev["t"] for ev in batch)) * 1000)
+            ok, failed = len(batch), 0
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Un evento malo no debe tumbar el lote entero: reintenta uno por uno
+                print("analytics flush error (batch):", e)
+                ok = 0
+                for ev in batch:
+                    try:
+                        self._commit([ev])
+                        ok += 1
+                    except Exception as e1:
+                        failed += 1
+                        print("analytics flush error (event):", ev.get("event"), e1)
+            with self._lock:
+                st = self.stats
+                st["flushed"] += ok
+                st["failed"] += failed
+                st["batches"] += 1
+                st["last_batch_size"] = len(batch)
+                st["last_flush_at"] = datetime.utcnow().isoformat() + "Z"
+                st["last_lag_ms"] = lag_ms
+                st["max_lag_ms"] = max(st["max_lag_ms"], lag_ms)
+
+    def flush(self):
+        """Escribe de forma síncrona todo lo que haya en cola."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self._max_batch:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self._interval + 5)
+        self.flush()
+
+    def snapshot(self) -> dict:
+        with self._q.mutex:
+            head = self._q.queue[0] if self._q.queue else None
+            depth = len(self._q.queue)
+        with self._lock:
+            out = dict(self.stats)
+        out["depth"] = depth
+        out["capacity"] = self._q.maxsize
+        out["oldest_pending_ms"] = int((time.monotonic() - head["t"]) * 1000) if head else 0
+        return out
+
+
+_event_buffer = _EventBuffer(ANALYTICS_QUEUE_MAX, ANALYTICS_FLUSH_MAX_EVENTS, ANALYTICS_FLUSH_INTERVAL_S)
+atexit.register(_event_buffer.close)
+
+
+@bp.post("/api/analytics/event")
+def analytics_event():
+    raw = request.get_data(cache=False, as_text=True)
+    try:
+        data = json.loads(raw) if raw else (request.get_json(force=True) or {})
+    except Exception as e:
+        current_app.logger.debug("/api/analytics/event bad json: %.200s", raw)
+        return jsonify(ok=False, error=f"bad json: {str(e)}"), 400
+
+    ev = _normalize_event(data, _request_event_defaults())
+    if ev is None:
+        return jsonify(ok=False, error="device_id y event son requeridos"), 400
+    _rollups.ensure_started()
 
+    if ANALYTICS_WRITE_BEHIND:
+        if not _event_buffer.put(ev, timeout=ANALYTICS_ENQUEUE_TIMEOUT_S):
+            resp = jsonify(ok=False, error="cola de eventos llena, reintenta")
+            resp.headers["Retry-After"] = "1"
+            return resp, 503
+        return jsonify(ok=True, queued=True), 202
+
+    db = SessionLocal()
+    try:
+        session_ids = _ingest_events(db, [ev])
         db.commit()
-        return jsonify(ok=True, session_id=str(session_rec.id)), 200
+        return jsonify(ok=True, session_id=session_ids[0]), 200
+
+    except Exception as e:
+        db.rollback()
+        return jsonify(ok=False, error=str(e)), 500
+    finally:
+        db.close()
+
+def _read_batch_body() -> bytes:
+    """Cuerpo del request, descomprimido si viene con Content-Encoding: gzip (con tope de tamaño)."""
+    raw = request.get_data(cache=False)
+    if (request.headers.get("Content-Encoding") or "").lower() != "gzip":
+        if len(raw) > ANALYTICS_BATCH_MAX_BYTES:
+            raise ValueError("body too large")
+        return raw
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out = d.decompress(raw, ANALYTICS_BATCH_MAX_BYTES)
+    if d.unconsumed_tail:
+        raise ValueError("body too large")
+    return out
+
+@bp.post("/api/analytics/events")
+def analytics_events():
+    """
+    Ingesta por lotes. Acepta una lista de eventos o un sobre:
+      {"device_id": "...", "user_agent": "...", "referrer": "...", "events": [{"event": "...", "payload": {...}}, ...]}
+    Los campos del sobre sirven de default para cada evento. Todo el lote va en una transacción.
+    """
+    try:
+        body = _read_batch_body()
+        data = json.loads(body) if body else {}
+    except (ValueError, zlib.error) as e:
+        return jsonify(ok=False, error=f"bad body: {str(e)}"), 400
+
+    envelope = data if isinstance(data, dict) else {}
+    items = data.get("events") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify(ok=False, error="events (lista) es requerido"), 400
+    if len(items) > ANALYTICS_BATCH_MAX_EVENTS:
+        return jsonify(ok=False, error=f"máximo {ANALYTICS_BATCH_MAX_EVENTS} eventos por lote"), 413
+
+    _rollups.ensure_started()
+    defaults = _request_event_defaults()
+    shared = {k: envelope.get(k) for k in ("device_id", "user_agent", "referrer", "geo") if envelope.get(k)}
+    events, rejected = [], 0
+    for item in items:
+        ev = _normalize_event({**shared, **item} if isinstance(item, dict) else None, defaults)
+        if ev is None:
+            rejected += 1
+        else:
+            events.append(ev)
+    if not events:
+        return jsonify(ok=False, error="ningún evento válido", rejected=rejected), 400
+
+    if ANALYTICS_WRITE_BEHIND:
+        if not _event_buffer.put_many(events):
+            resp = jsonify(ok=False, error="cola de eventos llena, reintenta")
+            resp.headers["Retry-After"] = "1"
+            return resp, 503
+        return jsonify(ok=True, queued=True, accepted=len(events), rejected=rejected), 202
 
+    db = SessionLocal()
+    try:
+        session_ids = _ingest_events(db, events)
+        db.commit()
+        return jsonify(ok=True, accepted=len(events), rejected=rejected, session_id=session_ids[-1]), 200
     except Exception as e:
         db.rollback()
         return jsonify(ok=False, error=str(e)), 500
     finally:
         db.close()
 
-@app.post("/analytics/logout")
+# ---- CACHÉS (inspección / vaciado) ----
+_CACHES = {
+    "verdicts": _verdict_cache,
+    "results": _result_cache,
+    "geo": _geo_cache,
+    "devices": _device_cache,
+    "stats": _stats_cache,
+    "queries": _query_cache,
+}
+
+@bp.get("/api/admin/caches")
+@require_admin
+def admin_caches():
+    return jsonify(ok=True, caches={name: c.stats() for name, c in _CACHES.items()})
+
+@bp.route("/api/admin/caches/<name>", methods=["GET", "DELETE"])
+@require_admin
+def admin_cache(name):
+    cache = _CACHES.get(name)
+    if cache is None:
+        return jsonify(ok=False, error=f"caché desconocida: {name}", available=sorted(_CACHES)), 404
+    if request.method == "DELETE":
+        return jsonify(ok=True, name=name, flushed=cache.clear())
+    return jsonify(ok=True, name=name, **cache.stats())
+
+@bp.post("/analytics/logout")
 def analytics_logout():
     # Limpia la sesión admin
     session.pop("admin_ok", None)
@@ -1028,6 +4426,39 @@ def analytics_logout():
     return jsonify(ok=True)
 
 
+# =========================
+#   App factory
+# =========================
+def create_app() -> Flask:
+    """
+    Crea la app Flask con las rutas y comandos de `bp`. Importar el módulo no abre conexiones ni importa
+    los SDKs de LLM ni numpy/pandas; el esquema se migra aparte (db-upgrade) salvo con AUTO_CREATE_TABLES=true,
+    y el primer request corre check_schema() (crea las tablas si la BD está vacía; si no, avisa y degrada).
+    Con `gunicorn --preload` el maestro importa una vez y los workers comparten esa memoria (copy-on-write).
+    """
+    flask_app = Flask(__name__, static_folder="static", template_folder="templates")
+    CORS(flask_app)
+    flask_app.secret_key = os.getenv("SECRET_KEY", "dev")
+    flask_app.register_blueprint(bp)
+    if AUTO_CREATE_TABLES:
+        try:
+            run_migrations(log=lambda *_: None)
+        except Exception as e:
+            print("DB init error:", e)
+    flask_app.before_request(_ensure_schema_checked)
+    return flask_app
+
+def _after_fork_in_child():
+    # --preload: el worker hereda el pool del maestro; lo descarta sin cerrar sockets que no son suyos
+    engine.dispose(close=False)
+    if read_engine is not None:
+        read_engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+app = create_app()  # gunicorn app:app / flask --app app / asgi.py
+
+
 # =========================
 #   Main
 # =========================
@@ -1035,19 +4466,12 @@ if __name__ == "__main__":
     port = int(os.getenv("PORT", "5000"))
     host = os.getenv("HOST", "0.0.0.0")
 
-    # Crear tablas si no existen (dev/primera vez)
-    try:
-        with engine.begin() as conn:
-            Base.metadata.create_all(bind=conn)
-        print("DB ready ✅")
-    except Exception as e:
-        print("DB init error:", e)
-
-    # Muestra rutas al arrancar (útil para verificar que /scorecard/which existe)
-    print("== URL MAP al arrancar ==")
-    for r in app.url_map.iter_rules():
-      print(" ", r.rule, "->", ",".join(sorted(r.methods)))
-
+    # Aplicar migraciones pendientes (dev/primera vez); con AUTO_CREATE_TABLES ya corrieron en create_app()
+    if not AUTO_CREATE_TABLES:
+        try:
+            run_migrations()
+            print("DB ready ✅")
+        except Exception as e:
+            print("DB init error:", e)
 
     app.run(host=host, port=port, debug=os.getenv("FLASH_DEBUG", "false").lower() == "true")
-
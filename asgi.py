@@ -0,0 +1,354 @@
+"""
+Entrada ASGI de GuíaIA.
+
+Las rutas que pasan casi todo su tiempo esperando al LLM o a la BD
+(/validate-step, /scorecard, /improve-online, /api/analytics/event) se atienden
+con handlers async: un solo proceso puede tener cientos de esperas abiertas.
+Todo lo demás se delega a la app Flask (WSGI) a través de asgiref.
+
+Ejecutar (junto o en lugar del WSGI de siempre):
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT
+"""
+import asyncio
+import json
+import os
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import app as guia
+
+_wsgi = WsgiToAsgi(guia.app)
+
+
+# =========================
+#   BD async (mismos modelos SQLAlchemy)
+# =========================
+# Pool propio, además del sync de app.py (5 + 10): solo lo usa la ingesta de /api/analytics/event,
+# así que por defecto es chico. Conexiones a Postgres por worker = 15 + ASYNC_POOL_SIZE + ASYNC_MAX_OVERFLOW.
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_POOL_SIZE", "2"))
+ASYNC_MAX_OVERFLOW = int(os.getenv("ASYNC_MAX_OVERFLOW", "2"))
+
+def _make_async_engine():
+    """Engine async para la misma DATABASE_URL. None si falta el driver (SQLite sin aiosqlite)."""
+    url = guia.DATABASE_URL
+    if url.startswith("sqlite:"):
+        try:
+            import aiosqlite  # noqa: F401
+        except ImportError:
+            return None
+        return create_async_engine(url.replace("sqlite:", "sqlite+aiosqlite:", 1))
+    if url.startswith("postgresql+psycopg") or url.startswith("postgresql:"):
+        url = url.replace("postgresql:", "postgresql+psycopg:", 1)
+        return create_async_engine(url, pool_pre_ping=True, pool_size=ASYNC_POOL_SIZE,
+                                   max_overflow=ASYNC_MAX_OVERFLOW)
+    return None
+
+async_engine = _make_async_engine()
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False) if async_engine else None
+
+
+async def ingest_events_async(events: list[dict]) -> list[str]:
+    """Ingesta en una transacción async; sin driver async, corre el camino sync en un hilo."""
+    if AsyncSessionLocal is None:
+        return await asyncio.to_thread(_ingest_events_sync, events)
+    async with AsyncSessionLocal() as db:
+        try:
+            out = await db.run_sync(guia._ingest_events, events)
+            await db.commit()
+            return out
+        except Exception:
+            await db.rollback()
+            raise
+
+def _ingest_events_sync(events: list[dict]) -> list[str]:
+    db = guia.SessionLocal()
+    try:
+        out = guia._ingest_events(db, events)
+        db.commit()
+        return out
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+async def _pre_resolve_geo(events: list[dict]):
+    """
+    La geo por red se resuelve fuera del event loop (en un hilo) antes de la ingesta. geo_resolved evita
+    que _ingest_events la vuelva a pedir (ya sin hilo) cuando el proveedor no encontró país.
+    """
+    for ev in events:
+        if ev["geo"].get("country") or guia.GEO_DEFERRED:
+            continue
+        geo = guia.peek_geo_for_ip(ev["ip"])
+        if geo is None:
+            geo = await asyncio.to_thread(guia.resolve_geo_for_ip, ev["ip"])
+        ev["geo"] = geo
+        ev["geo_resolved"] = True
+
+
+# =========================
+#   LLM async (Gemini)
+# =========================
+# Solo la llamada es async: caché, modelo y post-proceso son los *_prepare/*_finish de app.py
+async def gemini_one_word_async(system_msg: str, user_msg: str, cache_parts: tuple) -> str:
+    verdict, llm, key = guia._one_word_prepare(system_msg, user_msg, cache_parts)
+    if llm is None:
+        return verdict
+    return guia._one_word_finish(await llm.generate_content_async(user_msg), key)
+
+async def _combined_criteria_async(user_msg: str, objetivo: str, answer: str):
+    verdicts, llm, key = guia._combined_prepare(objetivo, answer)
+    if llm is None:
+        return verdicts
+    return guia._combined_finish(await llm.generate_content_async(user_msg), key)
+
+async def criteria_verdicts_async(objetivo: str, answer: str, drift_user: str, coh_user: str):
+    """Mismo contrato (y mismo registro de tiempos por modo) que _criteria_verdicts."""
+    mode = guia.CRITERIA_VALIDATION_MODE
+    parts = (objetivo, answer)
+    t0 = time.perf_counter()
+    try:
+        if mode == "combined":
+            res = await _combined_criteria_async(coh_user, objetivo, answer)
+            if res is not None:
+                return res
+            mode = "sequential"
+
+        if mode == "concurrent":
+            task_a = asyncio.ensure_future(gemini_one_word_async(guia._LLM_DRIFT_SYSTEM_CRITERIA, drift_user, parts))
+            task_b = asyncio.ensure_future(gemini_one_word_async(guia._LLM_COHERENCE_SYSTEM_CRITERIA, coh_user, parts))
+            pending, got = {task_a, task_b}, {}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    got[t] = t.result()
+                if "incoherente" in got.values():
+                    break
+            for t in pending:
+                t.cancel()  # la llamada gRPC async sí se cancela de verdad
+            return got.get(task_a), got.get(task_b)
+
+        v_a = await gemini_one_word_async(guia._LLM_DRIFT_SYSTEM_CRITERIA, drift_user, parts)
+        if v_a == "incoherente":
+            return v_a, None
+        return v_a, await gemini_one_word_async(guia._LLM_COHERENCE_SYSTEM_CRITERIA, coh_user, parts)
+    finally:
+        guia._record_criteria_timing(guia.CRITERIA_VALIDATION_MODE, (time.perf_counter() - t0) * 1000)
+
+async def validate_step_core_async(qid: str, answer: str, history: dict):
+    res, llm = guia._validate_step_plan(qid, answer, history)
+    if llm is None:
+        return res, 200
+    objetivo = llm["objetivo"]
+    if qid == "criterios":
+        res = guia._criteria_result(*await criteria_verdicts_async(objetivo, answer, llm["drift_user"], llm["coh_user"]))
+    else:
+        res = guia._context_result(
+            await gemini_one_word_async(guia._LLM_COHERENCE_SYSTEM_CONTEXT, llm["coh_user"], (objetivo, answer)))
+    await asyncio.to_thread(guia._log_verdict, qid, objetivo, answer, res)  # escritura de archivo: fuera del loop
+    return res, 200
+
+async def _safe_step_async(qid: str, answer: str, history: dict) -> dict:
+    try:
+        return (await validate_step_core_async(qid, answer, history))[0]
+    except Exception as e:
+        return {"ok": False, "hint": f"Error interno: {e}"}
+
+async def validate_steps_core_async(answers: dict) -> dict:
+    """Mismo contrato que validate_steps_core; todas las preguntas con LLM van en un gather."""
+    plan = guia._steps_plan(answers)
+    results = dict(zip([qid for qid, _, _ in plan],
+                       await asyncio.gather(*(_safe_step_async(*step) for step in plan))))
+    return guia._steps_payload(answers, plan, results)
+
+async def scorecard_async(prompt: str, api_key: str | None, model_name: str, use_cache: bool) -> dict:
+    hit, model, key = guia._scorecard_prepare(prompt, api_key, model_name, use_cache)
+    if hit is not None:
+        return hit
+    resp = await model.generate_content_async(guia._scorecard_user_msg(prompt))
+    return guia._finish_scorecard(guia._extract_text_from_candidates(resp), key)
+
+async def improve_async(base_prompt: str, use_cache: bool) -> dict:
+    hit, model, key = guia._improve_prepare(base_prompt, use_cache)
+    if hit is not None:
+        return hit
+    resp = await model.generate_content_async(base_prompt)
+    return {"prompt": guia._finish_improvement(resp, key), "cached": False}
+
+
+# =========================
+#   HTTP helpers (ASGI crudo)
+# =========================
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        msg = await receive()
+        chunks.append(msg.get("body", b""))
+        if not msg.get("more_body"):
+            return b"".join(chunks)
+
+def _headers(scope) -> dict:
+    return {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+
+async def _json_response(send, payload, status: int = 200, headers: dict | None = None):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    hdrs = {"content-type": "application/json", "access-control-allow-origin": "*", **(headers or {})}
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(k.encode(), str(v).encode()) for k, v in hdrs.items()]})
+    await send({"type": "http.response.body", "body": body})
+
+def _json_body(raw: bytes) -> dict:
+    try:
+        data = json.loads(raw) if raw else {}
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def _bypass(data: dict, headers: dict) -> bool:
+    return bool(data.get("no_cache")) or "no-cache" in headers.get("cache-control", "").lower()
+
+def _x_cache(bypass: bool, cached: bool) -> str:
+    return "BYPASS" if bypass or not guia.RESULT_CACHE_ENABLED else ("HIT" if cached else "MISS")
+
+def _client_ip(scope, headers: dict) -> str:
+    fwd = headers.get("x-forwarded-for")
+    if fwd:
+        return fwd.split(",")[0].strip()
+    client = scope.get("client") or ("", 0)
+    return client[0] or ""
+
+
+# =========================
+#   Handlers
+# =========================
+async def validate_step(scope, receive, send):
+    try:
+        if scope["method"] == "GET":
+            qs = parse_qs(scope.get("query_string", b"").decode("utf-8"))
+            arg = lambda k: (qs.get(k) or [None])[0]
+            qid = arg("question_id") or arg("qid")
+            answer = (arg("answer") or "").strip()
+            try:
+                history = json.loads(arg("history") or "{}")
+            except ValueError:
+                history = {}
+        else:
+            data = _json_body(await _read_body(receive))
+            qid = data.get("question_id") or data.get("qid")
+            answer = (data.get("answer", "") or "").strip()
+            history = data.get("history") or data.get("answers_so_far") or {}
+
+        if not qid:
+            return await _json_response(send, {"ok": False, "hint": "Falta 'question_id'."}, 400)
+        res, code = await validate_step_core_async(qid, answer, history)
+        return await _json_response(send, res, code)
+    except Exception as e:
+        return await _json_response(send, {"ok": False, "hint": f"Error interno: {e}"}, 500)
+
+async def validate_steps(scope, receive, send):
+    data = _json_body(await _read_body(receive))
+    answers = guia._steps_answers(data)
+    if answers is None:
+        return await _json_response(send, {"ok": False, "hint": "Falta 'answers' (objeto con las respuestas por pregunta)."}, 400)
+    try:
+        return await _json_response(send, await validate_steps_core_async(answers), 200)
+    except Exception as e:
+        return await _json_response(send, {"ok": False, "hint": f"Error interno: {e}"}, 500)
+
+async def scorecard(scope, receive, send):
+    headers = _headers(scope)
+    data = _json_body(await _read_body(receive))
+    prompt = (data.get("prompt") or "").strip()
+    model = (data.get("model") or "gemini-1.5-flash").strip()
+    if not prompt:
+        return await _json_response(send, {"ok": False, "error": "Falta 'prompt'."}, 400)
+    bypass = _bypass(data, headers)
+    sc = await scorecard_async(prompt, data.get("api_key"), model, use_cache=not bypass)
+    return await _json_response(send, guia._to_front_payload_v2(sc), 200, {
+        "cache-control": "no-store, no-cache, must-revalidate, max-age=0",
+        "x-cache": _x_cache(bypass, sc.get("_cached", False)),
+    })
+
+async def improve_online(scope, receive, send):
+    if not guia._HAS_GENAI:
+        return await _json_response(send, {"error": "Gemini no configurado. Define GEMINI_API_KEY."}, 501)
+    headers = _headers(scope)
+    data = _json_body(await _read_body(receive))
+    base_prompt = (data.get("prompt", "") or "").strip()
+    if not base_prompt:
+        return await _json_response(send, {"error": "Falta 'prompt'."}, 400)
+    bypass = _bypass(data, headers)
+    res = await improve_async(base_prompt, use_cache=not bypass)
+    return await _json_response(send, {"prompt": res["prompt"]}, 200,
+                                {"x-cache": _x_cache(bypass, res["cached"])})
+
+async def analytics_event(scope, receive, send):
+    headers = _headers(scope)
+    raw = await _read_body(receive)
+    try:
+        data = json.loads(raw) if raw else {}
+    except ValueError as e:
+        return await _json_response(send, {"ok": False, "error": f"bad json: {e}"}, 400)
+
+    defaults = {"user_agent": headers.get("user-agent", ""), "referrer": headers.get("referer", ""),
+                "ip": _client_ip(scope, headers)}
+    ev = guia._normalize_event(data, defaults)
+    if ev is None:
+        return await _json_response(send, {"ok": False, "error": "device_id y event son requeridos"}, 400)
+    guia._rollups.ensure_started()
+
+    if guia.ANALYTICS_WRITE_BEHIND:
+        # En el event loop no se bloquea: si la cola está llena, 503 inmediato
+        if not guia._event_buffer.put(ev):
+            return await _json_response(send, {"ok": False, "error": "cola de eventos llena, reintenta"},
+                                        503, {"retry-after": "1"})
+        return await _json_response(send, {"ok": True, "queued": True}, 202)
+
+    try:
+        await _pre_resolve_geo([ev])
+        session_ids = await ingest_events_async([ev])
+        return await _json_response(send, {"ok": True, "session_id": session_ids[0]})
+    except Exception as e:
+        return await _json_response(send, {"ok": False, "error": str(e)}, 500)
+
+
+_ROUTES = {}
+for _path in ("/validate-step", "/api/validate-step"):
+    _ROUTES[("GET", _path)] = validate_step
+    _ROUTES[("POST", _path)] = validate_step
+for _path in ("/validate-steps", "/api/validate-steps"):
+    _ROUTES[("POST", _path)] = validate_steps
+for _path in ("/scorecard", "/api/scorecard"):
+    _ROUTES[("POST", _path)] = scorecard
+for _path in ("/improve-online", "/api/improve-online"):
+    _ROUTES[("POST", _path)] = improve_online
+_ROUTES[("POST", "/api/analytics/event")] = analytics_event
+
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            # Vacía la cola write-behind y cierra el pool async antes de salir
+            await asyncio.to_thread(guia._event_buffer.close)
+            if async_engine is not None:
+                await async_engine.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] == "http":
+        handler = _ROUTES.get((scope["method"], scope["path"]))
+        if handler is not None:
+            if not guia._schema_checked.is_set():  # los handlers async no pasan por before_request de Flask
+                await asyncio.to_thread(guia._ensure_schema_checked)
+            return await handler(scope, receive, send)
+    return await _wsgi(scope, receive, send)
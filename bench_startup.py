@@ -0,0 +1,58 @@
+"""
+Benchmark de arranque: cuánto tarda un proceso nuevo (como un worker de gunicorn) en importar app.py
+y en responder su primer request. Cada corrida es un intérprete nuevo.
+
+    python bench_startup.py                 # 5 corridas, GET /
+    python bench_startup.py --runs 10 --path /health
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Código que corre en el proceso hijo: import, primer y segundo request, y qué SDKs quedaron cargados
+_CHILD = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+client = app.app.test_client()
+status = client.get(sys.argv[1]).status_code
+t2 = time.perf_counter()
+client.get(sys.argv[1])
+t3 = time.perf_counter()
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "first_request_ms": (t2 - t1) * 1000,
+    "second_request_ms": (t3 - t2) * 1000,
+    "status": status,
+    "loaded": [m for m in ("google.generativeai", "ollama", "pandas", "pyarrow") if m in sys.modules],
+}))
+"""
+
+def run_once(path: str) -> dict:
+    here = os.path.dirname(os.path.abspath(__file__))
+    t0 = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", _CHILD, path], cwd=here, capture_output=True, text=True, check=True)
+    res = json.loads(out.stdout.strip().splitlines()[-1])
+    res["process_ms"] = (time.perf_counter() - t0) * 1000
+    return res
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--path", default="/")
+    args = ap.parse_args()
+
+    runs = [run_once(args.path) for _ in range(max(1, args.runs))]
+    print(f"{len(runs)} corridas, GET {args.path} -> {runs[-1]['status']}")
+    for key in ("import_ms", "first_request_ms", "second_request_ms", "process_ms"):
+        vals = [r[key] for r in runs]
+        print(f"  {key:<18} mediana {statistics.median(vals):8.1f}   min {min(vals):8.1f}   max {max(vals):8.1f}")
+    print("  módulos pesados cargados:", ", ".join(runs[-1]["loaded"]) or "ninguno")
+
+if __name__ == "__main__":
+    main()
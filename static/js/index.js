@@ -42,6 +42,40 @@ async function postJSON(url, body){
   return r.json();
 }
 
+// Streaming SSE sobre POST (EventSource solo admite GET): llama onDelta por cada fragmento
+async function postSSE(url, body, onDelta){
+  const r = await fetch(url, {
+    method: "POST",
+    headers: {"Content-Type":"application/json", "Accept":"text/event-stream"},
+    body: JSON.stringify(body)
+  });
+  if (!r.ok || !r.body) throw new Error(await r.text());
+  const reader = r.body.getReader();
+  const dec = new TextDecoder();
+  let buf = "", final = null;
+  while (true){
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += dec.decode(value, { stream: true });
+    let i;
+    while ((i = buf.indexOf("\n\n")) >= 0){
+      const raw = buf.slice(0, i); buf = buf.slice(i + 2);
+      let ev = "message", data = "";
+      raw.split("\n").forEach(l => {
+        if (l.startsWith("event:")) ev = l.slice(6).trim();
+        else if (l.startsWith("data:")) data += l.slice(5).trim();
+      });
+      if (!data) continue;
+      const j = JSON.parse(data);
+      if (ev === "error") throw new Error(j.error || "error de streaming");
+      if (ev === "done") final = j;
+      else if (j.delta) onDelta(j.delta);
+    }
+  }
+  if (!final) throw new Error("stream incompleto");
+  return final;
+}
+
 // ===== Auto-scroll robusto =====
 function scrollElToBottom(el, { smooth = true } = {}) {
   if (!el) return;
@@ -241,14 +275,32 @@ function renderActionButtonsOnce(){
     const old = btnImprove.textContent;
     btnImprove.disabled = true; btnImprove.textContent = "Mejorando...";
 
+    let bubble = null;
     try{
-      const data = await postJSON('/improve-online', { prompt: basePrompt });
-      if (data.error) throw new Error(data.error);
-      const improved = (data.prompt || "").trim();
-      burBot(`<b>Prompt mejorado (≤150 palabras):</b><br><pre style="white-space:pre-wrap;margin:0">${esc(improved)}</pre>`);
+      let improved = "";
+      bubble = burBot(`<b>Prompt mejorado (≤150 palabras):</b><br><pre style="white-space:pre-wrap;margin:0"></pre>`);
+      const pre = bubble.querySelector('pre');
+      let streamed = false;
+      try {
+        // Texto progresivo vía SSE
+        const done = await postSSE('/improve-online/stream', { prompt: basePrompt }, delta => {
+          streamed = true;
+          pre.textContent += delta;
+          scrollChatToBottom({ smooth:false });
+        });
+        improved = (done.prompt || "").trim();
+      } catch(err) {
+        if (streamed) throw err;
+        // Sin streaming disponible: respuesta completa de una vez
+        const data = await postJSON('/improve-online', { prompt: basePrompt });
+        if (data.error) throw new Error(data.error);
+        improved = (data.prompt || "").trim();
+      }
+      pre.textContent = improved;
       scrollChatToBottom();
       renderPostImproveButtonsOnce(improved);
     }catch(e){
+      bubble?.remove();
       burBot("⚠️ No se pudo mejorar el prompt: " + esc(e.message));
       scrollChatToBottom();
       try { if (typeof window.onWrongAnswer === "function") window.onWrongAnswer(); } catch {}